@@ -9,8 +9,8 @@ import logging
 import shutil
 from pathlib import Path
 
-import redis.asyncio as aioredis
 from core.config import settings
+from core.redis_pools import POOL_CACHE, POOL_FSM, close_redis_pools, get_redis
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("cleanup")
@@ -18,7 +18,7 @@ log = logging.getLogger("cleanup")
 
 async def cleanup_fsm_old_states():
     """Очистка FSM с защитой от бесконечного цикла"""
-    r = aioredis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_FSM)
+    r = get_redis(POOL_FSM)
     
     try:
         cursor = 0
@@ -50,8 +50,6 @@ async def cleanup_fsm_old_states():
     
     except Exception as e:
         log.error(f"❌ FSM cleanup error: {e}")
-    finally:
-        await r.aclose()
 
 
 async def _cleanup_directory(directory: Path, max_age_hours: float, pattern: str = "*"):
@@ -117,9 +115,11 @@ async def emergency_cleanup_if_needed():
                 except Exception as e:
                     log.error(f"Failed to send disk alert: {e}")
             
-            # Удалить ВСЕ файлы старше 5 минут
+            # Удалить ВСЕ результаты старше 5 минут
             await _cleanup_directory(Path("/tmp/nanobanana"), max_age_hours=0.08, pattern="*")
-            await _cleanup_directory(Path("/app/temp_inputs"), max_age_hours=0.08, pattern="*")
+            # Входные фото — через input_store: только без ref и простаивающие > 5 минут
+            from services.input_store import sweep_inputs
+            await sweep_inputs({}, idle_ttl_s=300)
             
             log.info("✅ Emergency cleanup completed")
         else:
@@ -137,15 +137,12 @@ async def cleanup_old_temp_files():
     if temp_dir.exists():
         await _cleanup_directory(temp_dir, max_age_hours=0.5, pattern="*")  # ✅ ИЗМЕНЕНО
     
-    # ✅ ИЗМЕНЕНО: /app/temp_inputs - 5 минут вместо 10
-    temp_inputs = Path("/app/temp_inputs")
-    if temp_inputs.exists():
-        await _cleanup_directory(temp_inputs, max_age_hours=0.08, pattern="*")  # ✅ ~5 минут
+    # /app/temp_inputs чистит только input_store.sweep_inputs (refcount + INPUT_STORE_TTL_S)
 
 
 async def cleanup_old_redis_markers():
     """Очистка старых маркеров в Redis"""
-    r = aioredis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_CACHE)
+    r = get_redis(POOL_CACHE)
     
     try:
         deleted = 0
@@ -184,8 +181,6 @@ async def cleanup_old_redis_markers():
     
     except Exception as e:
         log.error(f"❌ Redis markers cleanup error: {e}")
-    finally:
-        await r.aclose()
 
 
 async def main():
@@ -195,6 +190,7 @@ async def main():
     await cleanup_fsm_old_states()
     await cleanup_old_temp_files()
     await cleanup_old_redis_markers()
+    await close_redis_pools()
     
     log.info("✅ Cleanup completed")
 
@@ -9,13 +9,12 @@ from aiogram.filters import Command
 from aiogram.types import Message
 from sqlalchemy import select, update
 
-from arq import create_pool
-from arq.connections import RedisSettings
 import tempfile  
 
 from core.config import settings
 from db.engine import SessionLocal
 from db.models import BroadcastJob, User
+from services.arq_pool import BACKGROUND_QUEUE, ArqClient, get_arq_client
 
 router = Router()
 
@@ -30,7 +29,7 @@ def _is_admin(uid: int) -> bool:
 
 
 @router.message(Command("broadcast"))
-async def cmd_broadcast(msg: Message):
+async def cmd_broadcast(msg: Message, arq_client: ArqClient | None = None):
     """
     Рассылка:
     1. /broadcast Текст — текстовая
@@ -88,15 +87,8 @@ async def cmd_broadcast(msg: Message):
         session.add(bj)
         await session.commit()
 
-    # Запустить в ARQ
-    redis_pool = await create_pool(
-        RedisSettings(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            database=settings.REDIS_DB_CACHE,  # ✅ CACHE
-        )
-    )
-    await redis_pool.enqueue_job("broadcast_send", job_id)
+    # Запустить в ARQ (общий клиент процесса, без create_pool на каждый вызов)
+    await (arq_client or get_arq_client()).enqueue_job("broadcast_send", job_id, _queue_name=BACKGROUND_QUEUE)
     
     media_info = ""
     if media_type == "photo":
@@ -1,19 +1,21 @@
 from __future__ import annotations
 
+import asyncio
 import os
 import sys
-import asyncio
 import logging
 import time
-from typing import List, Dict, Optional
+from typing import Any, Awaitable, List, Dict, Optional, Tuple
 
 from aiogram import Router, F, Bot
 from aiogram.filters import Command
 from aiogram.types import (
     Message, CallbackQuery, FSInputFile,
     InlineKeyboardMarkup, InlineKeyboardButton,
+    InputMediaDocument, InputMediaPhoto,
 )
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 from sqlalchemy import select
 from aiogram.exceptions import TelegramBadRequest
 
@@ -23,12 +25,15 @@ from db.models import User
 from services.pricing import CREDITS_PER_GENERATION
 from bot.states import GenStates
 from bot.keyboards import kb_gen_step_back, kb_final_result
-from services.queue import enqueue_generation
+from services.queue import enqueue_generation, enqueue_preingest
+from services.album_aggregator import append_album_item
+from services.chat_lanes import chat_lane
 from services.telegram_safe import (
     safe_answer,
     safe_send_text,
     safe_send_photo,
     safe_send_document,
+    safe_send_document_id,
     safe_edit_text,
     safe_delete_message,
 )
@@ -37,8 +42,6 @@ from core.config import settings
 log = logging.getLogger("generation")
 router = Router()
 
-_DEBOUNCE_TASKS: Dict[int, asyncio.Task] = {}
-
 
 def resource_path(relative_path: str) -> str:
     try:
@@ -118,11 +121,11 @@ async def auto_start_on_photo(m: Message, state: FSMContext):
         await handle_document_images(m, state)
 
 
-async def _kick_generation_now(m: Message, state: FSMContext, prompt: str) -> None:
+async def _kick_generation_now(bot: Bot, chat_id: int, user_id: int, state: FSMContext, prompt: str) -> None:
     prompt = (prompt or "").strip()
     if len(prompt) < 3:
         await state.set_state(GenStates.waiting_prompt)
-        await safe_send_text(m.bot, m.chat.id, "Введите промт (что изменить):", reply_markup=kb_gen_step_back())
+        await safe_send_text(bot, chat_id, "Введите промт (что изменить):", reply_markup=kb_gen_step_back())
         return
 
     data = await state.get_data()
@@ -130,19 +133,19 @@ async def _kick_generation_now(m: Message, state: FSMContext, prompt: str) -> No
     
     if not photos:
         await state.set_state(GenStates.waiting_prompt)
-        await safe_send_text(m.bot, m.chat.id, "Введите промт (что изменить):", reply_markup=kb_gen_step_back())
+        await safe_send_text(bot, chat_id, "Введите промт (что изменить):", reply_markup=kb_gen_step_back())
         return
 
     file_ids = [p["file_id"] for p in photos]
     await state.set_state(GenStates.generating)
-    wait_msg = await safe_send_text(m.bot, m.chat.id, "Генерирую…")
+    wait_msg = await safe_send_text(bot, chat_id, "Генерирую…")
     await state.update_data(
         prompt=prompt,
         mode="edit",
         wait_msg_id=getattr(wait_msg, "message_id", None),
         gen_started_at=int(time.time()),
     )
-    await enqueue_generation(m.from_user.id, prompt, file_ids)
+    await enqueue_generation(user_id, prompt, file_ids)
 
 
 @router.message(Command("gen"))
@@ -172,7 +175,6 @@ async def cmd_gen(m: Message, state: FSMContext, user_id: Optional[int] = None,
 
 
 async def start_generation(m: Message, state: FSMContext, show_intro: bool = True) -> None:
-    _cancel_debounce(m.chat.id)
     await state.clear()
     await state.set_state(GenStates.uploading_images)
     await state.update_data(photos=[], album_id=None, finalized=False)
@@ -198,19 +200,7 @@ def _is_image_document(msg: Message) -> bool:
     return False
 
 
-# def _cancel_debounce(chat_id: int) -> None:
-#     task = _DEBOUNCE_TASKS.pop(chat_id, None)
-#     if task and not task.done():
-#         task.cancel()
-
-def _cancel_debounce(chat_id: int) -> None:
-    task = _DEBOUNCE_TASKS.pop(chat_id, None)  # pop - хорошо
-    if task and not task.done():
-        task.cancel()
-
-async def _finalize_to_prompt(m: Message, state: FSMContext) -> None:
-    _cancel_debounce(m.chat.id)
-
+async def _finalize_to_prompt(bot: Bot, chat_id: int, user_id: int, state: FSMContext) -> None:
     data = await state.get_data()
     if data.get("finalized"):
         return
@@ -221,27 +211,43 @@ async def _finalize_to_prompt(m: Message, state: FSMContext) -> None:
 
     await state.update_data(finalized=True)
 
+    # ✅ Фото качаются в фоне, пока пользователь пишет промт
+    try:
+        await enqueue_preingest(chat_id, [p["file_id"] for p in photos])
+    except Exception as e:
+        log.warning(f"preingest enqueue failed: {e}")
+
     auto_prompt = (data.get("auto_prompt") or "").strip()
     if auto_prompt:
         await state.update_data(auto_prompt=None)
-        return await _kick_generation_now(m, state, auto_prompt)
+        return await _kick_generation_now(bot, chat_id, user_id, state, auto_prompt)
 
     await state.set_state(GenStates.waiting_prompt)
-    await safe_send_text(m.bot, m.chat.id, "Введите промт (что изменить):", reply_markup=kb_gen_step_back())
+    await safe_send_text(bot, chat_id, "Введите промт (что изменить):", reply_markup=kb_gen_step_back())
 
-    
-def _schedule_album_finalize(m: Message, state: FSMContext, delay: float = 2.0):
-    async def _debounce():
-        try:
-            await asyncio.sleep(delay)
-            await _finalize_to_prompt(m, state)
-        except asyncio.CancelledError:
-            return
-        finally:
-            _DEBOUNCE_TASKS.pop(m.chat.id, None)
 
-    _cancel_debounce(m.chat.id)
-    _DEBOUNCE_TASKS[m.chat.id] = asyncio.create_task(_debounce())
+async def on_album_ready(
+    bot: Bot,
+    storage: BaseStorage,
+    media_group_id: str,
+    chat_id: int,
+    user_id: int,
+    items: List[Dict[str, str]],
+) -> None:
+    """
+    ✅ Финализация альбома (вызывается AlbumAggregator ровно один раз на media_group_id).
+    Работает вне хендлера, поэтому берёт тот же lane-лок чата, что и апдейты.
+    """
+    async with chat_lane(chat_id):
+        state = FSMContext(storage=storage, key=StorageKey(bot.id, chat_id, user_id))
+        if await state.get_state() != GenStates.uploading_images.state:
+            return
+        data = await state.get_data()
+        # Пользователь успел начать заново / прислать другой альбом — этот уже не актуален
+        if data.get("finalized") or data.get("album_id") != media_group_id:
+            return
+        await state.update_data(photos=items[:4])
+        await _finalize_to_prompt(bot, chat_id, user_id, state)
 
 
 async def _accept_photo(m: Message, state: FSMContext, item: Dict[str, str]) -> None:
@@ -254,34 +260,23 @@ async def _accept_photo(m: Message, state: FSMContext, item: Dict[str, str]) ->
         await safe_send_text(m.bot, m.chat.id, "Изображения уже приняты.")
         return
 
-    # ✅ ИСПРАВЛЕНО: проверка ДО append
-    if len(photos) >= 4:
-        return  # Молча игнорируем 5+ фото
-
     mgid = getattr(m, "media_group_id", None)
 
-    if not photos:
-        if mgid:
-            await state.update_data(album_id=str(mgid))
-            photos.append(item)
-            await state.update_data(photos=photos)
-            _schedule_album_finalize(m, state, delay=2.0)
-            return
-        else:
-            photos.append(item)
-            await state.update_data(photos=photos)
-            await _finalize_to_prompt(m, state)
+    if mgid:
+        # ✅ Альбом собирается в Redis (общий для всех воркеров), 5+ фото отбрасываются там же
+        if not photos and album_id in (None, str(mgid)):
+            if album_id is None:
+                await state.update_data(album_id=str(mgid))
+            await append_album_item(str(mgid), m.chat.id, m.from_user.id, item)
             return
+        await safe_send_text(m.bot, m.chat.id, "Изображения уже приняты.")
+        return
 
-    if album_id is not None:
-        if mgid and str(mgid) == album_id:
-            photos.append(item)
-            await state.update_data(photos=photos)
-            _schedule_album_finalize(m, state, delay=2.0)
-            return
-        else:
-            await safe_send_text(m.bot, m.chat.id, "Изображения уже приняты.")
-            return
+    if not photos and album_id is None:
+        photos.append(item)
+        await state.update_data(photos=photos)
+        await _finalize_to_prompt(m.bot, m.chat.id, m.from_user.id, state)
+        return
 
     await safe_send_text(m.bot, m.chat.id, "Изображения уже приняты.")
     return
@@ -318,7 +313,6 @@ async def handle_text_while_upload(m: Message, state: FSMContext) -> None:
 @router.callback_query(GenStates.waiting_prompt, F.data == "back_to_images")
 async def back_to_images(c: CallbackQuery, state: FSMContext) -> None:
     await safe_answer(c)
-    _cancel_debounce(c.message.chat.id)
     await state.set_state(GenStates.uploading_images)
     await state.update_data(photos=[], album_id=None, finalized=False)
     await safe_edit_text(c.message, "Пришлите 1-4 фотографии которые нужно изменить или объединить")
@@ -391,6 +385,33 @@ async def got_user_prompt(m: Message, state: FSMContext) -> None:
         await safe_send_text(m.bot, m.chat.id, "⚠️ Произошла ошибка.\nНапишите в поддержку: @guard_gpt")
 
 
+def plan_result_edit(data: Dict[str, Any], edit: str) -> Optional[Tuple[str, List[str], Dict[str, Any]]]:
+    """
+    ✅ Правка результата. Если есть URL прошлого результата — он и есть вход,
+    а промт — только сама правка (без скачивания из Telegram). Иначе — как
+    раньше: исходные фото + накопленный промт.
+    Возвращает (prompt, входы для enqueue_generation, поля для FSM) или None.
+    """
+    base_prompt = (data.get("base_prompt") or data.get("prompt") or "").strip()
+    edits = list(data.get("edits") or [])
+    edits.append(edit)
+    updates: Dict[str, Any] = {"base_prompt": base_prompt, "edits": edits}
+
+    last_result_url = data.get("last_result_url")
+    if settings.EDIT_FROM_RESULT and last_result_url:
+        updates["input_urls"] = [last_result_url]
+        return edit, [last_result_url], updates
+
+    photos: List[Dict[str, str]] = data.get("photos") or []
+    if not photos:
+        return None
+    cumulative_prompt = " ".join([base_prompt] + edits).strip()
+    if len(cumulative_prompt) > 4000:
+        cumulative_prompt = cumulative_prompt[:4000]
+    updates["input_urls"] = None
+    return cumulative_prompt, [p["file_id"] for p in photos], updates
+
+
 @router.message(GenStates.final_menu)
 async def handle_final_menu_message(m: Message, state: FSMContext) -> None:
     if not m.text:
@@ -407,38 +428,29 @@ async def handle_final_menu_message(m: Message, state: FSMContext) -> None:
         prompt = prompt[:2000]
 
     data = await state.get_data()
-    photos: List[Dict[str, str]] = data.get("photos") or []
-    if not photos:
+    plan = plan_result_edit(data, prompt)
+    if plan is None:
         await safe_send_text(m.bot, m.chat.id, "Не удалось найти исходные изображения. Нажмите «Начать заново».")
         return
+    gen_prompt, inputs, updates = plan
 
-    base_prompt = (data.get("base_prompt") or data.get("prompt") or "").strip()
-    edits = list(data.get("edits") or [])
-    edits.append(prompt)
-    cumulative_prompt = " ".join([base_prompt] + edits).strip()
-    if len(cumulative_prompt) > 4000:
-        cumulative_prompt = cumulative_prompt[:4000]
-
-    file_ids = [p["file_id"] for p in photos]
     await state.set_state(GenStates.generating)
     try:
         wait_msg = await safe_send_text(m.bot, m.chat.id, "Генерирую…")
         await state.update_data(
-            prompt=cumulative_prompt,
-            base_prompt=base_prompt,
-            edits=edits,
+            prompt=gen_prompt,
             mode="edit",
             wait_msg_id=getattr(wait_msg, "message_id", None),
             gen_started_at=int(time.time()),
+            **updates,
         )
-        await enqueue_generation(m.from_user.id, cumulative_prompt, file_ids)
+        await enqueue_generation(m.from_user.id, gen_prompt, inputs)
     except Exception:
         await safe_send_text(m.bot, m.chat.id, "⚠️ Произошла ошибка.\nНапишите в поддержку: @guard_gpt")
 
 @router.callback_query(F.data == "new_image")
 async def new_image_any_state(c: CallbackQuery, state: FSMContext) -> None:
     await safe_answer(c)
-    _cancel_debounce(c.message.chat.id)
     await state.clear()
     await start_generation(c.message, state, show_intro=True)
 
@@ -449,7 +461,9 @@ async def regenerate(c: CallbackQuery, state: FSMContext) -> None:
     data = await state.get_data()
     prompt = data.get("prompt")
     photos: List[Dict[str, str]] = data.get("photos")
-    if not (prompt and photos):
+    # Повтор правки результата — снова от того же входа, а не от исходных фото
+    inputs: List[str] = data.get("input_urls") or [p["file_id"] for p in (photos or [])]
+    if not (prompt and inputs):
         await safe_send_text(c.bot, c.message.chat.id, "⚠️ Произошла ошибка.\nНапишите в поддержку: @guard_gpt")
         return
     try:
@@ -458,8 +472,7 @@ async def regenerate(c: CallbackQuery, state: FSMContext) -> None:
             wait_msg_id=getattr(wait_msg, "message_id", None),
             gen_started_at=int(time.time()),
         )
-        file_ids = [p["file_id"] for p in photos]
-        await enqueue_generation(c.from_user.id, prompt, file_ids)
+        await enqueue_generation(c.from_user.id, prompt, inputs)
     except Exception:
         await safe_send_text(c.bot, c.message.chat.id, "⚠️ Произошла ошибка.\nНапишите в поддержку: @guard_gpt")
 
@@ -468,11 +481,19 @@ async def regenerate(c: CallbackQuery, state: FSMContext) -> None:
 async def send_file_cb(c: CallbackQuery, state: FSMContext) -> None:
     await safe_answer(c)
     data = await state.get_data()
+    caption = "Скачать файлом — качество будет лучше, чем при просмотре здесь"
+    # ✅ Файл уже загружен в Telegram при доставке — отправляем по file_id, без upload
+    doc_file_id = data.get("last_result_doc_file_id")
+    if doc_file_id:
+        if await safe_send_document_id(c.bot, c.message.chat.id, doc_file_id, caption=caption) is not None:
+            return
     file_path = data.get("file_path")
     if file_path and os.path.exists(file_path):
-        ok = await safe_send_document(c.bot, c.message.chat.id, file_path, caption="Скачать файлом — качество будет лучше, чем при просмотре здесь")
-        if ok is None:
+        msg = await safe_send_document(c.bot, c.message.chat.id, file_path, caption=caption)
+        if msg is None:
             return
+        if msg.document:
+            await state.update_data(last_result_doc_file_id=msg.document.file_id)
     else:
         await safe_send_text(c.bot, c.message.chat.id, "Файл недоступен. Попробуйте сгенерировать снова.")
 
@@ -480,7 +501,6 @@ async def send_file_cb(c: CallbackQuery, state: FSMContext) -> None:
 @router.callback_query(GenStates.final_menu, F.data == "cancel")
 async def cancel_session(c: CallbackQuery, state: FSMContext) -> None:
     await safe_answer(c)
-    _cancel_debounce(c.message.chat.id)
     await state.clear()
     await safe_send_text(c.bot, c.message.chat.id, "Сессия завершена. Наберите /gen для нового изображения.")
     try:
@@ -592,101 +612,170 @@ async def send_generation_result(
     file_path: str,
     bot: Bot,
     preview_path: Optional[str] = None,  # ✅ ДОБАВЛЕНО
-) -> None:
-    from aiogram.fsm.context import FSMContext
-    from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
-    from aiogram.fsm.storage.base import StorageKey
-    import redis.asyncio as redis
-
-    redis_cli = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_FSM)
-    
-    try:
-        storage = RedisStorage(redis=redis_cli, key_builder=DefaultKeyBuilder(with_bot_id=True))
-        bot_info = await bot.get_me()
-        state = FSMContext(storage=storage, key=StorageKey(bot_info.id, chat_id, chat_id))
+    *,
+    with_document: bool = True,
+    document_file_id: Optional[str] = None,
+    photo_url: Optional[str] = None,
+    document_ready: Optional[Awaitable[bool]] = None,
+) -> Dict[str, Any]:
+    """
+    ✅ Отправка результата; возвращает, что реально ушло в Telegram:
+    {"document": ..., "photo": ..., "document_file_id": ...}. Пока photo
+    не ушло, FSM не трогаем — доставку повторит outbox (services.delivery),
+    document повторно не шлём (его file_id передаётся в document_file_id).
+
+    document и photo загружаются параллельно: задержка — max, а не сумма
+    двух upload'ов. Порядок в чате всё равно фиксированный (document, затем
+    photo с кнопками): если photo пришло раньше, сообщения меняются
+    содержимым через editMessageMedia по file_id (без повторной загрузки). file_id обоих сохраняются в FSM, повторная отправка
+    файла (send_file_cb) идёт по file_id без повторной загрузки.
+
+    photo_url — Telegram забирает фото сам (без превью и upload), а
+    оригинал для document ещё докачивается: document_ready ждём перед его
+    отправкой (False — файла не будет, document не шлём).
+    """
+    from core.fsm import external_fsm
+
+    state = external_fsm(chat_id)
 
-        data = await state.get_data()
-        wait_msg_id = data.get("wait_msg_id")
-        if wait_msg_id:
-            try:
-                await bot.delete_message(chat_id, wait_msg_id)
-            except Exception:
-                pass
-
-        mode = (data.get("mode") or "edit").lower().strip()
-        
-        # ✅ Если preview_path не передан - используем оригинал
-        if not preview_path:
-            preview_path = file_path
-
-        # ✅ Отправляем document для скачивания (оригинал)
-        if file_path and os.path.exists(file_path):
-            await safe_send_document(
-                bot,
-                chat_id,
-                file_path,
-                caption="Скачать файлом — качество будет лучше, чем при просмотре здесь"
-            )
-
-        # ✅ Режим create
-        if mode == "create":
-            result_msg = await safe_send_photo(
-                bot,
-                chat_id,
-                FSInputFile(preview_path),  # ✅ Используем превью
-                caption="Готово ✅ Напишите новый промт, чтобы сгенерировать ещё.",
-                reply_markup=None,
-            )
-            
-            result_file_id = None
-            if result_msg and result_msg.photo:
-                result_file_id = result_msg.photo[-1].file_id
-            
-            await state.clear()
-            await state.set_state(CreateStates.waiting_prompt)
-            await state.update_data(
-                mode="create",
-                prompt=prompt,
-                last_result_file_id=result_file_id,
-                file_path=file_path,
-            )
-            return
-
-        # ✅ Режим edit - отправляем photo с кнопками (превью)
-        result_msg = await safe_send_photo(
-            bot,
-            chat_id,
-            FSInputFile(preview_path),  # ✅ Используем превью
-            caption="<b>Если хотите что-то изменить или добавить напишите в чат ⬇️</b>",
-            reply_markup=kb_final_result(),
-        )
+    data = await state.get_data()
+    wait_msg_id = data.get("wait_msg_id")
+    if wait_msg_id:
+        try:
+            await bot.delete_message(chat_id, wait_msg_id)
+        except Exception:
+            pass
 
-        result_file_id = None
-        if result_msg and result_msg.photo:
-            result_file_id = result_msg.photo[-1].file_id
+    mode = (data.get("mode") or "edit").lower().strip()
+    
+    # ✅ Если preview_path не передан - используем оригинал
+    if not preview_path:
+        preview_path = file_path
+
+    sent: Dict[str, Any] = {"document": False, "photo": False, "document_file_id": document_file_id}
+
+    doc_caption = "Скачать файлом — качество будет лучше, чем при просмотре здесь"
+
+    async def _send_doc() -> Optional[Message]:
+        # ✅ document для скачивания (оригинал)
+        if with_document and document_ready is not None and not await document_ready:
+            return None
+        if not (with_document and file_path and os.path.exists(file_path)):
+            return None
+        doc_msg = await safe_send_document(bot, chat_id, file_path, caption=doc_caption)
+        sent["document"] = doc_msg is not None
+        if doc_msg is not None and doc_msg.document:
+            sent["document_file_id"] = doc_msg.document.file_id
+        return doc_msg
+
+    if mode == "create":
+        caption = "Готово ✅ Напишите новый промт, чтобы сгенерировать ещё."
+        reply_markup = None
+    else:
+        caption = "<b>Если хотите что-то изменить или добавить напишите в чат ⬇️</b>"
+        reply_markup = kb_final_result()
 
-        photos = data.get("photos", [])
-        base_prompt = data.get("base_prompt") or prompt
-        edits = data.get("edits") or []
-        
+    # ✅ photo (превью) и document уходят одновременно
+    doc_msg, result_msg = await asyncio.gather(
+        _send_doc(),
+        safe_send_photo(bot, chat_id, photo_url or FSInputFile(preview_path), caption=caption, reply_markup=reply_markup),
+    )
+    if result_msg is None:
+        return sent
+    sent["photo"] = True
+    if doc_msg is not None and result_msg.message_id < doc_msg.message_id:
+        result_msg = await _restore_order(bot, chat_id, doc_msg, result_msg, doc_caption, caption, reply_markup)
+
+    result_file_id = None
+    if result_msg.photo:
+        result_file_id = result_msg.photo[-1].file_id
+
+    # ✅ Режим create
+    if mode == "create":
         await state.clear()
-        await state.set_state(GenStates.final_menu)
+        await state.set_state(CreateStates.waiting_prompt)
         await state.update_data(
-            mode="edit",
+            mode="create",
             prompt=prompt,
-            base_prompt=base_prompt,
-            edits=edits,
-            photos=photos,
             last_result_file_id=result_file_id,
+            last_result_doc_file_id=sent["document_file_id"],
             file_path=file_path,
         )
-        
-        # ✅ ДОБАВЛЕНО: Удаляем preview после отправки (если это не оригинал)
-        if preview_path != file_path and os.path.exists(preview_path):
-            try:
-                os.unlink(preview_path)
-            except Exception:
-                pass
+        _drop_preview(preview_path, file_path)
+        return sent
+
+    # ✅ Режим edit - кнопки уже на photo
+    photos = data.get("photos", [])
+    base_prompt = data.get("base_prompt") or prompt
+    edits = data.get("edits") or []
     
-    finally:
-        await redis_cli.aclose()
\ No newline at end of file
+    await state.clear()
+    await state.set_state(GenStates.final_menu)
+    await state.update_data(
+        mode="edit",
+        prompt=prompt,
+        base_prompt=base_prompt,
+        edits=edits,
+        photos=photos,
+        input_urls=data.get("input_urls"),
+        last_result_file_id=result_file_id,
+        last_result_doc_file_id=sent["document_file_id"],
+        last_result_url=image_url,
+        file_path=file_path,
+    )
+    _drop_preview(preview_path, file_path)
+    return sent
+
+
+async def _restore_order(
+    bot: Bot,
+    chat_id: int,
+    doc_msg: Message,
+    photo_msg: Message,
+    doc_caption: str,
+    caption: str,
+    reply_markup: Optional[InlineKeyboardMarkup],
+) -> Message:
+    """
+    photo обогнало document: меняем сообщения содержимым, чтобы последним
+    было photo с кнопками. Возвращает сообщение, где теперь photo.
+    """
+    if not (doc_msg.document and photo_msg.photo):
+        return photo_msg
+    photo_media = InputMediaPhoto(media=photo_msg.photo[-1].file_id, caption=caption, parse_mode="HTML")
+    try:
+        await bot.edit_message_media(
+            chat_id=chat_id,
+            message_id=photo_msg.message_id,
+            media=InputMediaDocument(media=doc_msg.document.file_id, caption=doc_caption),
+        )
+    except Exception as e:
+        log.warning(f"restore result order failed chat_id={chat_id}: {e}")
+        return photo_msg
+    try:
+        moved = await bot.edit_message_media(
+            chat_id=chat_id,
+            message_id=doc_msg.message_id,
+            media=photo_media,
+            reply_markup=reply_markup,
+        )
+    except Exception as e:
+        # Вернуть photo на место, чтобы не осталось двух document
+        log.warning(f"restore result order failed chat_id={chat_id}: {e}")
+        try:
+            await bot.edit_message_media(
+                chat_id=chat_id, message_id=photo_msg.message_id, media=photo_media, reply_markup=reply_markup,
+            )
+        except Exception:
+            pass
+        return photo_msg
+    return moved if isinstance(moved, Message) else photo_msg
+
+
+def _drop_preview(preview_path: str, file_path: str) -> None:
+    # ✅ Удаляем preview после отправки (если это не оригинал)
+    if preview_path != file_path and os.path.exists(preview_path):
+        try:
+            os.unlink(preview_path)
+        except Exception:
+            pass
@@ -356,11 +356,10 @@ async def stars_success(m: Message, state: FSMContext):
             return
         
         # Идемпотентность через Redis
-        import redis.asyncio as aioredis
-        from core.config import settings
+        from core.redis_pools import POOL_CACHE, get_redis
         
         idempotency_key = f"stars:paid:{charge_id}"
-        r = aioredis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_CACHE)
+        r = get_redis(POOL_CACHE)
         
         try:
             already_processed = await r.exists(idempotency_key)
@@ -372,11 +371,6 @@ async def stars_success(m: Message, state: FSMContext):
             await r.setex(idempotency_key, 604800, "1")
         except Exception as e:
             log.error(f"❌ Redis error: user={m.from_user.id}, error={e}")
-        finally:
-            try:
-                await r.aclose()
-            except Exception:
-                pass
         
         async with SessionLocal() as s:
             try:
@@ -15,6 +15,7 @@ from pydub.effects import normalize
 from core.config import settings
 from bot.states import GenStates, CreateStates
 from services.queue import enqueue_generation
+from bot.routers.generation import plan_result_edit
 
 router = Router()
 logger = logging.getLogger("voice")
@@ -125,31 +126,23 @@ async def handle_voice_message(message: Message, state: FSMContext):
 
         # ✅ НОВОЕ: голосовые правки после результата /gen
         if cur == GenStates.final_menu.state:
-            photos = data.get("photos") or []
-            if not photos:
+            plan = plan_result_edit(data, text)
+            if plan is None:
                 await message.answer("❌ Не удалось найти исходные изображения. Нажмите «Начать заново».")
                 return
+            gen_prompt, inputs, updates = plan
 
-            base_prompt = (data.get("base_prompt") or data.get("prompt") or "").strip()
-            edits = list(data.get("edits") or [])
-            edits.append(text)
-            cumulative_prompt = " ".join([base_prompt] + edits).strip()
-            if len(cumulative_prompt) > 4000:
-                cumulative_prompt = cumulative_prompt[:4000]
-
-            file_ids = [p["file_id"] for p in photos]
             wait_msg = await message.answer("⏳ Генерирую...")
 
             await state.set_state(GenStates.generating)
             await state.update_data(
-                prompt=cumulative_prompt,
-                base_prompt=base_prompt,
-                edits=edits,
+                prompt=gen_prompt,
                 mode="edit",
                 wait_msg_id=wait_msg.message_id,
                 gen_started_at=int(time.time()),
+                **updates,
             )
-            await enqueue_generation(user_id, cumulative_prompt, file_ids)
+            await enqueue_generation(user_id, gen_prompt, inputs)
             return
 
         # /create: обычное ожидание промта
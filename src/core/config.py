@@ -136,7 +136,6 @@ class Settings(BaseSettings):
     DB_PASSWORD: str
     DB_NAME: str
     
-    BROADCAST_RPS: int = 10
     BROADCAST_CONCURRENCY: int = 5
     BROADCAST_BATCH: int = 100
 
@@ -147,6 +146,101 @@ class Settings(BaseSettings):
     RATE_LIMIT_PER_MIN: int = 30
     REDIS_PASSWORD: str | None = None
     REDIS_DB_BROADCAST: int = 3 
+    REDIS_POOL_MAX_CONNECTIONS: int = 200  # на один пул в процессе
+    ARQ_ENQUEUE_BATCH_MS: int = 0  # >0: склеивать enqueue_job за N мс в один pipeline
+    
+    # Быстрый ACK вебхука: апдейты обрабатываются фоновыми тасками
+    TG_WEBHOOK_FAST_ACK: bool = False
+    TG_DISPATCH_WORKERS: int = 16
+    TG_DISPATCH_QUEUE_SIZE: int = 1000
+    
+    # Lane-лок на chat_id между gunicorn-воркерами (апдейты одного чата — строго по очереди)
+    TG_CHAT_LANES: bool = True
+    TG_LANE_LOCK_TTL_S: float = 60.0
+    TG_LANE_LOCK_WAIT_S: float = 30.0
+    TG_LANE_LOCK_RETRIES: int = 3  # сколько раз повторить lane/альбом, если лок не взят
+    TG_LANE_RETRY_DELAY_S: float = 2.0
+
+    # Сборка альбомов в Redis: альбом финализируется, если ALBUM_QUIET_MS не было новых фото
+    ALBUM_QUIET_MS: int = 1200
+    ALBUM_POLL_MS: int = 200
+
+    # Лимит createTask KIE на весь кластер (token bucket в Redis, отдельно на модель)
+    KIE_RPS_STANDARD: float = 1.5
+    KIE_BURST_STANDARD: int = 2
+    KIE_RPS_PRO: float = 1.5
+    KIE_BURST_PRO: int = 2
+    # AIMD: createTask «в полёте» на кластер и снижение rate по 429 / call frequency / Cloudflare 5xx
+    KIE_AIMD_ENABLED: bool = True
+    KIE_AIMD_MIN_INFLIGHT: int = 1
+    KIE_AIMD_INIT_INFLIGHT: int = 8
+    KIE_AIMD_MAX_INFLIGHT: int = 32
+    KIE_AIMD_MIN_RPS: float = 0.2
+    KIE_AIMD_RPS_STEP: float = 0.05
+    KIE_AIMD_COOLDOWN_MS: int = 2000
+    # HTTP-клиент KIE (один на arq-воркер)
+    KIE_HTTP2: bool = True
+    KIE_HTTP_MAX_CONNECTIONS: int = 50
+    KIE_HTTP_MAX_KEEPALIVE: int = 20
+    KIE_HTTP_KEEPALIVE_EXPIRY_S: float = 60.0
+    # Сколько фото одного задания качаем из Telegram параллельно
+    TG_INGEST_CONCURRENCY: int = 4
+    # Предзагрузка фото сразу после приёма (пока пользователь пишет промт)
+    PREINGEST_ENABLED: bool = True
+    PREINGEST_WAIT_S: float = 10.0
+    # Входные фото в /app/temp_inputs живут столько после последнего использования
+    INPUT_STORE_TTL_S: int = 6 * 3600
+    # Правка в final_menu применяется к прошлому результату (его URL — вход), а не к исходным фото
+    EDIT_FROM_RESULT: bool = True
+    # Процессы для кодирования превью (PIL) в arq-воркере
+    IMAGE_POOL_WORKERS: int = 2
+    # Максимальный размер результата KIE при скачивании
+    RESULT_MAX_BYTES: int = 100 * 1024 * 1024
+    # Контекст задачи в Redis (task:ctx:*) для доставки без чтения БД
+    TASK_CTX_TTL_S: int = 48 * 3600
+    # Резерв кредитов без колбэка KIE возвращается через столько секунд
+    CREDIT_HOLD_TTL_S: int = 3600
+    # Reconciler задач без колбэка KIE (опрос recordInfo)
+    RECONCILE_AFTER_S: int = 120
+    RECONCILE_MAX_AGE_S: int = 3300
+    RECONCILE_POLL_MIN_S: int = 30
+    RECONCILE_POLL_MAX_S: int = 300
+    RECONCILE_CONCURRENCY: int = 8
+    RECONCILE_BATCH: int = 200
+    # Outbox доставки: повтор отправки результата с backoff
+    DELIVERY_MAX_ATTEMPTS: int = 8
+    DELIVERY_RETRY_BASE_S: int = 15
+    DELIVERY_RETRY_MAX_S: int = 600
+    DELIVERY_OUTBOX_GRACE_S: int = 300
+    DELIVERY_OUTBOX_MAX_AGE_S: int = 12 * 3600
+    # Планировщик исходящих запросов к Telegram (общий для web и воркеров)
+    TG_OUTBOUND_ENABLED: bool = True
+    TG_GLOBAL_RPS: float = 30.0
+    TG_GLOBAL_BURST: int = 30
+    TG_CHAT_RPS: float = 1.0
+    TG_CHAT_BURST: int = 3
+    TG_GROUP_RPS: float = 0.33
+    TG_OUTBOUND_MAX_WAIT_S: float = 30.0
+    # Доставка результата по URL: Telegram сам забирает картинку KIE (sendPhoto(url)),
+    # если HEAD показал JPEG/PNG не больше лимита Telegram для фото по URL
+    RESULT_URL_DELIVERY: bool = True
+    RESULT_URL_PHOTO_MAX_BYTES: int = 5 * 1024 * 1024
+    RESULT_HEAD_TIMEOUT_S: float = 3.0
+    # Интерактивные arq-воркеры (services.queue.WorkerSettings)
+    ARQ_WORKER_MAX_JOBS: int = 10
+    ARQ_WORKERS: int = 1  # сколько процессов WorkerSettings запущено
+    # Планировщик генераций (services.gen_scheduler): слоты process_generation на все воркеры.
+    # Слот держится весь process_generation (preingest, входы, createTask), поэтому
+    # по умолчанию слотов столько же, сколько job-слотов у воркеров (GEN_SCHED_SLOTS)
+    GEN_SCHED_ENABLED: bool = True
+    GEN_SCHED_MAX_INFLIGHT: int = 0  # 0 — ARQ_WORKER_MAX_JOBS × ARQ_WORKERS
+    GEN_SCHED_PRO_MAX_INFLIGHT: int = 0  # 0 — половина GEN_SCHED_SLOTS
+    GEN_SCHED_USER_MAX_INFLIGHT: int = 2
+    GEN_SCHED_PAID_USER_MAX_INFLIGHT: int = 4
+    GEN_SCHED_WEIGHT_INTERACTIVE: float = 1.0
+    GEN_SCHED_WEIGHT_PRO: float = 1.0
+    GEN_SCHED_PAID_WEIGHT: float = 2.0
+    GEN_SCHED_SLOT_TTL_S: int = 900
     
     MAX_TASK_WAIT_S: int = 150
     ARQ_JOB_TIMEOUT_OFFSET_S: int = 60
@@ -156,6 +250,11 @@ class Settings(BaseSettings):
     def ARQ_JOB_TIMEOUT_S(self) -> int:
         return max(self.MAX_TASK_WAIT_S + self.ARQ_JOB_TIMEOUT_OFFSET_S, 360)
     
+    @computed_field
+    @property
+    def GEN_SCHED_SLOTS(self) -> int:
+        return self.GEN_SCHED_MAX_INFLIGHT or max(1, self.ARQ_WORKER_MAX_JOBS * self.ARQ_WORKERS)
+
     @computed_field
     @property
     def DB_DSN(self) -> str:
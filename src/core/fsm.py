@@ -0,0 +1,49 @@
+"""
+FSM вне хендлеров (вебхуки, arq-воркер) без лишних запросов.
+
+bot_id берётся из токена (часть до «:»), а не из bot.get_me() — это
+одно HTTP-обращение к Telegram на каждую доставку/ошибку. RedisStorage
+один на процесс, поверх общего пула POOL_FSM (не закрывать).
+"""
+from __future__ import annotations
+
+from typing import Optional
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
+
+from core.config import settings
+from core.redis_pools import POOL_FSM, get_redis
+
+_bot_id: Optional[int] = None
+_storage: Optional[RedisStorage] = None
+
+
+def bot_id_from_token(token: str) -> int:
+    head, sep, _ = token.partition(":")
+    if not sep or not head.isdigit():
+        raise ValueError("malformed bot token")
+    return int(head)
+
+
+def get_bot_id() -> int:
+    """id бота, вычисленный один раз на процесс"""
+    global _bot_id
+    if _bot_id is None:
+        _bot_id = bot_id_from_token(settings.TELEGRAM_BOT_TOKEN)
+    return _bot_id
+
+
+def fsm_storage() -> RedisStorage:
+    """Общий RedisStorage процесса (тот же, что у Dispatcher в web)"""
+    global _storage
+    if _storage is None:
+        _storage = RedisStorage(redis=get_redis(POOL_FSM), key_builder=DefaultKeyBuilder(with_bot_id=True))
+    return _storage
+
+
+def external_fsm(chat_id: int, user_id: Optional[int] = None) -> FSMContext:
+    """FSMContext чата вне апдейта; для личных чатов user_id == chat_id"""
+    key = StorageKey(bot_id=get_bot_id(), chat_id=chat_id, user_id=user_id if user_id is not None else chat_id)
+    return FSMContext(storage=fsm_storage(), key=key)
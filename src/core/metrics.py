@@ -0,0 +1,142 @@
+"""
+Простые in-process метрики (счётчики, гауги, гистограммы).
+
+Без внешних зависимостей: каждый процесс (gunicorn worker / arq worker)
+копит свои значения. arq-воркеры раз в PUBLISH_INTERVAL_S кладут снимок в
+Redis (metrics:proc:{source}, см. publish_loop), /health/metrics отдаёт
+снимок web-процесса, снимки воркеров и их сумму (merge).
+"""
+from __future__ import annotations
+
+import asyncio
+import bisect
+import json
+import os
+import socket
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+# Границы бакетов в секундах — от быстрых Redis-операций до долгих загрузок
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PUBLISH_KEY = "metrics:proc:"
+PUBLISH_INTERVAL_S = 15.0
+# Снимок умершего процесса пропадает сам
+_PUBLISH_TTL_S = 120
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum", "max")
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self) -> Dict[str, Any]:
+        cumulative = 0
+        buckets: Dict[str, int] = {}
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            buckets[f"le_{bound}"] = cumulative
+        buckets["le_inf"] = self.count
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 4),
+            "avg": round(self.sum / self.count, 4) if self.count else 0.0,
+            "max": round(self.max, 4),
+            "buckets": buckets,
+        }
+
+
+_counters: Dict[str, float] = defaultdict(float)
+_gauges: Dict[str, float] = {}
+_histograms: Dict[str, Histogram] = {}
+
+
+def inc(name: str, value: float = 1.0) -> None:
+    _counters[name] += value
+
+
+def set_gauge(name: str, value: float) -> None:
+    _gauges[name] = value
+
+
+def observe(name: str, value: float) -> None:
+    h = _histograms.get(name)
+    if h is None:
+        h = _histograms[name] = Histogram()
+    h.observe(value)
+
+
+def snapshot() -> Dict[str, Any]:
+    return {
+        "counters": dict(_counters),
+        "gauges": dict(_gauges),
+        "histograms": {name: h.snapshot() for name, h in _histograms.items()},
+    }
+
+
+def process_source(role: str) -> str:
+    return f"{role}:{socket.gethostname()}:{os.getpid()}"
+
+
+async def publish(redis, source: str) -> None:
+    """Снимок процесса в Redis (для /health/metrics в web)"""
+    await redis.set(f"{PUBLISH_KEY}{source}", json.dumps(snapshot()), ex=_PUBLISH_TTL_S)
+
+
+async def publish_loop(redis, source: str) -> None:
+    """Фоновая задача arq-воркера: publish раз в PUBLISH_INTERVAL_S до отмены"""
+    while True:
+        try:
+            await publish(redis, source)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        await asyncio.sleep(PUBLISH_INTERVAL_S)
+
+
+async def load_published(redis) -> Dict[str, Dict[str, Any]]:
+    """Снимки всех живых процессов: {source: snapshot}"""
+    out: Dict[str, Dict[str, Any]] = {}
+    async for key in redis.scan_iter(match=f"{PUBLISH_KEY}*", count=100):
+        raw = await redis.get(key)
+        if raw is None:
+            continue
+        name = key.decode() if isinstance(key, bytes) else key
+        out[name[len(PUBLISH_KEY):]] = json.loads(raw)
+    return out
+
+
+def merge(snapshots: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Сумма снимков: счётчики и гистограммы складываются, гауги — последнее значение"""
+    counters: Dict[str, float] = defaultdict(float)
+    gauges: Dict[str, float] = {}
+    histograms: Dict[str, Dict[str, Any]] = {}
+    for snap in snapshots:
+        for name, v in snap.get("counters", {}).items():
+            counters[name] += v
+        gauges.update(snap.get("gauges", {}))
+        for name, h in snap.get("histograms", {}).items():
+            acc = histograms.get(name)
+            if acc is None:
+                histograms[name] = {**h, "buckets": dict(h.get("buckets", {}))}
+                continue
+            acc["count"] += h["count"]
+            acc["sum"] = round(acc["sum"] + h["sum"], 4)
+            acc["max"] = max(acc["max"], h["max"])
+            acc["avg"] = round(acc["sum"] / acc["count"], 4) if acc["count"] else 0.0
+            for b, n in h.get("buckets", {}).items():
+                acc["buckets"][b] = acc["buckets"].get(b, 0) + n
+    return {"counters": dict(counters), "gauges": gauges, "histograms": histograms}
@@ -0,0 +1,100 @@
+"""
+Общий реестр пулов Redis на процесс (web и arq worker).
+
+Вместо aioredis.Redis(...) + aclose() на каждый вызов модули берут клиента
+из именованного пула: get_redis(POOL_FSM) / get_redis(POOL_CACHE) / ...
+Пулы создаются лениво, прогреваются в startup и закрываются в shutdown.
+"""
+from __future__ import annotations
+
+import logging
+from typing import Dict
+
+import redis.asyncio as aioredis
+from redis.asyncio.connection import ConnectionPool
+
+from core.config import settings
+
+log = logging.getLogger("redis_pools")
+
+POOL_FSM = "fsm"
+POOL_CACHE = "cache"
+POOL_BROADCAST = "broadcast"
+
+_DBS: Dict[str, int] = {
+    POOL_FSM: settings.REDIS_DB_FSM,
+    POOL_CACHE: settings.REDIS_DB_CACHE,
+    POOL_BROADCAST: settings.REDIS_DB_BROADCAST,
+}
+
+_pools: Dict[str, ConnectionPool] = {}
+_clients: Dict[str, aioredis.Redis] = {}
+
+
+def _make_pool(name: str) -> ConnectionPool:
+    return ConnectionPool(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=_DBS[name],
+        password=settings.REDIS_PASSWORD,
+        max_connections=settings.REDIS_POOL_MAX_CONNECTIONS,
+        socket_keepalive=True,
+        health_check_interval=30,
+        decode_responses=False,
+    )
+
+
+def get_redis(name: str = POOL_CACHE) -> aioredis.Redis:
+    """
+    Клиент поверх общего пула. НЕ закрывать после использования —
+    соединение вернётся в пул само.
+    """
+    client = _clients.get(name)
+    if client is None:
+        if name not in _DBS:
+            raise KeyError(f"unknown redis pool: {name}")
+        pool = _make_pool(name)
+        _pools[name] = pool
+        client = aioredis.Redis(connection_pool=pool)
+        _clients[name] = client
+    return client
+
+
+async def init_redis_pools() -> None:
+    """Прогрев пулов на старте процесса (по одному соединению в каждом)"""
+    for name in _DBS:
+        try:
+            await get_redis(name).ping()
+        except Exception as e:
+            log.warning(f"Redis pool '{name}' warmup failed: {e}")
+
+
+async def close_redis_pools() -> None:
+    """Закрытие всех пулов на shutdown"""
+    for name, client in list(_clients.items()):
+        try:
+            await client.aclose()
+        except Exception:
+            pass
+        pool = _pools.get(name)
+        if pool is not None:
+            try:
+                await pool.disconnect()
+            except Exception:
+                pass
+    _clients.clear()
+    _pools.clear()
+
+
+def redis_pool_stats() -> Dict[str, Dict[str, int]]:
+    """Гауги насыщения пулов: создано соединений / занято / лимит"""
+    stats: Dict[str, Dict[str, int]] = {}
+    for name, pool in _pools.items():
+        in_use = len(getattr(pool, "_in_use_connections", ()))
+        available = len(getattr(pool, "_available_connections", ()))
+        stats[name] = {
+            "size": in_use + available,
+            "in_use": in_use,
+            "max": pool.max_connections,
+        }
+    return stats
@@ -11,7 +11,8 @@ import html  # ✅ ДОБАВЛЕНО
 import redis.asyncio as aioredis
 from aiogram import Bot
 
-from core.config import settings
+from core.redis_pools import POOL_CACHE, get_redis
+from core.tg_outbound import PRIORITY_ADMIN, tg_priority
 
 
 class TelegramLogHandler(logging.Handler):
@@ -26,13 +27,9 @@ class TelegramLogHandler(logging.Handler):
         self._loop: Optional[asyncio.AbstractEventLoop] = None
     
     async def _get_redis(self) -> aioredis.Redis:
-        """Ленивая инициализация Redis"""
+        """Redis из общего пула процесса"""
         if self._redis is None:
-            self._redis = aioredis.Redis(
-                host=settings.REDIS_HOST,
-                port=settings.REDIS_PORT,
-                db=settings.REDIS_DB_CACHE
-            )
+            self._redis = get_redis(POOL_CACHE)
         return self._redis
     
     def _format_error(self, record: logging.LogRecord) -> str:
@@ -104,7 +101,8 @@ class TelegramLogHandler(logging.Handler):
             try:
                 loop = asyncio.get_running_loop()
             except RuntimeError:
-                asyncio.run(self._async_emit(record))
+                # Вне event loop общий пул не трогаем (соединения привязаны к loop)
+                asyncio.run(self._async_emit(record, dedupe=False))
                 return
             
             loop.create_task(self._async_emit(record))
@@ -112,26 +110,26 @@ class TelegramLogHandler(logging.Handler):
         except Exception as e:
             print(f"TelegramLogHandler error: {e}")
     
-    async def _async_emit(self, record: logging.LogRecord):
+    async def _async_emit(self, record: logging.LogRecord, dedupe: bool = True):
         """Асинхронная отправка"""
         try:
             error_hash = self._get_error_hash(record)
             
-            if not await self._should_send(error_hash):
+            if dedupe and not await self._should_send(error_hash):
                 return
             
             message = self._format_error(record)
             
-            await self.bot.send_message(
-                self.admin_id,
-                message,
-                parse_mode="HTML"
-            )
+            with tg_priority(PRIORITY_ADMIN):
+                await self.bot.send_message(
+                    self.admin_id,
+                    message,
+                    parse_mode="HTML"
+                )
         
         except Exception as e:
             print(f"Failed to send log to Telegram: {e}")
     
     async def close_async(self):
-        """Закрытие Redis соединения"""
-        if self._redis:
-            await self._redis.aclose()
\ No newline at end of file
+        """Пул общий — закрывается в close_redis_pools(), здесь только отпускаем ссылку"""
+        self._redis = None
\ No newline at end of file
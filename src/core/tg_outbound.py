@@ -0,0 +1,250 @@
+"""
+Единый планировщик исходящих запросов к Telegram Bot API.
+
+Подключается middleware'ом к сессии бота (install_outbound_scheduler), поэтому
+через него идут все send*/edit*/copy*/forward* — из safe_send_*, хендлеров,
+воркера, рассылки и TelegramLogHandler — во всех процессах (web и arq).
+
+Состояние в Redis, одно Lua-обращение на попытку:
+  • tg:out:global      — token bucket на весь бот (TG_GLOBAL_RPS, ~30 msg/s);
+  • tg:out:chat:{id}   — bucket чата (1 msg/s в личке, ~20/мин в группах);
+  • tg:out:pause       — пауза всего бота после RetryAfter без chat_id;
+  • tg:out:pause:low   — пауза рассылки/админ-логов после любого RetryAfter;
+  • tg:out:pause:{id}  — пауза чата на retry_after.
+
+Классы приоритета (contextvar, см. tg_priority): результаты > ответы UI >
+рассылка > админ-логи. Низкие классы берут токен, только если в глобальном
+bucket'е остаётся резерв, так что рассылка не может выбрать лимит у доставки
+результатов. Если Redis недоступен — запрос уходит без ограничений.
+
+RetryAfter обрабатывает только этот middleware (пауза + до _MAX_RETRY_AFTER
+повторов); safe_send_* его больше не ждут. Если ждать токена дольше
+TG_OUTBOUND_MAX_WAIT_S, запрос не отправляется — вызывающий получает
+TelegramRetryAfter с оставшимся временем.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Any, Iterator, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+from core import metrics
+from core.config import settings
+from core.redis_pools import POOL_CACHE, get_redis
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+
+log = logging.getLogger("tg_outbound")
+
+PRIORITY_RESULT = "result"
+PRIORITY_UI = "ui"
+PRIORITY_BROADCAST = "broadcast"
+PRIORITY_ADMIN = "admin"
+
+# Доля глобального burst, которую класс обязан оставить более важным
+_RESERVE = {
+    PRIORITY_RESULT: 0.0,
+    PRIORITY_UI: 0.1,
+    PRIORITY_BROADCAST: 0.5,
+    PRIORITY_ADMIN: 0.6,
+}
+_LOW = (PRIORITY_BROADCAST, PRIORITY_ADMIN)
+_LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+_MAX_RETRY_AFTER = 2
+_TTL_MS = 60_000
+
+_priority: ContextVar[str] = ContextVar("tg_priority", default=PRIORITY_UI)
+
+# KEYS: global, chat, pause, pause_low, pause_chat
+# ARGV: g_rate, g_burst, reserve, c_rate (0 = без lane), c_burst, is_low, ttl_ms
+# Возвращает 0 (можно отправлять) или сколько мс ждать
+_ACQUIRE_LUA = """
+local t = redis.call('time')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+
+local function paused(key)
+    local p = tonumber(redis.call('get', key) or '0')
+    if p > now then return p - now end
+    return 0
+end
+
+local function refill(key, rate, burst)
+    local st = redis.call('hmget', key, 'tokens', 'ts')
+    local tokens = tonumber(st[1]) or burst
+    local ts = tonumber(st[2]) or now
+    return math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+end
+
+local w = paused(KEYS[3])
+if w > 0 then return w end
+if ARGV[6] == '1' then
+    w = paused(KEYS[4])
+    if w > 0 then return w end
+end
+
+local c_rate, c_burst = tonumber(ARGV[4]), tonumber(ARGV[5])
+local c_tokens = 0
+if c_rate > 0 then
+    w = paused(KEYS[5])
+    if w > 0 then return w end
+    c_tokens = refill(KEYS[2], c_rate, c_burst)
+    if c_tokens < 1 then
+        return math.max(1, math.ceil((1 - c_tokens) * 1000 / c_rate))
+    end
+end
+
+local g_rate, g_burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local need = 1 + tonumber(ARGV[3])
+local g_tokens = refill(KEYS[1], g_rate, g_burst)
+if g_tokens < need then
+    redis.call('hset', KEYS[1], 'tokens', tostring(g_tokens), 'ts', now)
+    redis.call('pexpire', KEYS[1], ARGV[7])
+    return math.max(1, math.ceil((need - g_tokens) * 1000 / g_rate))
+end
+
+redis.call('hset', KEYS[1], 'tokens', tostring(g_tokens - 1), 'ts', now)
+redis.call('pexpire', KEYS[1], ARGV[7])
+if c_rate > 0 then
+    redis.call('hset', KEYS[2], 'tokens', tostring(c_tokens - 1), 'ts', now)
+    redis.call('pexpire', KEYS[2], ARGV[7])
+end
+return 0
+"""
+
+
+def _j(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+@contextmanager
+def tg_priority(priority: str) -> Iterator[None]:
+    """with tg_priority(PRIORITY_RESULT): ... — класс для всех запросов внутри блока"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def set_tg_priority(priority: str) -> None:
+    """Класс для всей текущей asyncio-задачи (в начале arq job)"""
+    _priority.set(priority)
+
+
+def _chat_limits(chat_id: Optional[int]) -> tuple:
+    if chat_id is None:
+        return 0.0, 0
+    if chat_id < 0:
+        return settings.TG_GROUP_RPS, 1
+    return settings.TG_CHAT_RPS, settings.TG_CHAT_BURST
+
+
+async def _acquire(chat_id: Optional[int], priority: str) -> int:
+    """0 — токен получен (или Redis недоступен); иначе сколько ещё мс ждать после таймаута"""
+    c_rate, c_burst = _chat_limits(chat_id)
+    reserve = settings.TG_GLOBAL_BURST * _RESERVE.get(priority, 0.0)
+    chat = chat_id if chat_id is not None else 0
+    keys = (
+        "tg:out:global",
+        f"tg:out:chat:{chat}",
+        "tg:out:pause",
+        "tg:out:pause:low",
+        f"tg:out:pause:{chat}",
+    )
+    max_wait = settings.TG_OUTBOUND_MAX_WAIT_S * (10 if priority in _LOW else 1)
+    r = get_redis(POOL_CACHE)
+    started = time.monotonic()
+    while True:
+        try:
+            wait_ms = int(await r.eval(
+                _ACQUIRE_LUA, len(keys), *keys,
+                settings.TG_GLOBAL_RPS, settings.TG_GLOBAL_BURST, reserve,
+                c_rate, c_burst, 1 if priority in _LOW else 0, _TTL_MS,
+            ))
+        except Exception as e:
+            log.warning(_j("tg_outbound.redis_error", error=str(e)[:100]))
+            wait_ms = 0
+            break
+        if wait_ms <= 0:
+            break
+        if time.monotonic() - started + wait_ms / 1000 > max_wait:
+            metrics.inc(f"tg_out.wait_timeout.{priority}")
+            break
+        await asyncio.sleep(min(wait_ms, 1000) / 1000)
+    metrics.observe(f"tg_out.wait_s.{priority}", time.monotonic() - started)
+    return max(0, wait_ms)
+
+
+async def _pause(chat_id: Optional[int], retry_after: float) -> None:
+    ms = max(1000, int(retry_after * 1000))
+    until = int(time.time() * 1000) + ms
+    try:
+        async with get_redis(POOL_CACHE).pipeline(transaction=False) as pipe:
+            pipe.set("tg:out:pause:low", until, px=ms)
+            pipe.set(f"tg:out:pause:{chat_id}" if chat_id is not None else "tg:out:pause", until, px=ms)
+            await pipe.execute()
+    except Exception:
+        pass
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: "Bot",
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        name = getattr(method, "__api_method__", "") or ""
+        if not settings.TG_OUTBOUND_ENABLED or not name.startswith(_LIMITED_PREFIXES):
+            return await make_request(bot, method)
+
+        raw_chat = getattr(method, "chat_id", None)
+        chat_id = raw_chat if isinstance(raw_chat, int) else None
+        # per-chat лимит — только на новые сообщения, правки его не расходуют
+        lane_chat = chat_id if not name.startswith("edit") else None
+        priority = _priority.get()
+
+        for attempt in range(_MAX_RETRY_AFTER + 1):
+            left_ms = await _acquire(lane_chat, priority)
+            if left_ms:
+                # Пауза/лимит длиннее допустимого ожидания — не отправляем вопреки flood-wait
+                raise TelegramRetryAfter(
+                    method=method,
+                    message="outbound scheduler: wait limit exceeded",
+                    retry_after=max(1, left_ms // 1000),
+                )
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                metrics.inc(f"tg_out.retry_after.{priority}")
+                log.warning(_j(
+                    "tg_outbound.retry_after",
+                    method=name,
+                    chat_id=chat_id,
+                    priority=priority,
+                    retry_after=e.retry_after,
+                    attempt=attempt + 1,
+                ))
+                await _pause(chat_id, e.retry_after)
+                if attempt >= _MAX_RETRY_AFTER:
+                    raise
+        raise RuntimeError("unreachable")
+
+
+def install_outbound_scheduler(bot: "Bot") -> None:
+    """Подключить планировщик к сессии бота (боты с общей сессией — один раз)"""
+    session: Any = bot.session
+    if getattr(session, "_outbound_scheduler", False):
+        return
+    session.middleware(OutboundScheduler())
+    session._outbound_scheduler = True
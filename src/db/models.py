@@ -1,7 +1,7 @@
 from datetime import datetime
 from typing import Optional
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import String, BigInteger, Integer, ForeignKey, DateTime, Numeric, Text, Boolean,func
+from sqlalchemy import String, BigInteger, Integer, ForeignKey, DateTime, Numeric, Text, Boolean, JSON, func
 
 class Base(DeclarativeBase): ...
 
@@ -31,6 +31,19 @@ class Payment(Base):
     receipt_email: Mapped[Optional[str]] = mapped_column(String(255))
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+class CreditLedger(Base):
+    __tablename__ = "credit_ledger"
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
+    direction: Mapped[str] = mapped_column(String(8))             # in | out
+    source: Mapped[str] = mapped_column(String(16))               # payment | generation | admin | refund
+    amount_credits: Mapped[int] = mapped_column(Integer)
+    balance_after: Mapped[int] = mapped_column(Integer)
+    ref_type: Mapped[str] = mapped_column(String(16), default="manual")  # payment | task | manual
+    ref_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    note: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+
 class Task(Base):
     __tablename__ = "tasks"
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
@@ -40,6 +53,7 @@ class Task(Base):
     status: Mapped[str] = mapped_column(String(32), default="queued")
     credits_used: Mapped[int] = mapped_column(Integer, default=0)
     result_text: Mapped[Optional[str]] = mapped_column(Text)
+    result_image_urls: Mapped[Optional[list]] = mapped_column(JSON, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     delivered: Mapped[bool] = mapped_column(Boolean, default=False, index=True)
 
@@ -0,0 +1,159 @@
+"""
+Сборщик альбомов (media_group) поверх Redis, общий для всех воркеров.
+
+Части альбома прилетают в разные gunicorn-воркеры, поэтому in-process
+debounce (asyncio.sleep на чат) финализировал альбом несколько раз.
+Здесь:
+  • append_album_item() — атомарно дописывает фото в album:{mgid}:items
+    и сдвигает дедлайн альбома в sorted set album:timers (таймер-колесо);
+  • AlbumAggregator — один опросчик на процесс; альбом, «затихший» на
+    ALBUM_QUIET_MS, забирается Lua-скриптом целиком (ZREM + LRANGE + DEL),
+    поэтому финализатор срабатывает ровно один раз во всём кластере.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Set
+
+from core import metrics
+from core.config import settings
+from core.redis_pools import POOL_CACHE, get_redis
+from services.chat_lanes import LaneBusy
+
+log = logging.getLogger("album_aggregator")
+
+ALBUM_PREFIX = "album:"
+ALBUM_TIMERS_KEY = "album:timers"
+ALBUM_MAX_ITEMS = 4
+ALBUM_TTL_S = 600
+
+# KEYS: items, meta, timers; ARGV: item, chat_id, user_id, quiet_ms, ttl_s, mgid, max_items
+_APPEND_LUA = """
+local n = redis.call('llen', KEYS[1])
+if n < tonumber(ARGV[7]) then
+    redis.call('rpush', KEYS[1], ARGV[1])
+    n = n + 1
+end
+redis.call('hset', KEYS[2], 'chat_id', ARGV[2], 'user_id', ARGV[3])
+redis.call('expire', KEYS[1], ARGV[5])
+redis.call('expire', KEYS[2], ARGV[5])
+local t = redis.call('time')
+local now_ms = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+redis.call('zadd', KEYS[3], now_ms + tonumber(ARGV[4]), ARGV[6])
+return n
+"""
+
+# KEYS: timers; ARGV: limit, prefix
+_CLAIM_LUA = """
+local t = redis.call('time')
+local now_ms = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local ids = redis.call('zrangebyscore', KEYS[1], '-inf', now_ms, 'LIMIT', 0, tonumber(ARGV[1]))
+local out = {}
+for _, id in ipairs(ids) do
+    redis.call('zrem', KEYS[1], id)
+    local ik = ARGV[2] .. id .. ':items'
+    local mk = ARGV[2] .. id .. ':meta'
+    local items = redis.call('lrange', ik, 0, -1)
+    local meta = redis.call('hmget', mk, 'chat_id', 'user_id')
+    redis.call('del', ik, mk)
+    table.insert(out, {id, meta[1] or '', meta[2] or '', items})
+end
+return out
+"""
+
+AlbumCallback = Callable[[str, int, int, List[Dict[str, str]]], Awaitable[Any]]
+
+
+def _j(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+def _s(v: Any) -> str:
+    return v.decode() if isinstance(v, bytes) else str(v)
+
+
+async def append_album_item(media_group_id: str, chat_id: int, user_id: int, item: Dict[str, str]) -> int:
+    """Добавить часть альбома; возвращает текущее число фото (максимум ALBUM_MAX_ITEMS)"""
+    r = get_redis(POOL_CACHE)
+    n = await r.eval(
+        _APPEND_LUA, 3,
+        f"{ALBUM_PREFIX}{media_group_id}:items",
+        f"{ALBUM_PREFIX}{media_group_id}:meta",
+        ALBUM_TIMERS_KEY,
+        json.dumps(item, ensure_ascii=False),
+        chat_id,
+        user_id,
+        settings.ALBUM_QUIET_MS,
+        ALBUM_TTL_S,
+        media_group_id,
+        ALBUM_MAX_ITEMS,
+    )
+    metrics.inc("album.parts")
+    return int(n)
+
+
+class AlbumAggregator:
+    """Опросчик таймер-колеса: забирает затихшие альбомы и вызывает on_album"""
+
+    def __init__(self, on_album: AlbumCallback, *, poll_ms: int, batch: int = 50):
+        self.on_album = on_album
+        self.poll_s = max(0.05, poll_ms / 1000.0)
+        self.batch = batch
+        self._task: asyncio.Task | None = None
+        self._inflight: Set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def _run(self) -> None:
+        r = get_redis(POOL_CACHE)
+        while True:
+            try:
+                claimed = await r.eval(_CLAIM_LUA, 1, ALBUM_TIMERS_KEY, self.batch, ALBUM_PREFIX)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(_j("album.claim_failed", error=str(e)[:200]))
+                claimed = []
+
+            for mgid, chat_id, user_id, raw_items in claimed or []:
+                mgid, chat_id, user_id = _s(mgid), _s(chat_id), _s(user_id)
+                if not chat_id:
+                    continue
+                items = [json.loads(_s(x)) for x in raw_items]
+                metrics.inc("album.finalized")
+                task = asyncio.create_task(self._dispatch(mgid, int(chat_id), int(user_id or chat_id), items))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+
+            await asyncio.sleep(self.poll_s)
+
+    async def _dispatch(self, mgid: str, chat_id: int, user_id: int, items: List[Dict[str, str]]) -> None:
+        # Альбом уже забран из Redis — при занятом lane-локе повторяем здесь же
+        for attempt in range(settings.TG_LANE_LOCK_RETRIES + 1):
+            try:
+                await self.on_album(mgid, chat_id, user_id, items)
+                return
+            except LaneBusy:
+                if attempt < settings.TG_LANE_LOCK_RETRIES:
+                    metrics.inc("album.lane_retry")
+                    await asyncio.sleep(settings.TG_LANE_RETRY_DELAY_S * (attempt + 1))
+            except Exception:
+                log.exception(_j("album.finalize_failed", media_group_id=mgid, chat_id=chat_id))
+                return
+        metrics.inc("album.lane_dropped")
+        log.error(_j("album.lane_dropped", media_group_id=mgid, chat_id=chat_id))
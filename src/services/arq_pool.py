@@ -0,0 +1,186 @@
+"""
+Долгоживущий ArqRedis-клиент процесса для постановки задач в очередь.
+
+Раньше enqueue_generation / broadcast делали create_pool + close на каждый
+вызов (handshake + INFO на горячем пути). Теперь пул создаётся один раз
+в startup веб-приложения, переподключается при обрыве и, опционально,
+склеивает enqueue_job, пришедшие в течение ARQ_ENQUEUE_BATCH_MS, в один pipeline.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from typing import Any, List, Optional, Tuple
+from uuid import uuid4
+
+from arq import create_pool
+from arq.connections import ArqRedis, RedisSettings
+from arq.constants import job_key_prefix
+from arq.jobs import Job, serialize_job
+from arq.utils import timestamp_ms
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
+from core.config import settings
+
+log = logging.getLogger("arq_pool")
+
+ARQ_REDIS_SETTINGS = RedisSettings(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    database=settings.REDIS_DB_CACHE,
+    password=settings.REDIS_PASSWORD,
+)
+
+# Очередь фонового воркера (рассылка, обслуживание) — не делит слоты с генерациями
+BACKGROUND_QUEUE = "arq:queue:background"
+
+
+def _j(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+_Pending = Tuple[str, tuple, dict, "asyncio.Future[Optional[Job]]"]
+
+
+class ArqClient:
+    """
+    Обёртка над ArqRedis с ленивым подключением, reconnect и micro-batching.
+    """
+
+    def __init__(self, redis_settings: RedisSettings = ARQ_REDIS_SETTINGS, batch_window_ms: int = 0):
+        self.redis_settings = redis_settings
+        self.batch_window_s = max(0, batch_window_ms) / 1000.0
+        self._pool: Optional[ArqRedis] = None
+        self._connect_lock = asyncio.Lock()
+        self._pending: List[_Pending] = []
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def _get_pool(self) -> ArqRedis:
+        if self._pool is not None:
+            return self._pool
+        async with self._connect_lock:
+            if self._pool is None:
+                self._pool = await create_pool(self.redis_settings)
+                log.info(_j("arq_pool.connected"))
+        return self._pool
+
+    async def _reset_pool(self) -> None:
+        async with self._connect_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            try:
+                await pool.close()
+            except Exception:
+                pass
+
+    async def start(self) -> None:
+        await self._get_pool()
+
+    async def close(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            try:
+                await self._flush_task
+            except Exception:
+                pass
+        await self._reset_pool()
+
+    async def enqueue_job(self, function: str, *args: Any, **kwargs: Any) -> Optional[Job]:
+        """
+        Ставит задачу в очередь. Параметры arq (_job_id, _defer_by, ...) идут
+        напрямую в ArqRedis.enqueue_job, минуя батчинг.
+        """
+        if self.batch_window_s > 0 and not any(k.startswith("_") for k in kwargs):
+            fut: asyncio.Future[Optional[Job]] = asyncio.get_running_loop().create_future()
+            self._pending.append((function, args, kwargs, fut))
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self._flush_later())
+            return await fut
+
+        for attempt in (1, 2):
+            pool = await self._get_pool()
+            try:
+                return await pool.enqueue_job(function, *args, **kwargs)
+            except (RedisConnectionError, RedisTimeoutError, OSError) as e:
+                log.warning(_j("arq_pool.enqueue_reconnect", function=function, attempt=attempt, error=str(e)[:100]))
+                await self._reset_pool()
+                if attempt == 2:
+                    raise
+        return None
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.batch_window_s)
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            jobs = await self._enqueue_batch(batch)
+        except Exception as e:
+            for *_, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (*_, fut), job in zip(batch, jobs):
+            if not fut.done():
+                fut.set_result(job)
+
+    async def _enqueue_batch(self, batch: List[_Pending]) -> List[Job]:
+        """
+        Один pipeline на пачку: те же psetex + zadd, что делает arq.enqueue_job,
+        но без WATCH — job_id у нас всегда свежий uuid4, проверять дубли незачем.
+        """
+        for attempt in (1, 2):
+            pool = await self._get_pool()
+            try:
+                jobs: List[Job] = []
+                enqueue_time_ms = timestamp_ms()
+                expires_ms = pool.expires_extra_ms
+                async with pool.pipeline(transaction=False) as pipe:
+                    for function, args, kwargs, _ in batch:
+                        job_id = uuid4().hex
+                        payload = serialize_job(
+                            function, args, kwargs, None, enqueue_time_ms, serializer=pool.job_serializer
+                        )
+                        pipe.psetex(job_key_prefix + job_id, expires_ms, payload)
+                        pipe.zadd(pool.default_queue_name, {job_id: enqueue_time_ms})
+                        jobs.append(
+                            Job(job_id, redis=pool, _queue_name=pool.default_queue_name,
+                                _deserializer=pool.job_deserializer)
+                        )
+                    await pipe.execute()
+                if len(batch) > 1:
+                    log.info(_j("arq_pool.batch_enqueued", size=len(batch)))
+                return jobs
+            except (RedisConnectionError, RedisTimeoutError, OSError) as e:
+                log.warning(_j("arq_pool.batch_reconnect", size=len(batch), attempt=attempt, error=str(e)[:100]))
+                await self._reset_pool()
+                if attempt == 2:
+                    raise
+        return []
+
+
+_client: Optional[ArqClient] = None
+
+
+def get_arq_client() -> ArqClient:
+    """Клиент процесса; подключается лениво при первом enqueue"""
+    global _client
+    if _client is None:
+        _client = ArqClient(batch_window_ms=settings.ARQ_ENQUEUE_BATCH_MS)
+    return _client
+
+
+async def init_arq_client() -> ArqClient:
+    client = get_arq_client()
+    try:
+        await client.start()
+    except Exception as e:
+        log.warning(_j("arq_pool.start_failed", error=str(e)[:200]))
+    return client
+
+
+async def close_arq_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
@@ -6,6 +6,7 @@ from __future__ import annotations
 import asyncio
 import shutil
 import subprocess
+from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any
 import logging
@@ -15,7 +16,9 @@ from aiogram import Bot
 from aiogram.types import FSInputFile
 from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter
 
+from core import metrics
 from core.config import settings
+from core.tg_outbound import PRIORITY_BROADCAST, set_tg_priority
 from db.engine import SessionLocal
 from db.models import BroadcastJob, User
 
@@ -27,39 +30,25 @@ async def broadcast_send(ctx: dict[str, Any], job_id: str):
     ✅ ИСПРАВЛЕНО: убрана вложенная транзакция
     """
     bot: Bot = ctx["bot"]
+    # ✅ Рассылка — низший класс в общем планировщике Telegram, результатам не мешает
+    set_tg_priority(PRIORITY_BROADCAST)
+    enqueued: datetime | None = ctx.get("enqueue_time")
+    if enqueued is not None:
+        metrics.observe("queue.wait_s.broadcast", max(0.0, (datetime.now(timezone.utc) - enqueued).total_seconds()))
     
-    base_rps = settings.BROADCAST_RPS
+    # ✅ Темп и паузы после flood-wait задаёт OutboundScheduler (класс PRIORITY_BROADCAST),
+    # здесь только ограничение числа одновременных отправок
     concurrency = settings.BROADCAST_CONCURRENCY
     batch_size = settings.BROADCAST_BATCH
     check_cancel_every = 10
 
     sem = asyncio.Semaphore(concurrency)
-    
-    current_rps = base_rps
-    tokens: asyncio.Queue[None] = asyncio.Queue(maxsize=max(1, int(current_rps * 2)))
-    pump_task = None
-    
-    async def _rate_pump():
-        nonlocal current_rps
-        try:
-            while True:
-                interval = 1.0 / max(1, current_rps)
-                try:
-                    tokens.put_nowait(None)
-                except asyncio.QueueFull:
-                    pass
-                await asyncio.sleep(interval)
-        except asyncio.CancelledError:
-            return
-
-    pump_task = asyncio.create_task(_rate_pump())
 
     async with SessionLocal() as session:
         row = await session.execute(select(BroadcastJob).where(BroadcastJob.id == job_id))
         bj = row.scalars().first()
         
         if not bj or bj.status in ("done", "cancelled"):
-            pump_task.cancel()
             log.info(f"Broadcast {job_id} already finished")
             return
 
@@ -74,19 +63,10 @@ async def broadcast_send(ctx: dict[str, Any], job_id: str):
         sent = 0
         failed = 0
         fallback = 0
-        rate_limited_count = 0
         cancelled = False
 
         async def _send(chat_id: int, text: str, media_type: str | None, 
                media_file_id: str | None, media_file_path: str | None) -> str:
-   
-            nonlocal current_rps, rate_limited_count
-            
-            try:
-                await asyncio.wait_for(tokens.get(), timeout=30)
-            except asyncio.TimeoutError:
-                log.warning(f"Token queue timeout for chat {chat_id} - continuing anyway")
-            
             async with sem:
                 for attempt in range(3):
                     try:
@@ -114,28 +94,16 @@ async def broadcast_send(ctx: dict[str, Any], job_id: str):
                                 request_timeout=15
                             )
                         
-                        if rate_limited_count > 0:
-                            rate_limited_count = max(0, rate_limited_count - 1)
-                        
                         return "success"
                     
                     except TelegramBadRequest as e:
                         error_msg = str(e).lower()
                         
                         if "too many requests" in error_msg or "retry after" in error_msg:
-                            import re
-                            match = re.search(r'retry after (\d+)', error_msg)
-                            wait_time = int(match.group(1)) if match else 10
-                            
-                            rate_limited_count += 1
-                            if rate_limited_count > 3:
-                                current_rps = max(5, current_rps * 0.7)
-                                log.warning(f"🐌 Slowing down: RPS={current_rps:.1f}")
-                            
-                            if attempt < 2:
-                                log.debug(f"⏳ Rate limit for {chat_id}, waiting {wait_time}s")
-                                await asyncio.sleep(wait_time)
-                                continue
+                            # ✅ Flood-wait не ждём под семафором — паузу держит OutboundScheduler
+                            metrics.inc("broadcast.retry_after")
+                            log.warning(f"⏳ Rate limit for {chat_id}, counted as failed")
+                            return "failed"
                         
                         if attempt == 2:
                             log.warning(f"⚠️ BadRequest for {chat_id}: {str(e)[:100]}")
@@ -171,9 +139,9 @@ async def broadcast_send(ctx: dict[str, Any], job_id: str):
                         return "failed"
                     
                     except TelegramRetryAfter as e:
-                        if attempt < 2:
-                            await asyncio.sleep(e.retry_after)
-                            continue
+                        # Планировщик уже отработал паузу/повторы или не дождался токена
+                        metrics.inc("broadcast.retry_after")
+                        log.warning(f"⏳ RetryAfter {e.retry_after}s for {chat_id}, counted as failed")
                         return "failed"
                     
                     except Exception as e:
@@ -273,12 +241,6 @@ async def broadcast_send(ctx: dict[str, Any], job_id: str):
             
             last_chat_id = chat_ids[-1]
 
-        pump_task.cancel()
-        try:
-            await pump_task
-        except asyncio.CancelledError:
-            pass
-        
         final_status = "cancelled" if cancelled else "done"
         final_note = f"{'Cancelled' if cancelled else 'Completed'}. Fallback: {fallback}"
         
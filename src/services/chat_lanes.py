@@ -0,0 +1,137 @@
+"""
+Межпроцессный lane-лок на chat_id.
+
+8 gunicorn-воркеров получают апдейты одного чата параллельно (например,
+части альбома) и гоняются на FSM get_data/update_data. Лок в Redis
+гарантирует, что в каждый момент апдейты одного чата обрабатывает только
+один процесс; разные чаты не блокируют друг друга.
+
+Пока лок держится, фоновая таска продлевает его TTL, поэтому долгий
+хендлер лок не теряет. Если лок взять не удалось (ожидание дольше
+TG_LANE_LOCK_WAIT_S или Redis недоступен), chat_lane() бросает LaneBusy:
+вызывающий код повторяет апдейт позже, а не обрабатывает его без лока.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from contextlib import asynccontextmanager, suppress
+from typing import AsyncIterator, Optional
+from uuid import uuid4
+
+from core import metrics
+from core.config import settings
+from core.redis_pools import POOL_CACHE, get_redis
+
+log = logging.getLogger("chat_lanes")
+
+# Снимаем/продлеваем лок только если он всё ещё наш
+_RELEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+_REFRESH_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def _j(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+class LaneBusy(Exception):
+    """Lane-лок не взят — апдейт нужно повторить позже"""
+
+
+class ChatLaneLock:
+    def __init__(self, chat_id: int, *, ttl_s: float, wait_s: float):
+        self.key = f"lane:chat:{chat_id}"
+        self.token = uuid4().hex
+        self.ttl_ms = int(ttl_s * 1000)
+        self.wait_s = wait_s
+        self.acquired = False
+
+    async def acquire(self) -> None:
+        """
+        ✅ Ждём лок не дольше wait_s. Таймаут или ошибка Redis — LaneBusy:
+        без лока апдейты одного чата снова гоняются на FSM.
+        """
+        r = get_redis(POOL_CACHE)
+        started = time.monotonic()
+        delay = 0.02
+        try:
+            while True:
+                try:
+                    if await r.set(self.key, self.token, nx=True, px=self.ttl_ms):
+                        self.acquired = True
+                        return
+                except Exception as e:
+                    metrics.inc("chat_lanes.redis_error")
+                    log.warning(_j("chat_lanes.redis_error", key=self.key, error=str(e)[:100]))
+                    raise LaneBusy(self.key) from e
+                if time.monotonic() - started >= self.wait_s:
+                    metrics.inc("chat_lanes.wait_timeout")
+                    log.warning(_j("chat_lanes.wait_timeout", key=self.key, wait_s=self.wait_s))
+                    raise LaneBusy(self.key)
+                await asyncio.sleep(delay)
+                delay = min(delay * 1.5, 0.2)
+        finally:
+            metrics.observe("chat_lanes.lock_wait_s", time.monotonic() - started)
+
+    async def refresh(self) -> bool:
+        """Продлить TTL; False — лок уже не наш (истёк и перехвачен)"""
+        if not self.acquired:
+            return False
+        try:
+            return bool(await get_redis(POOL_CACHE).eval(_REFRESH_LUA, 1, self.key, self.token, self.ttl_ms))
+        except Exception as e:
+            # Кратковременный сбой Redis — попробуем на следующем тике, TTL ещё не вышел
+            log.warning(_j("chat_lanes.refresh_failed", key=self.key, error=str(e)[:100]))
+            return True
+
+    async def keepalive(self) -> None:
+        """Продлевать лок каждые ttl/3, пока его держит хендлер"""
+        interval = max(self.ttl_ms / 3000.0, 0.5)
+        while self.acquired:
+            await asyncio.sleep(interval)
+            if not await self.refresh():
+                metrics.inc("chat_lanes.lost")
+                log.warning(_j("chat_lanes.lost", key=self.key))
+                return
+
+    async def release(self) -> None:
+        if not self.acquired:
+            return
+        self.acquired = False
+        try:
+            await get_redis(POOL_CACHE).eval(_RELEASE_LUA, 1, self.key, self.token)
+        except Exception:
+            pass
+
+
+@asynccontextmanager
+async def chat_lane(chat_id: Optional[int]) -> AsyncIterator[Optional[ChatLaneLock]]:
+    """
+    async with chat_lane(chat_id): ... — апдейты одного чата строго по очереди.
+    Бросает LaneBusy, если лок не взят; тело под локом не выполняется.
+    """
+    if chat_id is None or not settings.TG_CHAT_LANES:
+        yield None
+        return
+    lock = ChatLaneLock(chat_id, ttl_s=settings.TG_LANE_LOCK_TTL_S, wait_s=settings.TG_LANE_LOCK_WAIT_S)
+    await lock.acquire()
+    keeper = asyncio.create_task(lock.keepalive())
+    try:
+        yield lock
+    finally:
+        keeper.cancel()
+        with suppress(asyncio.CancelledError):
+            await keeper
+        await lock.release()
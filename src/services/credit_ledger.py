@@ -0,0 +1,230 @@
+"""
+Резервирование кредитов под генерацию через credit_ledger.
+
+  • hold    — при старте задачи: balance_credits -= c (условно, WHERE balance >= c)
+              и строка out/generation с note="hold:{key}";
+  • capture — успешный колбэк: note hold: → capture: (баланс не меняется);
+  • release — ошибка/таймаут: note hold: → release:, баланс += c и строка
+              in/refund. Зависшие hold'ы возвращает cron release_stale_holds
+              пачкой (одна вставка на все строки возврата);
+  • reverse — результат так и не доставлен: capture: → release:, возврат
+              так же, как у release.
+
+Переход hold → capture/release — условный UPDATE по note LIKE 'hold:%',
+поэтому он происходит ровно один раз, даже если колбэк и таймаут пришли
+одновременно. Параллельные генерации не уходят в минус: резерв
+списывается сразу при старте.
+"""
+from __future__ import annotations
+
+import json
+import logging
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence
+
+from sqlalchemy import func, insert, literal_column, select, update
+
+from core import metrics
+from core.config import settings
+from db.engine import SessionLocal
+from db.models import CreditLedger, User
+
+log = logging.getLogger("credit_ledger")
+
+_HOLD = "hold:"
+_CAPTURE = "capture:"
+_SWEEP_BATCH = 500
+
+
+def _j(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+def _renamed(prefix: str, source: str = _HOLD):
+    # 'hold:{key}' -> '{prefix}{key}' (SUBSTRING в MySQL считает с 1)
+    return func.concat(prefix, func.substring(CreditLedger.note, len(source) + 1))
+
+
+async def hold_credits(user_id: int, amount: int, *, key: str) -> Optional[int]:
+    """
+    ✅ Резерв amount кредитов. Возвращает id строки hold или None,
+    если баланса не хватает.
+    """
+    async with SessionLocal() as s:
+        res = await s.execute(
+            update(User)
+            .where(User.id == user_id, User.balance_credits >= amount)
+            .values(balance_credits=User.balance_credits - amount)
+        )
+        if res.rowcount != 1:
+            await s.rollback()
+            metrics.inc("credits.hold_insufficient")
+            return None
+        balance = (await s.execute(select(User.balance_credits).where(User.id == user_id))).scalar_one()
+        entry = CreditLedger(
+            user_id=user_id,
+            direction="out",
+            source="generation",
+            amount_credits=amount,
+            balance_after=balance,
+            ref_type="task",
+            note=f"{_HOLD}{key}",
+        )
+        s.add(entry)
+        await s.flush()
+        hold_id = entry.id
+        await s.commit()
+
+    metrics.inc("credits.hold")
+    log.info(_j("credits.hold", user_id=user_id, amount=amount, hold_id=hold_id, key=key))
+    return hold_id
+
+
+async def attach_hold(session, hold_id: int, task_db_id: int) -> None:
+    """Привязка резерва к tasks.id (без commit — в транзакции вставки задачи)"""
+    await session.execute(update(CreditLedger).where(CreditLedger.id == hold_id).values(ref_id=task_db_id))
+
+
+async def find_task_hold(session, task_db_id: int) -> Optional[int]:
+    """Открытый резерв задачи (для контекста, собранного из MySQL)"""
+    return (await session.execute(
+        select(CreditLedger.id).where(
+            CreditLedger.ref_type == "task",
+            CreditLedger.ref_id == task_db_id,
+            CreditLedger.note.like(f"{_HOLD}%"),
+        )
+    )).scalar_one_or_none()
+
+
+async def capture_hold(session, hold_id: int) -> bool:
+    """
+    ✅ Резерв становится списанием (без commit — вызывающий коммитит вместе
+    со статусом задачи). False — резерва нет или он уже закрыт.
+    """
+    res = await session.execute(
+        update(CreditLedger)
+        .where(CreditLedger.id == hold_id, CreditLedger.note.like(f"{_HOLD}%"))
+        .values(note=_renamed(_CAPTURE))
+    )
+    captured = res.rowcount == 1
+    metrics.inc("credits.capture" if captured else "credits.capture_missed")
+    return captured
+
+
+async def _release_rows(session, rows: Sequence[Any], reason: str, *, source: str = _HOLD) -> int:
+    """Возврат по заблокированным (FOR UPDATE) строкам hold/capture; одна вставка на все refund-строки"""
+    if not rows:
+        return 0
+    await session.execute(
+        update(CreditLedger)
+        .where(CreditLedger.id.in_([r.id for r in rows]))
+        .values(note=_renamed("release:", source))
+    )
+
+    totals: Dict[int, int] = defaultdict(int)
+    for r in rows:
+        totals[r.user_id] += r.amount_credits
+    # Пользователей блокируем в порядке id — без взаимных блокировок с другим sweep
+    for uid in sorted(totals):
+        await session.execute(
+            update(User).where(User.id == uid).values(balance_credits=User.balance_credits + totals[uid])
+        )
+    balances = dict((await session.execute(
+        select(User.id, User.balance_credits).where(User.id.in_(list(totals)))
+    )).all())
+
+    running = {uid: balances.get(uid, 0) - total for uid, total in totals.items()}
+    entries: List[Dict[str, Any]] = []
+    for r in rows:
+        running[r.user_id] += r.amount_credits
+        entries.append({
+            "user_id": r.user_id,
+            "direction": "in",
+            "source": "refund",
+            "amount_credits": r.amount_credits,
+            "balance_after": running[r.user_id],
+            "ref_type": "task",
+            "ref_id": r.ref_id,
+            "note": f"release:{r.id}:{reason}"[:255],
+        })
+    await session.execute(insert(CreditLedger), entries)
+    return len(rows)
+
+
+def _hold_rows(source: str = _HOLD):
+    return select(
+        CreditLedger.id,
+        CreditLedger.user_id,
+        CreditLedger.amount_credits,
+        CreditLedger.ref_id,
+    ).where(CreditLedger.note.like(f"{source}%"))
+
+
+async def release_hold(hold_id: int, *, reason: str) -> bool:
+    """
+    ✅ Возврат резерва (ошибка генерации). Идемпотентно: закрытый
+    резерв (capture/release) не трогается.
+    """
+    try:
+        async with SessionLocal() as s:
+            rows = (await s.execute(_hold_rows().where(CreditLedger.id == hold_id).with_for_update())).all()
+            released = await _release_rows(s, rows, reason)
+            await s.commit()
+    except Exception as e:
+        log.error(_j("credits.release_failed", hold_id=hold_id, reason=reason, error=str(e)[:200]))
+        return False
+
+    if released:
+        metrics.inc("credits.release")
+        log.info(_j("credits.release", hold_id=hold_id, reason=reason))
+    return bool(released)
+
+
+async def reverse_capture(hold_id: int, *, reason: str) -> bool:
+    """
+    ✅ Возврат уже списанного резерва (результат не доставлен после всех
+    попыток). Идемпотентно: capture: → release: происходит один раз.
+    """
+    try:
+        async with SessionLocal() as s:
+            rows = (await s.execute(
+                _hold_rows(_CAPTURE).where(CreditLedger.id == hold_id).with_for_update()
+            )).all()
+            reversed_ = await _release_rows(s, rows, reason, source=_CAPTURE)
+            await s.commit()
+    except Exception as e:
+        log.error(_j("credits.reverse_failed", hold_id=hold_id, reason=reason, error=str(e)[:200]))
+        return False
+
+    if reversed_:
+        metrics.inc("credits.reverse")
+        log.info(_j("credits.reverse", hold_id=hold_id, reason=reason))
+    return bool(reversed_)
+
+
+async def release_stale_holds(ctx) -> dict:
+    """
+    ✅ Cron воркера: резервы старше CREDIT_HOLD_TTL_S без колбэка
+    возвращаются пачками по _SWEEP_BATCH.
+    """
+    cutoff = func.date_sub(func.now(), literal_column(f"INTERVAL {int(settings.CREDIT_HOLD_TTL_S)} SECOND"))
+    total = 0
+    while True:
+        async with SessionLocal() as s:
+            rows = (await s.execute(
+                _hold_rows()
+                .where(CreditLedger.created_at < cutoff)
+                .order_by(CreditLedger.id)
+                .limit(_SWEEP_BATCH)
+                .with_for_update()
+            )).all()
+            released = await _release_rows(s, rows, "timeout")
+            await s.commit()
+        total += released
+        if released < _SWEEP_BATCH:
+            break
+
+    if total:
+        metrics.inc("credits.release_timeout", total)
+    log.info(_j("credits.stale_holds_released", released=total))
+    return {"ok": True, "released": total}
@@ -0,0 +1,718 @@
+"""
+Доставка результата KIE пользователю — arq job deliver_result.
+
+Вебхук /webhook/kie только сохраняет колбэк и ставит задачу в очередь,
+а всё тяжёлое (списание, скачивание 4K PNG, превью, отправка в Telegram,
+отметки в БД) делает воркер. По каждой доставке пишется событие
+deliver.timings с длительностью этапов; те же этапы — в метриках deliver.stage.*.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import redis.asyncio as aioredis
+from aiogram import Bot
+from arq import Retry
+from sqlalchemy import select, update
+from sqlalchemy.exc import OperationalError
+
+from bot.states import CreateStates, GenStates
+from core import metrics
+from core.config import settings
+from core.fsm import external_fsm
+from core.redis_pools import POOL_CACHE, get_redis
+from core.tg_outbound import PRIORITY_RESULT, set_tg_priority
+from db.engine import SessionLocal
+from db.models import Task, User
+from services import image_service, input_store
+from services.arq_pool import get_arq_client
+from services.credit_ledger import capture_hold, release_hold, reverse_capture
+from services.downloader import download_to_file, new_download_client, probe_url
+from services.task_context import load_task_context, mark_task_delivered
+from services.telegram_safe import safe_send_text
+
+log = logging.getLogger("kie")
+
+_CALLBACK_TTL_S = 86400
+# MySQL: 1205 — lock wait timeout, 1213 — deadlock; транзакцию можно повторить
+_DB_RETRY_CODES = (1205, 1213)
+_DEBIT_ATTEMPTS = 3
+_OUTBOX_KEY = "deliver:outbox:"
+# Форматы, которые Telegram принимает как фото по URL
+_URL_PHOTO_TYPES = ("image/jpeg", "image/png")
+
+
+class _Stages:
+    """Длительности этапов доставки (мс) + гистограммы deliver.stage.{name}_s"""
+
+    def __init__(self) -> None:
+        self.started = self._t = time.monotonic()
+        self.ms: Dict[str, int] = {}
+
+    def mark(self, name: str) -> None:
+        now = time.monotonic()
+        metrics.observe(f"deliver.stage.{name}_s", now - self._t)
+        self.ms[name] = int((now - self._t) * 1000)
+        self._t = now
+
+    def total_ms(self) -> int:
+        return int((time.monotonic() - self.started) * 1000)
+
+
+async def _acquire_webhook_lock(task_id: str, ttl: int = 180) -> Optional[Tuple[aioredis.Redis, str]]:
+    """
+    ✅ Лок на task_id через общий пул (соединение не открываем/не закрываем)
+    """
+    r = get_redis(POOL_CACHE)
+    key = f"wb:lock:kie:{task_id}"
+    try:
+        ok = await r.set(key, "1", nx=True, ex=ttl)
+        if ok:
+            return r, key
+        return None
+    except Exception:
+        return None
+
+
+async def _release_webhook_lock(lock: Optional[Tuple[aioredis.Redis, str]]) -> None:
+    if not lock:
+        return
+    r, key = lock
+    try:
+        await r.delete(key)
+    except Exception:
+        pass
+
+
+async def _clear_wait_and_reset(bot, chat_id: int, *, back_to: str = "auto") -> None:
+    fsm = external_fsm(chat_id)
+
+    data = await fsm.get_data()
+    wait_id = data.get("wait_msg_id")
+    if wait_id:
+        try:
+            await bot.delete_message(chat_id, wait_id)
+        except Exception:
+            pass
+        await fsm.update_data(wait_msg_id=None)
+
+    mode = (data.get("mode") or "").lower()
+    target = back_to
+    if target == "auto":
+        target = "create" if mode == "create" else "edit"
+
+    if target == "create":
+        await fsm.update_data(mode="create", edits=[], photos=[])
+        await fsm.set_state(CreateStates.waiting_prompt)
+    else:
+        await fsm.set_state(GenStates.waiting_prompt)
+
+
+async def _update_with_retry(session, stmt, max_retries=3) -> bool:
+    """
+    ✅ НОВОЕ: Выполнение UPDATE с retry для deadlock
+    
+    Args:
+        session: SQLAlchemy async session
+        stmt: UPDATE statement для выполнения
+        max_retries: Максимальное количество попыток
+        
+    Returns:
+        True если успешно, False если deadlock после всех попыток
+    """
+    for attempt in range(1, max_retries + 1):
+        try:
+            await session.execute(stmt)
+            await session.commit()
+            return True
+            
+        except OperationalError as e:
+            await session.rollback()
+            error_code = getattr(e.orig, 'args', [None])[0] if hasattr(e, 'orig') else None
+            
+            # 1213 = Deadlock
+            if error_code == 1213:
+                if attempt < max_retries:
+                    wait_time = 0.5 * attempt  # 0.5s, 1s, 1.5s
+                    log.warning(json.dumps({
+                        "event": "kie_webhook.deadlock_retry",
+                        "attempt": attempt,
+                        "max_retries": max_retries,
+                        "wait_time": wait_time
+                    }, ensure_ascii=False))
+                    await asyncio.sleep(wait_time)
+                    continue
+                else:
+                    log.error(json.dumps({
+                        "event": "kie_webhook.deadlock_failed",
+                        "attempts": max_retries
+                    }, ensure_ascii=False))
+                    return False
+            else:
+                # Другая ошибка - пробросим
+                raise
+                
+        except Exception:
+            await session.rollback()
+            raise
+            
+    return False
+
+
+async def remember_callback(task_id: str, state: str, data: Dict[str, Any]) -> bool:
+    """
+    ✅ Сохраняет колбэк (kie:cb:{task_id}:{state}); False — такой уже был
+    (повтор от KIE или результат уже подобрал reconciler)
+    """
+    try:
+        return bool(await get_redis(POOL_CACHE).set(
+            f"kie:cb:{task_id}:{state}",
+            json.dumps(data, ensure_ascii=False),
+            nx=True,
+            ex=_CALLBACK_TTL_S,
+        ))
+    except Exception:
+        # Без Redis не дедуплицируем — повтор отсечёт delivered в БД
+        return True
+
+
+async def forget_callback(task_id: str, state: str) -> None:
+    """
+    Снять отметку колбэка, если доставка не дошла ни до outbox, ни до
+    закрытия задачи: тогда повтор KIE и reconciler снова её подхватят
+    """
+    try:
+        await get_redis(POOL_CACHE).delete(f"kie:cb:{task_id}:{state}")
+    except Exception:
+        pass
+
+
+async def _debit_and_complete(
+    session,
+    task_id: str,
+    user_id: int,
+    credits: int,
+    hold_id: Optional[int] = None,
+    result_urls: Optional[List[str]] = None,
+) -> Optional[bool]:
+    """
+    ✅ Списание и отметка задачи в одной транзакции.
+    Обычно списание — capture резерва, сделанного при старте задачи. Если
+    резерва нет (задача до ledger) или он уже возвращён по таймауту —
+    UPDATE ... WHERE balance_credits >= :c без чтения баланса в Python.
+    result_image_urls пишется тем же UPDATE, что и status: completed +
+    delivered=0 — это и есть запись outbox'а доставки.
+
+    True — списано, False — баланса не хватило (задача закрыта без списания),
+    None — задача уже была completed (повторная доставка, не списываем).
+    """
+    res = await session.execute(
+        update(Task)
+        .where(Task.task_uuid == task_id, Task.status != "completed")
+        .values(status="completed", result_image_urls=result_urls)
+    )
+    first = res.rowcount == 1
+
+    if hold_id and await capture_hold(session, hold_id):
+        charged: Optional[bool] = True
+    elif first:
+        res = await session.execute(
+            update(User)
+            .where(User.id == user_id, User.balance_credits >= credits)
+            .values(balance_credits=User.balance_credits - credits)
+        )
+        charged = res.rowcount == 1
+    else:
+        charged = None
+
+    if charged is not None:
+        await session.execute(
+            update(Task).where(Task.task_uuid == task_id).values(credits_used=credits if charged else 0)
+        )
+    await session.commit()
+    return charged
+
+
+async def _debit_with_retry(session, task_id: str, *args: Any, **kwargs: Any) -> Optional[bool]:
+    """
+    _debit_and_complete с повтором транзакции при deadlock / lock wait timeout.
+    Повтор безопасен: все UPDATE условные, двойного списания не будет.
+    """
+    for attempt in range(1, _DEBIT_ATTEMPTS + 1):
+        try:
+            return await _debit_and_complete(session, task_id, *args, **kwargs)
+        except OperationalError as e:
+            await session.rollback()
+            code = getattr(e.orig, "args", [None])[0] if getattr(e, "orig", None) is not None else None
+            if code not in _DB_RETRY_CODES or attempt == _DEBIT_ATTEMPTS:
+                raise
+            metrics.inc("deliver.debit_retry")
+            log.warning(json.dumps({"event": "kie_webhook.debit_retry", "task_id": task_id, "attempt": attempt, "code": code}, ensure_ascii=False))
+            await asyncio.sleep(0.5 * attempt)
+    return None
+
+
+async def _schedule_redelivery(ctx: Dict[str, Any], task_id: str) -> bool:
+    """
+    Следующая попытка доставки через DELIVERY_RETRY_BASE_S · 2^(n-1) секунд
+    (не больше DELIVERY_RETRY_MAX_S). False — попытки кончились.
+    """
+    r = get_redis(POOL_CACHE)
+    key = f"{_OUTBOX_KEY}{task_id}"
+    attempt = int(await r.hincrby(key, "attempts", 1))
+    if attempt > settings.DELIVERY_MAX_ATTEMPTS:
+        return False
+    delay = min(settings.DELIVERY_RETRY_BASE_S * 2 ** (attempt - 1), settings.DELIVERY_RETRY_MAX_S)
+    await r.hset(key, "next_at", time.time() + delay)
+    await r.expire(key, settings.DELIVERY_OUTBOX_MAX_AGE_S)
+    try:
+        arq = ctx.get("redis") or get_arq_client()
+        await arq.enqueue_job("redeliver_result", task_id, _job_id=f"redeliver:{task_id}:{attempt}", _defer_by=delay)
+    except Exception as e:
+        # Не страшно: запись outbox в БД подберёт drain_delivery_outbox
+        log.warning(json.dumps({"event": "deliver.retry_enqueue_failed", "task_id": task_id, "error": str(e)[:200]}, ensure_ascii=False))
+    metrics.inc("deliver.retry_scheduled")
+    log.warning(json.dumps({"event": "deliver.retry_scheduled", "task_id": task_id, "attempt": attempt, "delay_s": delay}, ensure_ascii=False))
+    return True
+
+
+async def _refund_undelivered(s, task_id: str, tctx: Dict[str, Any]) -> bool:
+    """
+    Вернуть списание за результат, который так и не дошёл до пользователя.
+    Резерв — reverse_capture; прямое списание (задачи без ledger или резерв
+    уже вернул таймаут) — по tasks.credits_used условным UPDATE, повторный
+    вызов ничего не вернёт.
+    """
+    task_row = Task.task_uuid == task_id
+    if tctx["hold_id"] and await reverse_capture(tctx["hold_id"], reason="undelivered"):
+        await _update_with_retry(s, update(Task).where(task_row).values(credits_used=0))
+        return True
+    try:
+        res = await s.execute(
+            update(Task).where(task_row, Task.credits_used > 0).values(credits_used=0)
+        )
+        refunded = res.rowcount == 1
+        if refunded:
+            await s.execute(
+                update(User)
+                .where(User.id == tctx["user_id"])
+                .values(balance_credits=User.balance_credits + tctx["credits"])
+            )
+        await s.commit()
+    except Exception as e:
+        await s.rollback()
+        log.error(json.dumps({"event": "deliver.refund_failed", "task_id": task_id, "error": str(e)[:200]}, ensure_ascii=False))
+        return False
+    return refunded
+
+
+async def _delivery_mode(http: httpx.AsyncClient, image_url: str, task_id: str) -> str:
+    """
+    "url" — Telegram может забрать фото по ссылке KIE сам (JPEG/PNG в пределах
+    лимита фото по URL, ссылка открывается без авторизации); иначе "upload".
+    """
+    if not settings.RESULT_URL_DELIVERY:
+        return "upload"
+    try:
+        size, ctype = await probe_url(http, image_url, timeout=settings.RESULT_HEAD_TIMEOUT_S)
+    except Exception as e:
+        metrics.inc("deliver.probe_error")
+        log.info(json.dumps({"event": "deliver.probe_error", "task_id": task_id, "error": str(e)[:200]}, ensure_ascii=False))
+        return "upload"
+    mode = "url" if (
+        size is not None
+        and size <= settings.RESULT_URL_PHOTO_MAX_BYTES
+        and ctype in _URL_PHOTO_TYPES
+    ) else "upload"
+    log.info(json.dumps({"event": "deliver.mode", "task_id": task_id, "mode": mode, "size": size, "content_type": ctype}, ensure_ascii=False))
+    return mode
+
+
+async def _deliver_success(
+    ctx: Dict[str, Any],
+    bot: Bot,
+    s,
+    task_id: str,
+    tctx: Dict[str, Any],
+    image_url: str,
+    stages: _Stages,
+) -> Dict[str, Any]:
+    """
+    Скачивание, превью и отправка результата (списание уже сделано).
+    Небольшой JPEG/PNG Telegram забирает по URL сам (_delivery_mode), при
+    отказе — обычный путь через скачивание и upload. Если результат не
+    скачался или Telegram не принял фото — задача остаётся в outbox
+    (delivered=0) и доставка повторяется с backoff; document повторно не
+    отправляется. Когда попытки кончились, а не дошёл даже document, списание
+    возвращается.
+    """
+    from bot.routers.generation import send_generation_result
+
+    chat_id: int = tctx["chat_id"]
+    task_row = Task.task_uuid == task_id
+    r = get_redis(POOL_CACHE)
+    outbox_key = f"{_OUTBOX_KEY}{task_id}"
+
+    out_dir = "/tmp/nanobanana"
+    os.makedirs(out_dir, exist_ok=True)
+    local_path = os.path.join(out_dir, f"{task_id}.png")
+
+    # file_id документа, уже загруженного прошлой попыткой ("1" — до кэша file_id)
+    try:
+        doc_prev = await r.hget(outbox_key, "document")
+    except Exception:
+        doc_prev = None
+    if isinstance(doc_prev, bytes):
+        doc_prev = doc_prev.decode()
+
+    http: Optional[httpx.AsyncClient] = ctx.get("result_http")
+    own_http = http is None
+    if own_http:
+        http = new_download_client()
+    download: Optional[asyncio.Task] = None
+    try:
+        async def _fetch() -> bool:
+            # ✅ Повторная попытка не качает заново, если файл уже на диске
+            if os.path.exists(local_path):
+                return True
+            # ✅ Потоковое скачивание с докачкой (Range) и лимитом размера
+            try:
+                await download_to_file(
+                    http,
+                    image_url,
+                    local_path,
+                    headers={"Authorization": f"Bearer {settings.KIE_API_KEY}"},
+                    max_bytes=settings.RESULT_MAX_BYTES,
+                    log_ctx={"task_id": task_id},
+                )
+                return True
+            except Exception as e:
+                log.warning(json.dumps({"event": "kie_webhook.download_failed", "task_id": task_id, "error": str(e)[:200]}, ensure_ascii=False))
+                return False
+
+        doc_done = bool(doc_prev)
+        sent: Dict[str, Any] = {"document": doc_done, "photo": False, "document_file_id": None}
+        if doc_prev and doc_prev != "1":
+            sent["document_file_id"] = doc_prev
+
+        mode = "upload" if os.path.exists(local_path) else await _delivery_mode(http, image_url, task_id)
+        stages.mark("probe")
+        if mode == "url":
+            # ✅ Фото Telegram забирает по URL сам, оригинал для document качаем параллельно
+            if not doc_prev:
+                download = asyncio.create_task(_fetch())
+            sent = await send_generation_result(
+                chat_id,
+                task_id,
+                tctx["prompt"],
+                image_url,
+                local_path,
+                bot,
+                with_document=not doc_prev,
+                document_file_id=sent["document_file_id"],
+                photo_url=image_url,
+                document_ready=download,
+            )
+            doc_done = doc_done or sent["document"]
+            if not sent["photo"]:
+                metrics.inc("deliver.url_fallback")
+                log.warning(json.dumps({"event": "deliver.url_fallback", "task_id": task_id}, ensure_ascii=False))
+            else:
+                metrics.inc("deliver.mode.url")
+
+        if not sent["photo"]:
+            # Не скачалось — фото не отправляем, ниже это обычная повторная доставка
+            if await (download if download is not None else _fetch()):
+                stages.mark("download")
+
+                # ✅ Превью для sendPhoto — в пуле процессов, event loop не блокируется
+                preview_path = await image_service.preview_for_telegram(local_path, task_id=task_id)
+                stages.mark("preview")
+
+                # ✅ Отправить результат (передаём оба пути)
+                sent = await send_generation_result(
+                    chat_id,
+                    task_id,
+                    tctx["prompt"],
+                    image_url,
+                    local_path,      # ✅ Оригинал для document
+                    bot,
+                    preview_path,    # ✅ Превью для photo
+                    with_document=not doc_done,
+                    document_file_id=sent["document_file_id"],
+                )
+                doc_done = doc_done or sent["document"]
+                if sent["photo"]:
+                    metrics.inc("deliver.mode.upload")
+        sent["document"] = doc_done
+    finally:
+        if download is not None and not download.done():
+            download.cancel()
+        if own_http:
+            await http.aclose()
+    stages.mark("send")
+
+    if not sent["photo"]:
+        if sent["document"]:
+            try:
+                await r.hset(outbox_key, "document", sent["document_file_id"] or 1)
+                await r.expire(outbox_key, settings.DELIVERY_OUTBOX_MAX_AGE_S)
+            except Exception:
+                pass
+        if await _schedule_redelivery(ctx, task_id):
+            return {"ok": True, "retry": True}
+        # ✅ Попытки кончились: если не дошёл и document — списание возвращаем
+        refunded = not sent["document"] and await _refund_undelivered(s, task_id, tctx)
+        metrics.inc("deliver.gave_up")
+        log.error(json.dumps({"event": "deliver.gave_up", "task_id": task_id, "refunded": refunded}, ensure_ascii=False))
+        await _clear_wait_and_reset(bot, chat_id, back_to="auto")
+        text = "⚠️ Не удалось отправить результат."
+        if refunded:
+            text += " Кредиты возвращены на баланс."
+        await safe_send_text(bot, chat_id, text + "\nНапишите в поддержку: @guard_gpt")
+    
+    # ✅ UPDATE delivered с retry
+    success = await _update_with_retry(
+        s,
+        update(Task).where(task_row).values(delivered=True)
+    )
+    if not success:
+        log.error(json.dumps({"event": "kie_webhook.delivered_update_failed", "task_id": task_id}, ensure_ascii=False))
+    await mark_task_delivered(task_id)
+    try:
+        await r.delete(outbox_key)
+    except Exception:
+        pass
+    
+    # ✅ Входные фото остаются в input_store для повторных правок,
+    # задача лишь снимает с них ref (файлы удалит sweep_inputs)
+    await input_store.release_task(task_id)
+    
+    stages.mark("bookkeeping")
+    log.info(json.dumps({"event": "kie_webhook.success", "task_id": task_id}, ensure_ascii=False))
+    return {"ok": True}
+
+
+async def deliver_result(
+    ctx: Dict[str, Any],
+    task_id: str,
+    state: str,
+    result_urls: List[str],
+    fail_code: Optional[str] = None,
+    fail_msg: Optional[str] = None,
+    received_at: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    ✅ arq job: обработка колбэка KIE (раньше — прямо в HTTP-запросе вебхука)
+    """
+    # Подписи результата — HTML, поэтому нужен бот с parse_mode=HTML
+    bot: Bot = ctx.get("bot_html") or ctx["bot"]
+    set_tg_priority(PRIORITY_RESULT)
+    stages = _Stages()
+    if received_at:
+        metrics.observe("deliver.queue_wait_s", max(0.0, time.time() - received_at))
+
+    lock = await _acquire_webhook_lock(task_id, ttl=180)
+    if lock is None:
+        log.info(json.dumps({"event": "kie_webhook.skip_locked", "task_id": task_id}, ensure_ascii=False))
+        await forget_callback(task_id, state)
+        return {"ok": True, "skipped": "locked"}
+
+    # True — результат уже в outbox (completed) или задача закрыта: отметку колбэка оставляем
+    settled = False
+    try:
+        # ✅ Контекст задачи из Redis (записан при createTask); MySQL — только при промахе
+        tctx = await load_task_context(task_id)
+        if not tctx:
+            log.info(json.dumps({"event": "kie_webhook.no_task", "task_id": task_id}, ensure_ascii=False))
+            await forget_callback(task_id, state)
+            return {"ok": True, "skipped": "no_task"}
+
+        if tctx["delivered"]:
+            settled = True
+            log.info(json.dumps({"event": "kie_webhook.already_delivered", "task_id": task_id}, ensure_ascii=False))
+            return {"ok": True}
+
+        chat_id: int = tctx["chat_id"]
+        task_row = Task.task_uuid == task_id
+        stages.mark("db")
+
+        async with SessionLocal() as s:
+            if state == "success":
+                if not result_urls:
+                    settled = True
+                    await _clear_wait_and_reset(bot, chat_id, back_to="auto")
+                    if tctx["hold_id"]:
+                        await release_hold(tctx["hold_id"], reason="no_urls")
+                    await safe_send_text(bot, chat_id, "⚠️ Произошла ошибка.\nНапишите в поддержку: @guard_gpt")
+                    
+                    # ✅ UPDATE с retry
+                    success = await _update_with_retry(
+                        s,
+                        update(Task).where(task_row).values(delivered=True, status="completed")
+                    )
+                    if not success:
+                        log.error(json.dumps({"event": "kie_webhook.update_failed_deadlock", "task_id": task_id}, ensure_ascii=False))
+                    await mark_task_delivered(task_id)
+                    
+                    log.info(json.dumps({"event": "kie_webhook.no_urls", "task_id": task_id}, ensure_ascii=False))
+                    return {"ok": True}
+
+                # ✅ Списание и статус задачи — одна транзакция, баланс условием в UPDATE
+                credits_used = tctx["credits"]
+                try:
+                    charged = await _debit_with_retry(
+                        s, task_id, tctx["user_id"], credits_used,
+                        hold_id=tctx["hold_id"], result_urls=result_urls,
+                    )
+                except OperationalError as e:
+                    # Колбэк уже учтён (kie:cb:*), повтор от KIE отсечётся —
+                    # поэтому не закрываем задачу, а повторяем весь job
+                    metrics.inc("deliver.debit_failed")
+                    log.error(json.dumps({"event": "kie_webhook.debit_failed", "task_id": task_id, "job_try": ctx.get("job_try"), "error": str(e)[:200]}, ensure_ascii=False))
+                    raise Retry(defer=settings.DELIVERY_RETRY_BASE_S * (ctx.get("job_try") or 1))
+                settled = True
+                if charged is False:
+                    metrics.inc("credits.debit_insufficient")
+                    log.warning(json.dumps({"event": "kie_webhook.debit_insufficient", "task_id": task_id, "credits": credits_used}, ensure_ascii=False))
+
+                stages.mark("debit")
+
+                return await _deliver_success(ctx, bot, s, task_id, tctx, result_urls[0], stages)
+
+            if state == "fail":
+                settled = True
+                await _clear_wait_and_reset(bot, chat_id, back_to="auto")
+                if tctx["hold_id"]:
+                    await release_hold(tctx["hold_id"], reason="kie_fail")
+                
+                try:
+                    rr = get_redis(POOL_CACHE)
+                    shown = await rr.setnx(f"msg:fail:{task_id}", "1")
+                    if shown:
+                        await rr.expire(f"msg:fail:{task_id}", 86400)
+                        
+                        error_msg = "⚠️ Не удалось сгенерировать изображение. Попробуйте снова чуть позже: /gen"
+                        if fail_msg:
+                            error_msg = f"⚠️ Ошибка: {fail_msg[:200]}\n\nПопробуйте изменить промт или фото."
+                        
+                        await safe_send_text(bot, chat_id, error_msg)
+                except Exception:
+                    pass
+
+                # ✅ UPDATE с retry для failed task
+                success = await _update_with_retry(
+                    s,
+                    update(Task).where(task_row).values(
+                        delivered=True,
+                        status="failed"
+                    )
+                )
+                if not success:
+                    log.error(json.dumps({"event": "kie_webhook.fail_update_failed", "task_id": task_id}, ensure_ascii=False))
+                await mark_task_delivered(task_id)
+
+                await input_store.release_task(task_id)
+                
+                log.info(json.dumps({
+                    "event": "kie_webhook.fail",
+                    "task_id": task_id,
+                    "fail_code": fail_code,
+                    "fail_msg": fail_msg
+                }, ensure_ascii=False))
+                return {"ok": True}
+
+            log.info(json.dumps({"event": "kie_webhook.waiting", "task_id": task_id}, ensure_ascii=False))
+            return {"ok": True}
+
+    except BaseException:
+        # Упали до outbox (в т.ч. Retry): колбэк не должен считаться обработанным
+        if not settled:
+            await forget_callback(task_id, state)
+        raise
+    finally:
+        await _release_webhook_lock(lock)
+        log.info(json.dumps({
+            "event": "deliver.timings",
+            "task_id": task_id,
+            "state": state,
+            "total_ms": stages.total_ms(),
+            **{f"{k}_ms": v for k, v in stages.ms.items()},
+        }, ensure_ascii=False))
+
+
+async def redeliver_result(ctx: Dict[str, Any], task_id: str) -> Dict[str, Any]:
+    """
+    ✅ arq job: повторная доставка задачи из outbox (completed, delivered=0).
+    URL результата берётся из tasks.result_image_urls; списание не повторяется.
+    """
+    bot: Bot = ctx.get("bot_html") or ctx["bot"]
+    set_tg_priority(PRIORITY_RESULT)
+    stages = _Stages()
+    lock = await _acquire_webhook_lock(task_id, ttl=180)
+    if lock is None:
+        return {"ok": True, "skipped": "locked"}
+
+    try:
+        tctx = await load_task_context(task_id)
+        if not tctx or tctx["delivered"]:
+            return {"ok": True, "skipped": "delivered"}
+
+        async with SessionLocal() as s:
+            row = (await s.execute(
+                select(Task.status, Task.delivered, Task.result_image_urls).where(Task.task_uuid == task_id)
+            )).first()
+            if row is None or row.delivered or row.status != "completed" or not row.result_image_urls:
+                return {"ok": True, "skipped": "not_in_outbox"}
+            stages.mark("db")
+            metrics.inc("deliver.redelivery")
+            return await _deliver_success(ctx, bot, s, task_id, tctx, row.result_image_urls[0], stages)
+    finally:
+        await _release_webhook_lock(lock)
+        log.info(json.dumps({
+            "event": "deliver.timings",
+            "task_id": task_id,
+            "state": "redeliver",
+            "total_ms": stages.total_ms(),
+            **{f"{k}_ms": v for k, v in stages.ms.items()},
+        }, ensure_ascii=False))
+
+
+async def drain_delivery_outbox(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    ✅ Cron воркера: задачи completed без delivered, для которых не
+    запланирована попытка (воркер упал, очередь была недоступна), —
+    снова в redeliver_result.
+    """
+    now = datetime.utcnow()
+    async with SessionLocal() as s:
+        task_ids = (await s.execute(
+            select(Task.task_uuid).where(
+                Task.status == "completed",
+                Task.delivered.is_(False),
+                Task.result_image_urls.is_not(None),
+                Task.created_at < now - timedelta(seconds=settings.DELIVERY_OUTBOX_GRACE_S),
+                Task.created_at > now - timedelta(seconds=settings.DELIVERY_OUTBOX_MAX_AGE_S),
+            ).limit(200)
+        )).scalars().all()
+
+    r = get_redis(POOL_CACHE)
+    arq = ctx.get("redis") or get_arq_client()
+    queued = 0
+    for task_id in task_ids:
+        next_at = await r.hget(f"{_OUTBOX_KEY}{task_id}", "next_at")
+        if next_at is not None and float(next_at) + settings.DELIVERY_OUTBOX_GRACE_S > time.time():
+            continue
+        await arq.enqueue_job("redeliver_result", task_id, _job_id=f"redeliver:{task_id}:drain")
+        queued += 1
+
+    metrics.set_gauge("deliver.outbox_pending", float(len(task_ids)))
+    log.info(json.dumps({"event": "deliver.outbox_drain", "pending": len(task_ids), "queued": queued}, ensure_ascii=False))
+    return {"ok": True, "pending": len(task_ids), "queued": queued}
@@ -0,0 +1,138 @@
+"""
+Потоковое скачивание больших файлов (результаты KIE) на диск.
+
+Память на загрузку постоянная (чанки по 256 KB, запись вне event loop),
+при обрыве докачка продолжается с места остановки через Range, а не
+начинается заново. Размер ограничен max_bytes.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+from core import metrics
+
+log = logging.getLogger("downloader")
+
+_CHUNK = 256 * 1024
+
+
+class DownloadTooLarge(Exception):
+    ...
+
+
+def _j(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+def new_download_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(120.0, connect=15.0),
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60.0),
+        follow_redirects=True,
+    )
+
+
+async def probe_url(
+    http: httpx.AsyncClient,
+    url: str,
+    *,
+    timeout: float = 3.0,
+) -> Tuple[Optional[int], Optional[str]]:
+    """
+    HEAD без авторизации: (Content-Length, Content-Type) так, как их увидит
+    сторонний клиент (Telegram при отправке по URL). Ошибка HTTP — исключение.
+    """
+    resp = await http.head(url, timeout=timeout)
+    resp.raise_for_status()
+    length = resp.headers.get("Content-Length")
+    ctype = (resp.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+    return (int(length) if length and length.isdigit() else None), (ctype or None)
+
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        code = e.response.status_code
+        return code in (408, 429) or code >= 500
+    return isinstance(e, (httpx.TransportError, OSError))
+
+
+async def download_to_file(
+    http: httpx.AsyncClient,
+    url: str,
+    dest: str | Path,
+    *,
+    headers: Optional[Dict[str, str]] = None,
+    max_bytes: int,
+    attempts: int = 3,
+    retry_delay: float = 2.0,
+    log_ctx: Optional[Dict[str, object]] = None,
+) -> int:
+    """
+    Скачивает url в dest (через dest.part) и возвращает размер в байтах.
+    Повторные попытки докачивают с Range: bytes={уже_скачано}-.
+    """
+    dest = Path(dest)
+    part = dest.with_name(dest.name + ".part")
+    await asyncio.to_thread(dest.parent.mkdir, parents=True, exist_ok=True)
+    await asyncio.to_thread(part.unlink, missing_ok=True)
+    log_ctx = log_ctx or {}
+    offset = 0
+    delay = retry_delay
+
+    for attempt in range(1, attempts + 1):
+        req_headers = dict(headers or {})
+        if offset:
+            req_headers["Range"] = f"bytes={offset}-"
+        try:
+            async with http.stream("GET", url, headers=req_headers) as resp:
+                resp.raise_for_status()
+                if offset and resp.status_code != 206:
+                    # Сервер не умеет Range — начинаем сначала
+                    metrics.inc("download.range_ignored")
+                    offset = 0
+                length = resp.headers.get("Content-Length")
+                if length and length.isdigit() and offset + int(length) > max_bytes:
+                    raise DownloadTooLarge(f"{offset + int(length)} > {max_bytes}")
+
+                out = await asyncio.to_thread(open, part, "ab" if offset else "wb")
+                try:
+                    async for chunk in resp.aiter_bytes(_CHUNK):
+                        if offset + len(chunk) > max_bytes:
+                            raise DownloadTooLarge(f"> {max_bytes}")
+                        await asyncio.to_thread(out.write, chunk)
+                        offset += len(chunk)
+                finally:
+                    await asyncio.to_thread(out.close)
+
+            await asyncio.to_thread(os.replace, part, dest)
+            metrics.inc("download.bytes", offset)
+            log.info(_j("download.ok", **log_ctx, attempt=attempt, size=offset))
+            return offset
+
+        except DownloadTooLarge:
+            await asyncio.to_thread(part.unlink, missing_ok=True)
+            raise
+        except Exception as e:
+            if attempt >= attempts or not _retryable(e):
+                await asyncio.to_thread(part.unlink, missing_ok=True)
+                raise
+            if offset:
+                metrics.inc("download.resumed")
+            log.warning(_j(
+                "download.retry",
+                **log_ctx,
+                attempt=attempt,
+                resume_from=offset,
+                error=str(e)[:200],
+            ))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2.0, 10.0)
+
+    raise RuntimeError("unreachable")
@@ -0,0 +1,330 @@
+"""
+Планировщик генераций: справедливая очередь перед process_generation.
+
+Раньше enqueue_generation клал process_generation прямо в общую FIFO-очередь
+arq, и пользователь, жмущий «ещё раз», занимал все слоты воркера. Теперь
+запрос попадает в очередь пользователя в Redis, а dispatch_generations
+выпускает в arq не больше GEN_SCHED_SLOTS задач одновременно (по умолчанию
+ARQ_WORKER_MAX_JOBS × ARQ_WORKERS — столько, сколько воркеры и так
+выполняют параллельно):
+
+  • классы: interactive (standard) и pro — у pro свой потолок слотов
+    (GEN_SCHED_PRO_MAX_INFLIGHT, по умолчанию половина), обычные генерации
+    он не вытесняет;
+  • между пользователями — weighted deficit round robin: за проход по кольцу
+    пользователь получает quantum = вес класса × GEN_SCHED_PAID_WEIGHT
+    (если платил за последние 30 дней);
+  • потолок задач в работе на пользователя (платящим — больше).
+
+Ключи:
+  gen:sched:q:{chat}    — очередь пользователя (JSON: args, cls, paid, ts);
+  gen:sched:ring        — кольцо пользователей с непустой очередью;
+  gen:sched:members     — кто уже в кольце;
+  gen:sched:deficit     — дефицит DRR по пользователям;
+  gen:sched:running     — занятые слоты "{chat}:{cls}:{job_id}" → время старта
+                          (слоты упавших воркеров истекают через GEN_SCHED_SLOT_TTL_S).
+
+Диспетчер один (lock), его будят постановка и завершение задачи, плюс cron
+раз в 10 с на случай потерянного пинка. Время ожидания по классам —
+гистограммы queue.wait_s.{cls}.
+
+Рассылка и обслуживание (чистка БД, бэкап, sweep) идут отдельной очередью
+arq BACKGROUND_QUEUE в своём воркере и слоты генераций не занимают.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from sqlalchemy import select
+
+from core import metrics
+from core.config import settings
+from core.redis_pools import POOL_CACHE, get_redis
+from db.engine import SessionLocal
+from db.models import Payment, User
+from services.arq_pool import get_arq_client
+
+log = logging.getLogger("gen_scheduler")
+
+CLASS_INTERACTIVE = "interactive"
+CLASS_PRO = "pro"
+
+_Q = "gen:sched:q:"
+_RING = "gen:sched:ring"
+_MEMBERS = "gen:sched:members"
+_DEFICIT = "gen:sched:deficit"
+_RUNNING = "gen:sched:running"
+_DIRTY = "gen:sched:dirty"
+_LOCK = "gen:sched:lock"
+_PROFILE = "gen:sched:user:"
+_PROFILE_TTL_S = 300
+_LOCK_TTL_S = 30
+_PAID_WINDOW = timedelta(days=30)
+_MAX_PASSES = 20
+
+# KEYS: queue, members, ring; ARGV: entry, chat
+_SUBMIT_LUA = """
+redis.call('rpush', KEYS[1], ARGV[1])
+if redis.call('sadd', KEYS[2], ARGV[2]) == 1 then
+    redis.call('rpush', KEYS[3], ARGV[2])
+end
+return 1
+"""
+
+# KEYS: queue, members, ring, deficit; ARGV: chat
+# Пользователь уходит из кольца, только если его очередь всё ещё пуста
+_RETIRE_LUA = """
+if redis.call('llen', KEYS[1]) > 0 then return 0 end
+redis.call('srem', KEYS[2], ARGV[1])
+redis.call('lrem', KEYS[3], 0, ARGV[1])
+redis.call('hdel', KEYS[4], ARGV[1])
+return 1
+"""
+
+
+def _j(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+def _s(v) -> str:
+    return v.decode() if isinstance(v, bytes) else str(v)
+
+
+def _quantum(cls: str, paid: bool) -> float:
+    w = settings.GEN_SCHED_WEIGHT_PRO if cls == CLASS_PRO else settings.GEN_SCHED_WEIGHT_INTERACTIVE
+    return w * (settings.GEN_SCHED_PAID_WEIGHT if paid else 1.0)
+
+
+def _user_cap(paid: bool) -> int:
+    return settings.GEN_SCHED_PAID_USER_MAX_INFLIGHT if paid else settings.GEN_SCHED_USER_MAX_INFLIGHT
+
+
+def _class_cap(cls: str) -> int:
+    if cls == CLASS_PRO:
+        return settings.GEN_SCHED_PRO_MAX_INFLIGHT or max(1, settings.GEN_SCHED_SLOTS // 2)
+    return settings.GEN_SCHED_SLOTS
+
+
+async def _profile(r, chat_id: int) -> Tuple[str, bool]:
+    """(класс, платящий) — из кэша в Redis, при промахе из MySQL"""
+    key = f"{_PROFILE}{chat_id}"
+    try:
+        raw = await r.hgetall(key)
+        if raw:
+            d = {_s(k): _s(v) for k, v in raw.items()}
+            return d.get("cls") or CLASS_INTERACTIVE, d.get("paid") == "1"
+    except Exception:
+        pass
+
+    cls, paid = CLASS_INTERACTIVE, False
+    try:
+        async with SessionLocal() as s:
+            row = (await s.execute(
+                select(User.id, User.model_preference).where(User.chat_id == chat_id)
+            )).first()
+            if row is not None:
+                cls = CLASS_PRO if row.model_preference == "pro" else CLASS_INTERACTIVE
+                paid = (await s.execute(
+                    select(Payment.id).where(
+                        Payment.user_id == row.id,
+                        Payment.status == "succeeded",
+                        Payment.created_at > datetime.utcnow() - _PAID_WINDOW,
+                    ).limit(1)
+                )).first() is not None
+    except Exception as e:
+        log.warning(_j("gen_sched.profile_failed", chat_id=chat_id, error=str(e)[:100]))
+        return cls, paid
+
+    try:
+        await r.hset(key, mapping={"cls": cls, "paid": int(paid)})
+        await r.expire(key, _PROFILE_TTL_S)
+    except Exception:
+        pass
+    return cls, paid
+
+
+async def _kick(arq=None) -> None:
+    r = get_redis(POOL_CACHE)
+    await r.set(_DIRTY, 1)
+    await (arq or get_arq_client()).enqueue_job("dispatch_generations")
+
+
+async def submit_generation(
+    chat_id: int,
+    prompt: str,
+    photos: List[str],
+    aspect_ratio: Optional[str] = None,
+) -> None:
+    """
+    ✅ Постановка генерации в очередь пользователя. Если Redis планировщика
+    недоступен — сразу в arq, как раньше (без справедливости, но без потерь).
+    """
+    r = get_redis(POOL_CACHE)
+    try:
+        cls, paid = await _profile(r, chat_id)
+        entry = json.dumps({
+            "args": [chat_id, prompt, photos, aspect_ratio],
+            "cls": cls,
+            "paid": paid,
+            "ts": time.time(),
+        }, ensure_ascii=False)
+        await r.eval(_SUBMIT_LUA, 3, f"{_Q}{chat_id}", _MEMBERS, _RING, entry, str(chat_id))
+    except Exception as e:
+        metrics.inc("gen_sched.bypass")
+        log.warning(_j("gen_sched.submit_failed", chat_id=chat_id, error=str(e)[:100]))
+        await get_arq_client().enqueue_job(
+            "process_generation", chat_id, prompt, photos, aspect_ratio, submitted_at=time.time()
+        )
+        return
+    metrics.inc(f"gen_sched.submitted.{cls}")
+    try:
+        await _kick()
+    except Exception as e:
+        # Запрос уже в очереди — его выпустит cron-проход
+        log.warning(_j("gen_sched.kick_failed", chat_id=chat_id, error=str(e)[:100]))
+
+
+async def finish_generation(ctx: Dict[str, Any], slot: Optional[str]) -> None:
+    """Освободить слот (finally в process_generation) и разбудить диспетчер"""
+    if not slot:
+        return
+    try:
+        await get_redis(POOL_CACHE).zrem(_RUNNING, slot)
+        await _kick(ctx.get("redis"))
+    except Exception as e:
+        log.warning(_j("gen_sched.finish_failed", slot=slot, error=str(e)[:100]))
+
+
+def observe_queue_wait(cls: Optional[str], submitted_at: Optional[float]) -> None:
+    """Гистограмма queue.wait_s.{cls}: от постановки до старта задачи"""
+    if submitted_at:
+        metrics.observe(f"queue.wait_s.{cls or CLASS_INTERACTIVE}", max(0.0, time.time() - submitted_at))
+
+
+async def _running(r, now: float) -> Tuple[Dict[str, int], Dict[str, int], int]:
+    await r.zremrangebyscore(_RUNNING, 0, now - settings.GEN_SCHED_SLOT_TTL_S)
+    per_user: Dict[str, int] = {}
+    per_class: Dict[str, int] = {}
+    members = await r.zrange(_RUNNING, 0, -1)
+    for m in members:
+        chat, cls, _ = _s(m).split(":", 2)
+        per_user[chat] = per_user.get(chat, 0) + 1
+        per_class[cls] = per_class.get(cls, 0) + 1
+    return per_user, per_class, len(members)
+
+
+async def _dispatch(arq, r, chat: str, entry: Dict[str, Any], now: float) -> bool:
+    job_id = uuid4().hex
+    slot = f"{chat}:{entry['cls']}:{job_id}"
+    await r.zadd(_RUNNING, {slot: now})
+    try:
+        await arq.enqueue_job(
+            "process_generation",
+            *entry["args"],
+            sched_slot=slot,
+            sched_class=entry["cls"],
+            submitted_at=entry["ts"],
+            _job_id=f"gen:{job_id}",
+        )
+    except Exception as e:
+        await r.zrem(_RUNNING, slot)
+        log.warning(_j("gen_sched.enqueue_failed", chat_id=chat, error=str(e)[:100]))
+        return False
+    return True
+
+
+async def _pass(arq, r) -> int:
+    """Один проход DRR по кольцу; возвращает число выпущенных задач"""
+    now = time.time()
+    per_user, per_class, total = await _running(r, now)
+    free = settings.GEN_SCHED_SLOTS - total
+    dispatched = 0
+
+    for _ in range(await r.llen(_RING)):
+        if free <= 0:
+            break
+        chat = await r.lmove(_RING, _RING, "LEFT", "RIGHT")
+        if chat is None:
+            break
+        chat = _s(chat)
+        qkey = f"{_Q}{chat}"
+        head = await r.lindex(qkey, 0)
+        if head is None:
+            await r.eval(_RETIRE_LUA, 4, qkey, _MEMBERS, _RING, _DEFICIT, chat)
+            continue
+
+        entry = json.loads(head)
+        cls, paid = entry["cls"], bool(entry.get("paid"))
+        cap = _user_cap(paid)
+        # Упёрся в потолок — дефицит не копим, иначе потом выйдет пачкой
+        if per_user.get(chat, 0) >= cap or per_class.get(cls, 0) >= _class_cap(cls):
+            continue
+
+        quantum = _quantum(cls, paid)
+        deficit = float(await r.hget(_DEFICIT, chat) or 0) + quantum
+        while deficit >= 1 and free > 0 and per_user.get(chat, 0) < cap and per_class.get(cls, 0) < _class_cap(cls):
+            raw = await r.lpop(qkey)
+            if raw is None:
+                break
+            entry = json.loads(raw)
+            if not await _dispatch(arq, r, chat, entry, now):
+                await r.lpush(qkey, raw)
+                return dispatched
+            cls = entry["cls"]
+            deficit -= 1
+            free -= 1
+            dispatched += 1
+            per_user[chat] = per_user.get(chat, 0) + 1
+            per_class[cls] = per_class.get(cls, 0) + 1
+            metrics.observe(f"gen_sched.dispatch_wait_s.{cls}", max(0.0, now - entry["ts"]))
+
+        if await r.eval(_RETIRE_LUA, 4, qkey, _MEMBERS, _RING, _DEFICIT, chat):
+            continue
+        await r.hset(_DEFICIT, chat, min(deficit, quantum))
+
+    return dispatched
+
+
+async def dispatch_generations(ctx: Dict[str, Any]) -> dict:
+    """
+    ✅ arq job / cron: выпустить в работу столько генераций, сколько
+    свободно слотов. Работает один экземпляр (lock); пинки, пришедшие во
+    время прохода, отмечаются флагом dirty и дают ещё один проход.
+    """
+    r = get_redis(POOL_CACHE)
+    arq = ctx.get("redis") or get_arq_client()
+    token = uuid4().hex
+    dispatched = 0
+
+    for _ in range(_MAX_PASSES):
+        if not await r.set(_LOCK, token, nx=True, ex=_LOCK_TTL_S):
+            break  # проход уже идёт — он увидит dirty
+        try:
+            while await r.delete(_DIRTY):
+                dispatched += await _pass(arq, r)
+        finally:
+            if _s(await r.get(_LOCK) or "") == token:
+                await r.delete(_LOCK)
+        # Пинок между последней проверкой и снятием lock
+        if not await r.exists(_DIRTY):
+            break
+
+    try:
+        metrics.set_gauge("gen_sched.running", float(await r.zcard(_RUNNING)))
+        metrics.set_gauge("gen_sched.users_waiting", float(await r.llen(_RING)))
+    except Exception:
+        pass
+    if dispatched:
+        log.info(_j("gen_sched.dispatched", count=dispatched))
+    return {"ok": True, "dispatched": dispatched}
+
+
+async def dispatch_generations_cron(ctx: Dict[str, Any]) -> dict:
+    """Страховочный проход раз в 10 с (потерянный пинок, истёкшие слоты)"""
+    await get_redis(POOL_CACHE).set(_DIRTY, 1)
+    return await dispatch_generations(ctx)
@@ -0,0 +1,141 @@
+"""
+CPU-тяжёлая работа с картинками — в отдельных процессах (ProcessPoolExecutor),
+чтобы PIL не блокировал event loop воркера.
+
+Превью для Telegram (sendPhoto принимает до 10 MB) строится за один проход:
+draft-декодирование, thumbnail до PREVIEW_MAX_SIDE и одно JPEG-кодирование
+с качеством, выбранным заранее по бюджету байт на пиксель (вместо перебора
+85 → 65 с optimize=True и записью на диск на каждой попытке).
+"""
+from __future__ import annotations
+
+import asyncio
+import io
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Optional
+
+from core import metrics
+from core.config import settings
+
+log = logging.getLogger("image_service")
+
+PREVIEW_MAX_SIDE = 2048
+PREVIEW_LIMIT_BYTES = int(9.5 * 1024 * 1024)  # лимит Telegram 10 MB, с запасом
+PREVIEW_THRESHOLD_BYTES = 10 * 1024 * 1024    # меньше — отправляем оригинал
+
+# Примерный размер JPEG (бит на пиксель) по качеству для фото-контента.
+# Берём максимальное качество, которое укладывается в бюджет.
+_BPP_BY_QUALITY = ((90, 4.0), (85, 3.0), (80, 2.4), (75, 2.0), (70, 1.7), (65, 1.5))
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _j(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+def _pick_quality(pixels: int, budget_bytes: int) -> int:
+    bpp_budget = budget_bytes * 8 / max(1, pixels)
+    for quality, bpp in _BPP_BY_QUALITY:
+        if bpp <= bpp_budget:
+            return quality
+    return _BPP_BY_QUALITY[-1][0]
+
+
+def _render_preview(src_path: str, dst_path: str, max_side: int, limit_bytes: int) -> Dict[str, Any]:
+    """Выполняется в дочернем процессе"""
+    from PIL import Image
+
+    started = time.perf_counter()
+    with Image.open(src_path) as img:
+        # Для JPEG декодер сразу уменьшает в 2/4/8 раз; для PNG — no-op
+        img.draft("RGB", (max_side, max_side))
+        if img.mode in ("RGBA", "LA", "P"):
+            rgba = img.convert("RGBA")
+            background = Image.new("RGB", rgba.size, (255, 255, 255))
+            background.paste(rgba, mask=rgba.split()[3])
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+        quality = _pick_quality(img.width * img.height, limit_bytes)
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=quality)
+        if buf.tell() > limit_bytes:
+            # Прогноз промахнулся (очень шумная картинка) — одна повторная попытка
+            quality = _BPP_BY_QUALITY[-1][0]
+            buf = io.BytesIO()
+            img.save(buf, "JPEG", quality=quality)
+
+    with open(dst_path, "wb") as out:
+        out.write(buf.getbuffer())
+
+    return {
+        "quality": quality,
+        "preview_bytes": buf.tell(),
+        "encode_s": time.perf_counter() - started,
+    }
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=max(1, settings.IMAGE_POOL_WORKERS))
+    return _pool
+
+
+def shutdown_image_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def preview_for_telegram(src_path: str, *, task_id: Optional[str] = None) -> str:
+    """
+    ✅ Путь к картинке для sendPhoto: оригинал, если он < 10 MB,
+    иначе сжатое превью рядом (*_preview.jpg). При ошибке — оригинал.
+    """
+    global _pool
+    try:
+        original_bytes = os.path.getsize(src_path)
+    except OSError:
+        return src_path
+    if original_bytes <= PREVIEW_THRESHOLD_BYTES:
+        log.info(_j("image.no_preview_needed", task_id=task_id, file_mb=round(original_bytes / (1024 * 1024), 2)))
+        return src_path
+
+    dst_path = os.path.splitext(src_path)[0] + "_preview.jpg"
+    loop = asyncio.get_running_loop()
+    args = (src_path, dst_path, PREVIEW_MAX_SIDE, PREVIEW_LIMIT_BYTES)
+    try:
+        try:
+            info = await loop.run_in_executor(_get_pool(), _render_preview, *args)
+        except BrokenProcessPool:
+            # Дочерний процесс упал (OOM и т.п.) — пересоздаём пул один раз
+            log.warning(_j("image.pool_broken", task_id=task_id))
+            _pool = None
+            info = await loop.run_in_executor(_get_pool(), _render_preview, *args)
+    except Exception as e:
+        log.warning(_j("image.preview_failed", task_id=task_id, error=str(e)[:100]))
+        return src_path
+
+    saved = original_bytes - info["preview_bytes"]
+    metrics.observe("image.preview_encode_s", info["encode_s"])
+    metrics.inc("image.preview_bytes_saved", max(0, saved))
+    log.info(_j(
+        "image.preview_created",
+        task_id=task_id,
+        original_mb=round(original_bytes / (1024 * 1024), 2),
+        preview_mb=round(info["preview_bytes"] / (1024 * 1024), 2),
+        saved_mb=round(saved / (1024 * 1024), 2),
+        quality=info["quality"],
+        encode_ms=int(info["encode_s"] * 1000),
+    ))
+    return dst_path
@@ -0,0 +1,241 @@
+"""
+Контентно-адресуемое хранилище входных фото (/app/temp_inputs).
+
+Имя файла — sha256 содержимого, поэтому одинаковые фото лежат на диске
+один раз. Индекс в Redis:
+  • input:fid:{file_id}        -> filename  (повтор без запроса в Telegram)
+  • input:uid:{file_unique_id} -> filename  (тот же файл под другим file_id)
+  • input:obj:{filename}       — refs (сколько задач сейчас используют файл)
+                                 и TTL, продлеваемый при каждом использовании;
+  • input:ing:{file_id}        — файл сейчас качает предзагрузка (preingest_photos),
+                                 process_generation ждёт её, а не качает второй раз.
+Файлы удаляет sweep_inputs (cron воркера): когда запись input:obj истекла,
+или refs <= 0 и файл давно не использовался.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import httpx
+
+from core import metrics
+from core.config import settings
+from core.redis_pools import POOL_CACHE, get_redis
+
+log = logging.getLogger("input_store")
+
+INPUT_DIR = Path("/app/temp_inputs")
+_CHUNK = 256 * 1024
+_KEY = "input:"
+_PART_GRACE_S = 3600
+_NEW_FILE_GRACE_S = 600
+_INGEST_CLAIM_TTL_S = 120
+
+
+def _j(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+def _s(v) -> str:
+    return v.decode() if isinstance(v, bytes) else str(v)
+
+
+def public_url(filename: str) -> str:
+    return f"{settings.PUBLIC_BASE_URL.rstrip('/')}/proxy/image/{filename}"
+
+
+def filename_from_url(url: str) -> Optional[str]:
+    if "/proxy/image/" not in url:
+        return None
+    return url.rsplit("/", 1)[-1] or None
+
+
+async def lookup(*, file_id: Optional[str] = None, file_unique_id: Optional[str] = None) -> Optional[str]:
+    """Имя уже сохранённого файла (и он всё ещё на диске) или None"""
+    keys = []
+    if file_id:
+        keys.append(f"{_KEY}fid:{file_id}")
+    if file_unique_id:
+        keys.append(f"{_KEY}uid:{file_unique_id}")
+    if not keys:
+        return None
+    try:
+        values = await get_redis(POOL_CACHE).mget(keys)
+    except Exception as e:
+        log.warning(_j("input_store.lookup_failed", error=str(e)[:100]))
+        return None
+    for raw in values:
+        if raw is None:
+            continue
+        name = _s(raw)
+        if (INPUT_DIR / name).exists():
+            metrics.inc("input_store.hit")
+            return name
+    metrics.inc("input_store.miss")
+    return None
+
+
+async def index(filename: str, *, file_id: Optional[str] = None, file_unique_id: Optional[str] = None) -> None:
+    ttl = settings.INPUT_STORE_TTL_S
+    try:
+        async with get_redis(POOL_CACHE).pipeline(transaction=False) as pipe:
+            if file_id:
+                pipe.set(f"{_KEY}fid:{file_id}", filename, ex=ttl)
+            if file_unique_id:
+                pipe.set(f"{_KEY}uid:{file_unique_id}", filename, ex=ttl)
+            pipe.hsetnx(f"{_KEY}obj:{filename}", "refs", 0)
+            pipe.hset(f"{_KEY}obj:{filename}", "used_at", int(time.time()))
+            pipe.expire(f"{_KEY}obj:{filename}", ttl)
+            await pipe.execute()
+    except Exception as e:
+        log.warning(_j("input_store.index_failed", filename=filename, error=str(e)[:100]))
+
+
+async def claim_ingest(file_id: str) -> bool:
+    """Занять скачивание file_id (False — уже качает другой воркер)"""
+    try:
+        return bool(await get_redis(POOL_CACHE).set(f"{_KEY}ing:{file_id}", 1, nx=True, ex=_INGEST_CLAIM_TTL_S))
+    except Exception:
+        return True
+
+
+async def release_ingest(file_id: str) -> None:
+    try:
+        await get_redis(POOL_CACHE).delete(f"{_KEY}ing:{file_id}")
+    except Exception:
+        pass
+
+
+async def ingest_pending(file_ids: List[str]) -> List[bool]:
+    """Для каждого file_id: идёт ли сейчас его скачивание"""
+    if not file_ids:
+        return []
+    try:
+        values = await get_redis(POOL_CACHE).mget([f"{_KEY}ing:{fid}" for fid in file_ids])
+    except Exception:
+        return [False] * len(file_ids)
+    return [v is not None for v in values]
+
+
+async def store_stream(http: httpx.AsyncClient, url: str, *, ext: str, max_size: int) -> Tuple[str, int, bool]:
+    """
+    Стримит url на диск, считая sha256 по ходу. Пишем в .part и
+    переименовываем в {sha256}{ext}; если такой файл уже есть — .part
+    удаляется. Возвращает (filename, size, deduplicated).
+    """
+    await asyncio.to_thread(INPUT_DIR.mkdir, parents=True, exist_ok=True)
+    part = INPUT_DIR / f"{os.urandom(8).hex()}.part"
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with http.stream("GET", url) as resp:
+            resp.raise_for_status()
+            out = await asyncio.to_thread(open, part, "wb")
+            try:
+                async for chunk in resp.aiter_bytes(_CHUNK):
+                    size += len(chunk)
+                    if size > max_size:
+                        raise ValueError("file_too_big")
+                    digest.update(chunk)
+                    await asyncio.to_thread(out.write, chunk)
+            finally:
+                await asyncio.to_thread(out.close)
+
+        filename = f"{digest.hexdigest()}{ext}"
+        target = INPUT_DIR / filename
+        if target.exists():
+            await asyncio.to_thread(part.unlink)
+            metrics.inc("input_store.dedup")
+            return filename, size, True
+        await asyncio.to_thread(os.replace, part, target)
+        return filename, size, False
+    except BaseException:
+        try:
+            part.unlink(missing_ok=True)
+        except OSError:
+            pass
+        raise
+
+
+async def retain_for_task(task_uuid: str, urls: Iterable[str]) -> None:
+    """+1 ref на каждый входной файл задачи; снимается release_task()"""
+    names = [n for n in (filename_from_url(u) for u in urls) if n]
+    if not names:
+        return
+    ttl = settings.INPUT_STORE_TTL_S
+    try:
+        async with get_redis(POOL_CACHE).pipeline(transaction=False) as pipe:
+            for name in names:
+                pipe.hincrby(f"{_KEY}obj:{name}", "refs", 1)
+                pipe.hset(f"{_KEY}obj:{name}", "used_at", int(time.time()))
+                pipe.expire(f"{_KEY}obj:{name}", ttl)
+            pipe.rpush(f"{_KEY}task:{task_uuid}", *names)
+            pipe.expire(f"{_KEY}task:{task_uuid}", ttl)
+            await pipe.execute()
+    except Exception as e:
+        log.warning(_j("input_store.retain_failed", task_uuid=task_uuid, error=str(e)[:100]))
+
+
+async def release_task(task_uuid: str) -> None:
+    """Задача завершена: -1 ref на её входные файлы (файлы остаются для повторных правок)"""
+    r = get_redis(POOL_CACHE)
+    try:
+        names: List[str] = [_s(x) for x in await r.lrange(f"{_KEY}task:{task_uuid}", 0, -1)]
+        if not names:
+            return
+        async with r.pipeline(transaction=False) as pipe:
+            for name in names:
+                pipe.hincrby(f"{_KEY}obj:{name}", "refs", -1)
+            pipe.delete(f"{_KEY}task:{task_uuid}")
+            await pipe.execute()
+    except Exception as e:
+        log.warning(_j("input_store.release_failed", task_uuid=task_uuid, error=str(e)[:100]))
+
+
+async def sweep_inputs(ctx, idle_ttl_s: Optional[int] = None) -> dict:
+    """
+    ✅ Cron воркера: удаляет входные файлы без живой записи в Redis
+    и недокачанные .part старше часа. idle_ttl_s — меньший срок простоя
+    для экстренной очистки диска (cleanup_redis.py); файлы с живыми ref
+    (задача ещё идёт) не трогаются никогда.
+    """
+    if not INPUT_DIR.exists():
+        return {"ok": True, "deleted": 0}
+    r = get_redis(POOL_CACHE)
+    now = time.time()
+    ttl = settings.INPUT_STORE_TTL_S if idle_ttl_s is None else idle_ttl_s
+    deleted = 0
+
+    for path in await asyncio.to_thread(lambda: list(INPUT_DIR.iterdir())):
+        try:
+            age = now - path.stat().st_mtime
+            if path.suffix == ".part":
+                if age > _PART_GRACE_S:
+                    path.unlink(missing_ok=True)
+                    deleted += 1
+                continue
+            if age < _NEW_FILE_GRACE_S:
+                continue
+            refs, used_at = await r.hmget(f"{_KEY}obj:{path.name}", "refs", "used_at")
+            if refs is None:
+                stale = True
+            else:
+                idle = now - int(used_at or 0)
+                stale = int(refs) <= 0 and idle > ttl
+            if stale:
+                path.unlink(missing_ok=True)
+                await r.delete(f"{_KEY}obj:{path.name}")
+                deleted += 1
+        except Exception as e:
+            log.warning(_j("input_store.sweep_error", file=path.name, error=str(e)[:100]))
+
+    metrics.inc("input_store.swept", deleted)
+    log.info(_j("input_store.sweep_done", deleted=deleted))
+    return {"ok": True, "deleted": deleted}
@@ -11,6 +11,7 @@ from yookassa.domain.exceptions.api_error import ApiError
 from sqlalchemy import select
 
 from core.config import settings
+from core.tg_outbound import install_outbound_scheduler
 from db.engine import SessionLocal
 from db.models import Payment as PayModel, User
 from services.pricing import credits_for_rub
@@ -175,6 +176,7 @@ async def handle_yookassa_webhook(payload: dict):
     )
 
     bot = Bot(token=settings.TELEGRAM_BOT_TOKEN)
+    install_outbound_scheduler(bot)
     try:
         await bot.send_message(user.chat_id, text)
     finally:
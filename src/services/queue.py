@@ -9,12 +9,15 @@ import hashlib
 import json
 import logging
 import mimetypes
+import time
 from typing import Any, Dict, List, Optional
 from pathlib import Path
 
 import httpx
 import redis.asyncio as aioredis
 from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
 from aiogram.exceptions import TelegramForbiddenError,TelegramBadRequest
 from aiogram.exceptions import (
     TelegramForbiddenError,
@@ -22,23 +25,36 @@ from aiogram.exceptions import (
     TelegramNetworkError,  # ✅ ДОБАВИТЬ
     TelegramServerError,    # ✅ ДОБАВИТЬ
 )
-from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.base import StorageKey
-from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
-from arq import create_pool
-from arq.connections import RedisSettings
-from sqlalchemy import select, update
+from sqlalchemy import select
 from sqlalchemy.exc import OperationalError
 from uuid import uuid4
 from arq.cron import cron
 from services.cleanup_db import cleanup_database_task
 from services.backup_db import backup_database_task
+from core import metrics
 from core.config import settings
+from core.fsm import external_fsm
+from core.tg_outbound import install_outbound_scheduler
+from core.redis_pools import POOL_CACHE, close_redis_pools, get_redis, init_redis_pools
 from db.engine import SessionLocal
 from db.models import Task, User
 from services.pricing import CREDITS_PER_GENERATION
 from vendors.kie import KieClient, KieError
 from services.broadcast import broadcast_send
+from services.delivery import deliver_result, drain_delivery_outbox, redeliver_result
+from services.downloader import new_download_client
+from services import image_service, input_store
+from services.credit_ledger import attach_hold, hold_credits, release_hold, release_stale_holds
+from services.reconciler import reconcile_stuck_tasks
+from services.task_context import save_task_context
+from services.arq_pool import ARQ_REDIS_SETTINGS, BACKGROUND_QUEUE, get_arq_client
+from services.gen_scheduler import (
+    dispatch_generations,
+    dispatch_generations_cron,
+    finish_generation,
+    observe_queue_wait,
+    submit_generation,
+)
 
 log = logging.getLogger("worker")
 
@@ -47,10 +63,33 @@ def _j(event: str, **fields) -> str:
     return json.dumps({"event": event, **fields}, ensure_ascii=False)
 
 
-async def _tg_file_to_public_url(bot: Bot, file_id: str, *, cid: str) -> str:
+def new_tg_http_client() -> httpx.AsyncClient:
+    """Клиент для скачивания файлов Telegram — один на воркер (ctx["tg_http"])"""
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(90.0, connect=20.0),
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60.0),
+    )
+
+
+async def _tg_file_to_public_url(
+    bot: Bot,
+    file_id: str,
+    *,
+    cid: str,
+    http: Optional[httpx.AsyncClient] = None,
+) -> str:
     """
     ✅ ИСПРАВЛЕНО: улучшенная обработка сетевых ошибок с retry
     """
+    # ✅ Этот file_id уже скачивали — ни Telegram, ни диска
+    cached = await input_store.lookup(file_id=file_id)
+    if cached:
+        return input_store.public_url(cached)
+
+    if http is None:
+        async with new_tg_http_client() as own:
+            return await _tg_file_to_public_url(bot, file_id, cid=cid, http=own)
+
     max_attempts = 4  # ✅ увеличено с 3
     delay = 2.0
     
@@ -107,15 +146,20 @@ async def _tg_file_to_public_url(bot: Bot, file_id: str, *, cid: str) -> str:
             ))
             raise ValueError("file_too_big")
         
-        # ✅ Скачивание файла с retry
+        # ✅ Тот же файл под другим file_id (пересылка, документ) — берём готовый
+        same = await input_store.lookup(file_unique_id=f.file_unique_id)
+        if same:
+            await input_store.index(same, file_id=file_id)
+            return input_store.public_url(same)
+
+        # ✅ Сохранение файла: стримим прямо на диск, имя = sha256 содержимого
+        ext = Path(f.file_path).suffix or ".jpg"
         file_url = f"https://api.telegram.org/file/bot{settings.TELEGRAM_BOT_TOKEN}/{f.file_path}"
 
         try:
-            async with httpx.AsyncClient(timeout=httpx.Timeout(90.0, connect=20.0)) as client:  # ✅ увеличены таймауты
-                resp = await client.get(file_url)
-                resp.raise_for_status()
-                content = resp.content
-                
+            filename, size, deduplicated = await input_store.store_stream(
+                http, file_url, ext=ext, max_size=max_size
+            )
         except (httpx.TimeoutException, httpx.ConnectTimeout, httpx.ReadTimeout) as e:
             # ✅ Таймауты httpx - retry
             if attempt < max_attempts:
@@ -134,38 +178,22 @@ async def _tg_file_to_public_url(bot: Bot, file_id: str, *, cid: str) -> str:
                 continue
             raise ValueError(f"download_error:{str(e)[:100]}")
 
-        # ✅ Сохранение файла
-        temp_dir = Path("/app/temp_inputs")
-        
-        try:
-            temp_dir.mkdir(exist_ok=True, parents=True)
         except OSError as e:
             if e.errno == 28:
-                log.error(_j("queue.disk_full", cid=cid, error="No space left on device"))
+                log.error(_j("queue.disk_full_write", cid=cid, file_id=file_id))
                 raise OSError("Disk full") from e
             raise
         
-        ext = Path(f.file_path).suffix or ".jpg"
-        filename = f"{uuid4().hex}{ext}"
-        filepath = temp_dir / filename
-        
-        try:
-            with open(filepath, "wb") as out:
-                out.write(content)
-        except OSError as e:
-            if e.errno == 28:
-                log.error(_j("queue.disk_full_write", cid=cid, file=filename))
-                raise OSError("Disk full") from e
-            raise
-        
-        public_url = f"{settings.PUBLIC_BASE_URL.rstrip('/')}/proxy/image/{filename}"
+        await input_store.index(filename, file_id=file_id, file_unique_id=f.file_unique_id)
+        public_url = input_store.public_url(filename)
         
         log.info(_j(
             "queue.file_saved", 
             cid=cid, 
             filename=filename, 
-            size=len(content),
-            size_mb=round(len(content) / (1024 * 1024), 2),
+            deduplicated=deduplicated,
+            size=size,
+            size_mb=round(size / (1024 * 1024), 2),
             ext=ext,
             public_url=public_url,
             attempts=attempt  # ✅ логируем количество попыток
@@ -176,27 +204,134 @@ async def _tg_file_to_public_url(bot: Bot, file_id: str, *, cid: str) -> str:
     # Не должно дойти сюда
     raise ValueError("max_retries_exceeded")
 
+async def _ingest_photos(
+    bot: Bot,
+    file_ids: List[str],
+    *,
+    cid: str,
+    http: Optional[httpx.AsyncClient],
+) -> List[Any]:
+    """
+    ✅ Все фото альбома качаются параллельно (не больше TG_INGEST_CONCURRENCY разом).
+    Результат в порядке file_ids: public_url или исключение этого файла.
+    """
+    sem = asyncio.Semaphore(max(1, settings.TG_INGEST_CONCURRENCY))
+
+    async def _one(fid: str) -> str:
+        async with sem:
+            return await _tg_file_to_public_url(bot, fid, cid=cid, http=http)
+
+    return await asyncio.gather(*(_one(fid) for fid in file_ids), return_exceptions=True)
+
+
+# ✅ Предзагрузка: фото качаются в input_store, пока пользователь пишет промт
+
+
+async def preingest_photos(ctx: dict[str, Bot], chat_id: int, file_ids: List[str]) -> Dict[str, Any]:
+    """
+    arq job: качает фото сразу после приёма в input_store (индекс input:fid:),
+    чтобы process_generation сразу шёл в createTask.
+    """
+    bot: Bot = ctx["bot"]
+    cid = uuid4().hex[:12]
+
+    claimed: List[str] = []
+    for fid in file_ids[:5]:
+        if await input_store.claim_ingest(fid):
+            claimed.append(fid)
+    if not claimed:
+        return {"ok": True, "claimed": 0}
+
+    started = time.monotonic()
+    try:
+        results = await _ingest_photos(bot, claimed, cid=cid, http=ctx.get("tg_http"))
+    finally:
+        for fid in claimed:
+            await input_store.release_ingest(fid)
+    ok = 0
+    for fid, res in zip(claimed, results):
+        if isinstance(res, BaseException):
+            log.warning(_j("queue.preingest_failed", cid=cid, chat_id=chat_id, file_id=fid, error=str(res)[:100]))
+            continue
+        ok += 1
+
+    log.info(_j(
+        "queue.preingest_done",
+        cid=cid,
+        chat_id=chat_id,
+        files=len(claimed),
+        ok=ok,
+        duration_ms=int((time.monotonic() - started) * 1000),
+    ))
+    return {"ok": True, "claimed": len(claimed), "ingested": ok}
+
+
+async def _preingested_urls(file_ids: List[str], *, cid: str) -> Dict[str, str]:
+    """
+    public_url уже предзагруженных фото (из input_store, файл проверен на диске).
+    Если предзагрузка ещё идёт — ждём её до PREINGEST_WAIT_S, чтобы не
+    качать файл второй раз.
+    """
+    if not file_ids or not settings.PREINGEST_ENABLED:
+        return {}
+    deadline = time.monotonic() + settings.PREINGEST_WAIT_S
+    found: Dict[str, str] = {}
+
+    try:
+        while True:
+            rest = [fid for fid in file_ids if fid not in found]
+            for fid in rest:
+                name = await input_store.lookup(file_id=fid)
+                if name:
+                    found[fid] = input_store.public_url(name)
+            rest = [fid for fid in rest if fid not in found]
+            if not any(await input_store.ingest_pending(rest)) or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(0.25)
+    except Exception as e:
+        log.warning(_j("queue.preingest_lookup_failed", cid=cid, error=str(e)[:100]))
+
+    if found:
+        log.info(_j("queue.preingest_hit", cid=cid, hit=len(found), total=len(file_ids)))
+    return found
+
+
+async def enqueue_preingest(chat_id: int, file_ids: List[str]) -> None:
+    if not settings.PREINGEST_ENABLED or not file_ids:
+        return
+    await get_arq_client().enqueue_job("preingest_photos", chat_id, file_ids)
+
+
 async def enqueue_generation(
     chat_id: int,
     prompt: str,
     photos: List[str],
     aspect_ratio: Optional[str] = None
 ) -> None:
-    redis_pool = await create_pool(
-        RedisSettings(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            database=settings.REDIS_DB_CACHE,
-        )
-    )
-    try:
-            await redis_pool.enqueue_job("process_generation", chat_id, prompt, photos, aspect_ratio)
-    finally:
-            await redis_pool.close()
+    # ✅ Через справедливый планировщик (services.gen_scheduler), а не прямо в FIFO arq
+    if settings.GEN_SCHED_ENABLED:
+        await submit_generation(chat_id, prompt, photos, aspect_ratio)
+        return
+    await get_arq_client().enqueue_job("process_generation", chat_id, prompt, photos, aspect_ratio)
 
 
 async def startup(ctx: dict[str, Bot]):
     ctx["bot"] = Bot(token=settings.TELEGRAM_BOT_TOKEN)
+    install_outbound_scheduler(ctx["bot"])
+    # Для deliver_result: подписи результата в HTML (та же HTTP-сессия)
+    ctx["bot_html"] = Bot(
+        token=settings.TELEGRAM_BOT_TOKEN,
+        session=ctx["bot"].session,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+    ctx["kie"] = KieClient()
+    ctx["tg_http"] = new_tg_http_client()
+    ctx["result_http"] = new_download_client()
+    await init_redis_pools()
+    # Метрики воркера видны в /health/metrics web-процесса только через Redis
+    ctx["metrics_task"] = asyncio.create_task(
+        metrics.publish_loop(get_redis(POOL_CACHE), metrics.process_source("worker"))
+    )
 
     if settings.ADMIN_ID:
         from core.telegram_logger import TelegramLogHandler
@@ -212,6 +347,23 @@ async def shutdown(ctx: dict[str, Bot]):
     bot: Bot = ctx.get("bot")
     if bot:
         await bot.session.close()
+
+    metrics_task: Optional[asyncio.Task] = ctx.pop("metrics_task", None)
+    if metrics_task is not None:
+        metrics_task.cancel()
+
+    kie: Optional[KieClient] = ctx.pop("kie", None)
+    if kie is not None:
+        await kie.aclose()
+
+    for key in ("tg_http", "result_http"):
+        client: Optional[httpx.AsyncClient] = ctx.pop(key, None)
+        if client is not None:
+            await client.aclose()
+
+    image_service.shutdown_image_pool()
+    
+    await close_redis_pools()
     
     # ✅ Закрываем все асинхронные ресурсы
     import gc
@@ -235,11 +387,8 @@ async def shutdown(ctx: dict[str, Bot]):
 
 
 async def _clear_waiting_message(bot: Bot, chat_id: int) -> None:
-    r = aioredis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_FSM)
     try:
-        storage = RedisStorage(redis=r, key_builder=DefaultKeyBuilder(with_bot_id=True))
-        me = await bot.get_me()
-        fsm = FSMContext(storage=storage, key=StorageKey(me.id, chat_id, chat_id))
+        fsm = external_fsm(chat_id)
         data = await fsm.get_data()
         msg_id = data.get("wait_msg_id")
         if msg_id:
@@ -250,67 +399,33 @@ async def _clear_waiting_message(bot: Bot, chat_id: int) -> None:
             await fsm.update_data(wait_msg_id=None)
     except Exception:
         pass
-    finally:
-        await r.aclose()
-
-
-async def _maybe_refund_if_deducted(
-    chat_id: int,
-    task_uuid: str,
-    amount: int,
-    cid: str,
-    reason: str
-) -> None:
-    rcache = aioredis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_CACHE)
-    try:
-        debited = await rcache.get(f"credits:debited:{task_uuid}")
-    except Exception:
-        debited = None
-    finally:
-        await rcache.aclose()
-    
-    if not debited:
-        log.info(_j("refund.skipped_not_debited", cid=cid, chat_id=chat_id, task_uuid=task_uuid))
-        return
 
-    try:
-        async with SessionLocal() as s:
-            q = await s.execute(select(User).where(User.chat_id == chat_id))
-            u = q.scalar_one_or_none()
-            if u is not None:
-                await s.execute(
-                    update(User)
-                    .where(User.id == u.id)
-                    .values(balance_credits=User.balance_credits + amount)
-                )
-                await s.commit()
-                log.info(_j("refund.ok", cid=cid, chat_id=chat_id, task_uuid=task_uuid, amount=amount, reason=reason))
-                
-                # ✅ ИСПРАВЛЕНО: Redis с гарантией закрытия
-                rcache2 = aioredis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_CACHE)
-                try:
-                    await rcache2.delete(f"credits:debited:{task_uuid}")
-                finally:
-                    await rcache2.aclose()
-                return
-            else:
-                log.warning(_j("refund.user_not_found", cid=cid, chat_id=chat_id, task_uuid=task_uuid))
-    except Exception:
-        log.exception(_j("refund.db_error", cid=cid, task_uuid=task_uuid))
 
 async def process_generation(
     ctx: dict[str, Bot],
     chat_id: int,
     prompt: str,
     photos: List[str],
-    aspect_ratio: Optional[str] = None
+    aspect_ratio: Optional[str] = None,
+    *,
+    sched_slot: Optional[str] = None,
+    sched_class: Optional[str] = None,
+    submitted_at: Optional[float] = None,
 ) -> Dict[str, Any] | None:
     """
     ✅ УЛУЧШЕНО: учитывает модель пользователя
+    photos — Telegram file_id или готовые URL (правка прошлого результата)
+    sched_slot — слот планировщика генераций, освобождается в finally
     """
+    observe_queue_wait(sched_class, submitted_at)
     bot: Bot = ctx["bot"]
-    api = KieClient()
+    # ✅ Общий клиент воркера; свой — только если startup его не создал
+    own_api = "kie" not in ctx
+    api: KieClient = ctx["kie"] if not own_api else KieClient()
     cid = uuid4().hex[:12]
+    # ✅ Резерв кредитов: возвращается, если задача так и не ушла в KIE
+    hold_id: Optional[int] = None
+    submitted = False
 
     try:
         async with SessionLocal() as s:
@@ -338,7 +453,8 @@ async def process_generation(
             from services.pricing import credits_per_generation
             credits_needed = credits_per_generation(user_model)
 
-            if user.balance_credits < credits_needed:
+            hold_id = await hold_credits(user.id, credits_needed, key=cid)
+            if hold_id is None:
                 model_name = "Pro" if user_model == "pro" else "Standard"
                 await bot.send_message(
                     chat_id, 
@@ -354,10 +470,21 @@ async def process_generation(
             download_errors = []
             file_too_big_count = 0
             
-            for fid in (photos or [])[:5]:
+            file_ids = (photos or [])[:5]
+            # ✅ Правка результата: вход — уже готовый URL (KIE / proxy), качать нечего
+            ready = {fid: fid for fid in file_ids if fid.startswith(("http://", "https://"))}
+            ready.update(await _preingested_urls([fid for fid in file_ids if fid not in ready], cid=cid))
+            missing = [fid for fid in file_ids if fid not in ready]
+            fetched = dict(zip(missing, await _ingest_photos(bot, missing, cid=cid, http=ctx.get("tg_http"))))
+            results = [ready[fid] if fid in ready else fetched[fid] for fid in file_ids]
+            
+            for fid, res in zip(file_ids, results):
+                if not isinstance(res, BaseException):
+                    image_urls.append(res)
+                    continue
                 try:
-                    url = await _tg_file_to_public_url(bot, fid, cid=cid)
-                    image_urls.append(url)
+                    # Разбираем ошибку конкретного файла теми же ветками, что и раньше
+                    raise res
                 except ValueError as e:
                     if "file_too_big" in str(e):
                         log.warning(_j("queue.file_too_big_skip", cid=cid, file_id=fid))
@@ -444,6 +571,7 @@ async def process_generation(
                     user_model=user_model,  # ✅ ДОБАВЛЕНО
                     cid=cid,
                 )
+                submitted = True
             except httpx.HTTPError as e:
                 code = getattr(getattr(e, "response", None), "status_code", None)
                 log.warning(_j("queue.kie_http_error", cid=cid, status_code=code))
@@ -454,6 +582,23 @@ async def process_generation(
                     pass
                 return {"ok": False, "error": f"kie_http_{code or 'unknown'}"}
 
+            # ✅ Контекст для доставки пишем до INSERT: колбэк KIE может прийти раньше коммита
+            try:
+                wait_msg_id = (await external_fsm(chat_id).get_data()).get("wait_msg_id")
+            except Exception:
+                wait_msg_id = None
+            await save_task_context(
+                task_uuid,
+                user_id=user.id,
+                chat_id=chat_id,
+                prompt=prompt,
+                model=user_model,
+                credits=credits_needed,
+                input_urls=image_urls,
+                wait_msg_id=wait_msg_id,
+                hold_id=hold_id,
+            )
+
             try:
                 task = Task(
                     user_id=user.id,
@@ -463,11 +608,14 @@ async def process_generation(
                     delivered=False
                 )
                 s.add(task)
+                await s.flush()
+                await attach_hold(s, hold_id, task.id)
                 await s.commit()
-                await s.refresh(task)
             except Exception:
                 log.warning(_j("queue.db_write_failed", cid=cid, task_uuid=task_uuid))
 
+            await input_store.retain_for_task(task_uuid, image_urls)
+
         return {"ok": True, "task_uuid": task_uuid}
 
     # ... остальные except БЕЗ ИЗМЕНЕНИЙ ...
@@ -476,9 +624,6 @@ async def process_generation(
         log.error(_j("queue.kie_error", cid=cid, err=str(e)[:500]))
         await _clear_waiting_message(bot, chat_id)
         
-        if 'task_uuid' in locals():
-            await _maybe_refund_if_deducted(chat_id, task_uuid, credits_needed, cid, reason="kie_error")
-        
         try:
             if "file type not supported" in error_str or "not supported" in error_str:
                 await bot.send_message(
@@ -543,8 +688,6 @@ async def process_generation(
     except Exception:
         log.exception(_j("queue.fatal", cid=cid))
         await _clear_waiting_message(bot, chat_id)
-        if 'task_uuid' in locals():
-            await _maybe_refund_if_deducted(chat_id, task_uuid, credits_needed, cid, reason="internal")
         try:
             await bot.send_message(chat_id, "⚠️ Ошибка. Напишите @guard_gpt")
         except Exception:
@@ -552,25 +695,63 @@ async def process_generation(
         return {"ok": False, "error": "internal"}
     
     finally:
-        await api.aclose()
+        if hold_id is not None and not submitted:
+            await release_hold(hold_id, reason="not_submitted")
+        if own_api:
+            await api.aclose()
+        await finish_generation(ctx, sched_slot)
         
 class WorkerSettings:
-    functions = [process_generation, broadcast_send]
+    """
+    Интерактивный воркер: генерации (через gen_scheduler), доставка результатов.
+    Рассылка и обслуживание — в BackgroundWorkerSettings (своя очередь).
+    """
+    functions = [process_generation, preingest_photos, deliver_result, redeliver_result, dispatch_generations]
     on_startup = startup
     on_shutdown = shutdown
-    redis_settings = RedisSettings(
-        host=settings.REDIS_HOST,
-        port=settings.REDIS_PORT,
-        database=settings.REDIS_DB_CACHE
-    )
+    redis_settings = ARQ_REDIS_SETTINGS
     job_timeout = 259200
     keep_result = 0
+    # Слоты планировщика генераций считаются от этого же значения (GEN_SCHED_SLOTS)
+    max_jobs = settings.ARQ_WORKER_MAX_JOBS
     
     # ✅ ДОБАВЛЕНО: регистрация cron задач
+    cron_jobs = [
+        # Задачи без колбэка KIE — опрос recordInfo (каждую минуту)
+        cron(reconcile_stuck_tasks, second=30, run_at_startup=False),
+        
+        # Outbox доставки: результаты, которые так и не ушли в Telegram
+        cron(drain_delivery_outbox, minute=set(range(2, 60, 5)), run_at_startup=False),
+        
+        # Планировщик генераций: страховочный проход (потерянный пинок, истёкшие слоты)
+        cron(dispatch_generations_cron, second=set(range(5, 60, 10)), run_at_startup=True),
+    ]
+
+
+class BackgroundWorkerSettings:
+    """
+    Фоновый воркер (arq services.queue.BackgroundWorkerSettings): рассылка и
+    обслуживание в очереди BACKGROUND_QUEUE — генерациям слоты не занимают.
+    """
+    functions = [broadcast_send]
+    queue_name = BACKGROUND_QUEUE
+    on_startup = startup
+    on_shutdown = shutdown
+    redis_settings = ARQ_REDIS_SETTINGS
+    job_timeout = 259200
+    keep_result = 0
+    max_jobs = 4
+
     cron_jobs = [
         # Очистка БД каждые 10 минут
         cron(cleanup_database_task, minute={0, 10, 20, 30, 40, 50}, run_at_startup=True),
         
         # Бэкап БД каждый час (в :05 минут каждого часа)
         cron(backup_database_task, minute=5, run_at_startup=False),
+        
+        # Входные фото без живой записи в Redis
+        cron(input_store.sweep_inputs, minute={7, 17, 27, 37, 47, 57}, run_at_startup=False),
+        
+        # Резервы кредитов без колбэка KIE
+        cron(release_stale_holds, minute={3, 13, 23, 33, 43, 53}, run_at_startup=False),
     ]    
@@ -0,0 +1,162 @@
+"""
+Reconciler зависших задач: колбэк KIE потерялся — спрашиваем recordInfo сами.
+
+Cron воркера раз в минуту берёт задачи в queued старше RECONCILE_AFTER_S
+(и моложе RECONCILE_MAX_AGE_S — дальше их закрывает cleanup_database_task),
+опрашивает KIE параллельно (не больше RECONCILE_CONCURRENCY запросов) через
+глобальный rate limiter, а готовый результат отдаёт в тот же deliver_result,
+что и вебхук. Интервал опроса задачи растёт от RECONCILE_POLL_MIN_S вдвое
+до RECONCILE_POLL_MAX_S (kie:poll:{task_uuid}).
+
+Метрики: reconcile.callback_missed — KIE уже закончил, а колбэка не было;
+reconcile.recovered — доставка по такой задаче поставлена в очередь.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select
+
+from core import metrics
+from core.config import settings
+from core.redis_pools import POOL_CACHE, get_redis
+from db.engine import SessionLocal
+from db.models import Task, User
+from services.delivery import deliver_result, forget_callback, remember_callback
+from vendors.kie import KieClient, KieError
+from vendors.kie_rate_limiter import bucket_for_model
+
+log = logging.getLogger("reconciler")
+
+_POLL_KEY = "kie:poll:"
+_TERMINAL = ("success", "fail")
+
+
+def _j(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+async def _due(r, task_uuid: str, now: float) -> Optional[int]:
+    """Номер опроса, если пора опрашивать; None — ещё рано"""
+    n, next_at = await r.hmget(f"{_POLL_KEY}{task_uuid}", "n", "next_at")
+    if next_at is not None and float(next_at) > now:
+        return None
+    return int(n or 0)
+
+
+async def _schedule(r, task_uuid: str, n: int, now: float) -> None:
+    interval = min(settings.RECONCILE_POLL_MIN_S * (2 ** n), settings.RECONCILE_POLL_MAX_S)
+    key = f"{_POLL_KEY}{task_uuid}"
+    await r.hset(key, mapping={"n": n + 1, "next_at": now + interval})
+    await r.expire(key, settings.RECONCILE_MAX_AGE_S)
+
+
+async def _callback_seen(r, task_uuid: str) -> bool:
+    return bool(await r.exists(*(f"kie:cb:{task_uuid}:{s}" for s in _TERMINAL)))
+
+
+async def _enqueue_delivery(ctx: Dict[str, Any], task_uuid: str, status: Dict[str, Any]) -> None:
+    args = (
+        task_uuid,
+        status["state"],
+        status.get("result_urls") or [],
+        status.get("fail_code"),
+        status.get("fail_msg"),
+        time.time(),
+    )
+    arq = ctx.get("redis")
+    if arq is not None:
+        await arq.enqueue_job("deliver_result", *args, _job_id=f"deliver:{task_uuid}")
+    else:
+        await deliver_result(ctx, *args)
+
+
+async def _reconcile_one(ctx: Dict[str, Any], api: KieClient, task_uuid: str, model: str) -> str:
+    r = get_redis(POOL_CACHE)
+    now = time.time()
+    n = await _due(r, task_uuid, now)
+    if n is None:
+        return "not_due"
+    if await _callback_seen(r, task_uuid):
+        return "callback_seen"
+
+    await _schedule(r, task_uuid, n, now)
+    try:
+        status = await api.get_status(task_uuid, cid=f"reconcile:{n}", bucket=bucket_for_model(model))
+    except KieError as e:
+        metrics.inc("reconcile.poll_error")
+        log.warning(_j("reconcile.poll_error", task_uuid=task_uuid, error=str(e)[:200]))
+        return "error"
+
+    state = status.get("state")
+    if state not in _TERMINAL:
+        return "running"
+
+    metrics.inc("reconcile.callback_missed")
+    # Колбэк мог прийти, пока шёл опрос: SET NX решает, кто доставляет
+    if not await remember_callback(task_uuid, state, {"source": "reconciler", **(status.get("raw") or {})}):
+        return "callback_seen"
+    try:
+        await _enqueue_delivery(ctx, task_uuid, status)
+    except Exception:
+        await forget_callback(task_uuid, state)
+        raise
+    metrics.inc("reconcile.recovered")
+    log.warning(_j("reconcile.recovered", task_uuid=task_uuid, state=state, polls=n + 1))
+    return "recovered"
+
+
+async def _stuck_tasks() -> List[Any]:
+    now = datetime.utcnow()
+    async with SessionLocal() as s:
+        return (await s.execute(
+            select(Task.task_uuid, User.model_preference)
+            .join(User, User.id == Task.user_id)
+            .where(
+                Task.status == "queued",
+                Task.delivered.is_(False),
+                Task.created_at < now - timedelta(seconds=settings.RECONCILE_AFTER_S),
+                Task.created_at > now - timedelta(seconds=settings.RECONCILE_MAX_AGE_S),
+            )
+            .order_by(Task.created_at)
+            .limit(settings.RECONCILE_BATCH)
+        )).all()
+
+
+async def reconcile_stuck_tasks(ctx: Dict[str, Any]) -> dict:
+    """
+    ✅ Cron воркера: опрос KIE по задачам без колбэка
+    """
+    rows = await _stuck_tasks()
+    if not rows:
+        return {"ok": True, "checked": 0}
+
+    own_api = "kie" not in ctx
+    api: KieClient = ctx["kie"] if not own_api else KieClient()
+    sem = asyncio.Semaphore(max(1, settings.RECONCILE_CONCURRENCY))
+
+    async def one(task_uuid: str, model: Optional[str]) -> str:
+        async with sem:
+            try:
+                return await _reconcile_one(ctx, api, task_uuid, model or "standard")
+            except Exception as e:
+                log.warning(_j("reconcile.task_error", task_uuid=task_uuid, error=str(e)[:200]))
+                return "error"
+
+    try:
+        outcomes = await asyncio.gather(*(one(t, m) for t, m in rows))
+    finally:
+        if own_api:
+            await api.aclose()
+
+    summary: Dict[str, int] = {}
+    for o in outcomes:
+        summary[o] = summary.get(o, 0) + 1
+    metrics.set_gauge("reconcile.stuck", float(len(rows)))
+    log.info(_j("reconcile.done", checked=len(rows), **summary))
+    return {"ok": True, "checked": len(rows), **summary}
@@ -0,0 +1,141 @@
+"""
+Контекст задачи генерации в Redis (task:ctx:{task_uuid}).
+
+Пишется воркером сразу после createTask, поэтому доставке результата
+не нужны SELECT задачи и пользователя: chat_id, промт, модель и цена
+фиксируются на момент отправки (смена /model во время генерации не
+меняет списание). При промахе (истёк TTL, Redis недоступен, задачи
+до этого релиза) контекст собирается из MySQL, как раньше.
+"""
+from __future__ import annotations
+
+import json
+import logging
+from typing import Any, Dict, Iterable, Optional
+
+from sqlalchemy import select
+
+from core import metrics
+from core.config import settings
+from core.redis_pools import POOL_CACHE, get_redis
+from db.engine import SessionLocal
+from db.models import Task, User
+from services import input_store
+from services.credit_ledger import find_task_hold
+from services.pricing import credits_per_generation
+
+log = logging.getLogger("task_context")
+
+_KEY = "task:ctx:"
+
+
+def _j(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+def _s(v) -> str:
+    return v.decode() if isinstance(v, bytes) else str(v)
+
+
+async def save_task_context(
+    task_uuid: str,
+    *,
+    user_id: int,
+    chat_id: int,
+    prompt: str,
+    model: str,
+    credits: int,
+    input_urls: Iterable[str] = (),
+    wait_msg_id: Optional[int] = None,
+    hold_id: Optional[int] = None,
+) -> None:
+    inputs = [n for n in (input_store.filename_from_url(u) for u in input_urls) if n]
+    mapping = {
+        "user_id": user_id,
+        "chat_id": chat_id,
+        "prompt": prompt,
+        "model": model,
+        "credits": credits,
+        "inputs": json.dumps(inputs),
+        "wait_msg_id": wait_msg_id or 0,
+        "hold_id": hold_id or 0,
+        "delivered": 0,
+    }
+    try:
+        async with get_redis(POOL_CACHE).pipeline(transaction=False) as pipe:
+            pipe.hset(f"{_KEY}{task_uuid}", mapping=mapping)
+            pipe.expire(f"{_KEY}{task_uuid}", settings.TASK_CTX_TTL_S)
+            await pipe.execute()
+    except Exception as e:
+        log.warning(_j("task_ctx.save_failed", task_uuid=task_uuid, error=str(e)[:100]))
+
+
+def _from_hash(raw: Dict[Any, Any]) -> Dict[str, Any]:
+    d = {_s(k): _s(v) for k, v in raw.items()}
+    return {
+        "user_id": int(d["user_id"]),
+        "chat_id": int(d["chat_id"]),
+        "prompt": d.get("prompt", ""),
+        "model": d.get("model") or "standard",
+        "credits": int(d["credits"]),
+        "inputs": json.loads(d.get("inputs") or "[]"),
+        "wait_msg_id": int(d.get("wait_msg_id") or 0) or None,
+        "hold_id": int(d.get("hold_id") or 0) or None,
+        "delivered": d.get("delivered") == "1",
+    }
+
+
+async def _from_db(task_uuid: str) -> Optional[Dict[str, Any]]:
+    async with SessionLocal() as s:
+        row = (await s.execute(
+            select(Task, User).join(User, User.id == Task.user_id).where(Task.task_uuid == task_uuid)
+        )).first()
+        if row is None:
+            return None
+        task, user = row
+        hold_id = await find_task_hold(s, task.id)
+    model = user.model_preference or "standard"
+    return {
+        "user_id": user.id,
+        "chat_id": user.chat_id,
+        "prompt": task.prompt,
+        "model": model,
+        "credits": credits_per_generation(model),
+        "inputs": [],
+        "wait_msg_id": None,
+        "hold_id": hold_id,
+        "delivered": bool(task.delivered),
+    }
+
+
+async def load_task_context(task_uuid: str) -> Optional[Dict[str, Any]]:
+    """
+    ✅ Контекст задачи: из Redis, при промахе — из MySQL (Task + User).
+    None — задачи нет нигде.
+    """
+    try:
+        raw = await get_redis(POOL_CACHE).hgetall(f"{_KEY}{task_uuid}")
+    except Exception as e:
+        log.warning(_j("task_ctx.load_failed", task_uuid=task_uuid, error=str(e)[:100]))
+        raw = None
+    if raw:
+        try:
+            ctx = _from_hash(raw)
+            metrics.inc("task_ctx.hit")
+            return ctx
+        except (KeyError, ValueError) as e:
+            log.warning(_j("task_ctx.corrupt", task_uuid=task_uuid, error=str(e)[:100]))
+
+    metrics.inc("task_ctx.miss")
+    return await _from_db(task_uuid)
+
+
+async def mark_task_delivered(task_uuid: str) -> None:
+    """Повторный колбэк увидит delivered без похода в БД (только если запись ещё жива)"""
+    key = f"{_KEY}{task_uuid}"
+    try:
+        r = get_redis(POOL_CACHE)
+        if await r.exists(key):
+            await r.hset(key, "delivered", 1)
+    except Exception as e:
+        log.warning(_j("task_ctx.mark_failed", task_uuid=task_uuid, error=str(e)[:100]))
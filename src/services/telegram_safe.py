@@ -84,12 +84,9 @@ async def safe_send_text(
                 return None
                 
         except TelegramRetryAfter as e:
-            if attempt < max_attempts:
-                await asyncio.sleep(e.retry_after)
-                continue
-            else:
-                log.exception(f"send_message failed after retry chat_id={chat_id}")
-                return None
+            # Flood-wait уже ждал и повторял OutboundScheduler (core.tg_outbound)
+            log.warning(f"send_message flood-wait {e.retry_after}s, giving up chat_id={chat_id}")
+            return None
                 
         except TelegramForbiddenError:
             await _maybe_delete_user(chat_id)
@@ -196,7 +193,7 @@ async def safe_send_text(
 async def safe_send_photo(
     bot: Bot,
     chat_id: int,
-    photo: Union[FSInputFile, bytes],
+    photo: Union[FSInputFile, bytes, str],
     caption: Optional[str] = None,
     reply_markup: Optional[InlineKeyboardMarkup] = None,
     parse_mode: str = "HTML",
@@ -266,18 +263,20 @@ async def safe_send_photo(
             #     log.exception(f"send_photo failed chat_id={chat_id}")
             #     return None
             
+            # ✅ URL/file_id, который Telegram не принял, повторять бессмысленно
+            if isinstance(photo, str):
+                log.warning(f"send_photo by URL rejected chat_id={chat_id}: {error_msg[:100]}")
+                return None
+
             # ✅ Просто логируем ошибку
             if attempt == 3:
                 log.exception(f"send_photo failed chat_id={chat_id}")
                 return None
         
         except TelegramRetryAfter as e:
-            if attempt < 3:
-                await asyncio.sleep(e.retry_after)
-                continue
-            else:
-                log.exception(f"send_photo failed after retry chat_id={chat_id}")
-                return None
+            # Flood-wait уже ждал и повторял OutboundScheduler (core.tg_outbound)
+            log.warning(f"send_photo flood-wait {e.retry_after}s, giving up chat_id={chat_id}")
+            return None
         
         except TelegramForbiddenError:
             await _maybe_delete_user(chat_id)
@@ -354,12 +353,9 @@ async def safe_send_document(
                 return None
         
         except TelegramRetryAfter as e:
-            if attempt < 3:
-                await asyncio.sleep(e.retry_after)
-                continue
-            else:
-                log.exception(f"send_document failed after retry chat_id={chat_id}")
-                return None
+            # Flood-wait уже ждал и повторял OutboundScheduler (core.tg_outbound)
+            log.warning(f"send_document flood-wait {e.retry_after}s, giving up chat_id={chat_id}")
+            return None
         
         except TelegramForbiddenError:
             await _maybe_delete_user(chat_id)
@@ -377,6 +373,43 @@ async def safe_send_document(
     
     return None
 
+
+async def safe_send_document_id(
+    bot: Bot,
+    chat_id: int,
+    file_id: str,
+    caption: Optional[str] = None,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> Optional[Message]:
+    """
+    ✅ Повторная отправка уже загруженного в Telegram файла по file_id
+    (без upload). None — file_id недействителен или отправка не удалась:
+    вызывающий откатывается на safe_send_document с диска.
+    """
+    for attempt in range(1, 4):
+        try:
+            return await bot.send_document(chat_id, document=file_id, caption=caption, reply_markup=reply_markup)
+        except (TelegramServerError, TelegramNetworkError):
+            if attempt < 3:
+                await asyncio.sleep(3 * attempt)
+                continue
+            log.warning(f"send_document by file_id failed after 3 attempts chat_id={chat_id}")
+            return None
+        except TelegramRetryAfter as e:
+            # Flood-wait уже ждал и повторял OutboundScheduler (core.tg_outbound)
+            log.warning(f"send_document by file_id flood-wait {e.retry_after}s, giving up chat_id={chat_id}")
+            return None
+        except TelegramForbiddenError:
+            await _maybe_delete_user(chat_id)
+            return None
+        except TelegramBadRequest as e:
+            log.warning(f"send_document by file_id rejected chat_id={chat_id}: {e}")
+            return None
+        except Exception:
+            log.exception(f"send_document by file_id failed chat_id={chat_id}")
+            return None
+    return None
+
 async def safe_edit_text(
     message: Message,
     text: str,
@@ -406,16 +439,8 @@ async def safe_edit_text(
             return message
         log.exception("edit_text bad request")
     except TelegramRetryAfter as e:
-        await asyncio.sleep(e.retry_after)
-        try:
-            return await message.edit_text(
-                text, 
-                reply_markup=reply_markup, 
-                parse_mode=parse_mode,
-                disable_web_page_preview=disable_web_page_preview
-            )
-        except Exception:
-            log.exception("edit_text failed after retry")
+        # Flood-wait уже ждал и повторял OutboundScheduler (core.tg_outbound)
+        log.warning(f"edit_text flood-wait {e.retry_after}s, giving up")
     except TelegramForbiddenError:
         return None
     except Exception:
@@ -433,11 +458,8 @@ async def safe_edit_reply_markup(
             return message
         log.exception("edit_reply_markup bad request")
     except TelegramRetryAfter as e:
-        await asyncio.sleep(e.retry_after)
-        try:
-            return await message.edit_reply_markup(reply_markup=reply_markup)
-        except Exception:
-            log.exception("edit_reply_markup failed after retry")
+        # Flood-wait уже ждал и повторял OutboundScheduler (core.tg_outbound)
+        log.warning(f"edit_reply_markup flood-wait {e.retry_after}s, giving up")
     except TelegramForbiddenError:
         return None
     except Exception:
@@ -471,13 +493,8 @@ async def safe_send_video(
             video_file = video
         return await bot.send_video(chat_id, video=video_file, caption=caption, reply_markup=reply_markup, parse_mode=parse_mode)
     except TelegramRetryAfter as e:
-        await asyncio.sleep(e.retry_after)
-        try:
-            return await bot.send_video(chat_id, video=video_file, caption=caption, reply_markup=reply_markup, parse_mode=parse_mode)
-        except TelegramForbiddenError:
-            await _maybe_delete_user(chat_id)
-        except Exception:
-            log.exception("send_video failed after retry chat_id=%s", chat_id)
+        # Flood-wait уже ждал и повторял OutboundScheduler (core.tg_outbound)
+        log.warning("send_video flood-wait %ss, giving up chat_id=%s", e.retry_after, chat_id)
     except TelegramForbiddenError:
         await _maybe_delete_user(chat_id)
     except Exception as e:
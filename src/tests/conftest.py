@@ -0,0 +1,23 @@
+import os
+import sys
+
+# Settings() требует обязательные переменные окружения — для тестов хватит заглушек
+for _name in (
+    "TELEGRAM_BOT_TOKEN",
+    "PUBLIC_BASE_URL",
+    "WEBHOOK_SECRET_TOKEN",
+    "FREEPIK_API_KEY",
+    "FREEPIK_WEBHOOK_SECRET",
+    "KIE_API_KEY",
+    "RUNBLOB_API_KEY",
+    "YOOKASSA_SHOP_ID",
+    "YOOKASSA_SECRET_KEY",
+    "TOPUP_RETURN_URL",
+    "DB_HOST",
+    "DB_USER",
+    "DB_PASSWORD",
+    "DB_NAME",
+):
+    os.environ.setdefault(_name, "test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
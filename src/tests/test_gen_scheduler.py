@@ -0,0 +1,224 @@
+"""
+gen_scheduler: N разных пользователей при N ≤ слотов воркеров выпускаются
+в arq одновременно, а не по одному.
+
+Redis подменён минимальной in-memory реализацией команд, которые использует
+планировщик (Lua-скрипты модуля повторены на Python).
+"""
+import asyncio
+import time
+from typing import Any, Dict, List
+
+import pytest
+
+from core.config import settings
+from services import gen_scheduler
+from services.queue import WorkerSettings
+
+
+def _b(v: Any) -> bytes:
+    return v if isinstance(v, bytes) else str(v).encode()
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.kv: Dict[bytes, bytes] = {}
+        self.lists: Dict[bytes, List[bytes]] = {}
+        self.sets: Dict[bytes, set] = {}
+        self.hashes: Dict[bytes, Dict[bytes, bytes]] = {}
+        self.zsets: Dict[bytes, Dict[bytes, float]] = {}
+
+    # strings
+    async def set(self, key, value, nx=False, ex=None, px=None):
+        key = _b(key)
+        if nx and key in self.kv:
+            return None
+        self.kv[key] = _b(value)
+        return True
+
+    async def get(self, key):
+        return self.kv.get(_b(key))
+
+    async def delete(self, *keys):
+        n = 0
+        for key in map(_b, keys):
+            for store in (self.kv, self.lists, self.sets, self.hashes, self.zsets):
+                if store.pop(key, None) is not None:
+                    n += 1
+        return n
+
+    async def exists(self, *keys):
+        return sum(1 for k in map(_b, keys) if k in self.kv or k in self.lists)
+
+    async def expire(self, key, seconds):
+        return True
+
+    # lists
+    async def rpush(self, key, *values):
+        lst = self.lists.setdefault(_b(key), [])
+        lst.extend(map(_b, values))
+        return len(lst)
+
+    async def lpush(self, key, *values):
+        lst = self.lists.setdefault(_b(key), [])
+        for v in values:
+            lst.insert(0, _b(v))
+        return len(lst)
+
+    async def lpop(self, key):
+        lst = self.lists.get(_b(key))
+        if not lst:
+            return None
+        v = lst.pop(0)
+        if not lst:
+            del self.lists[_b(key)]
+        return v
+
+    async def lindex(self, key, index):
+        lst = self.lists.get(_b(key)) or []
+        return lst[index] if -len(lst) <= index < len(lst) else None
+
+    async def llen(self, key):
+        return len(self.lists.get(_b(key)) or [])
+
+    async def lmove(self, src, dst, wherefrom, whereto):
+        v = await (self.lpop(src) if wherefrom == "LEFT" else self._rpop(src))
+        if v is not None:
+            await (self.rpush(dst, v) if whereto == "RIGHT" else self.lpush(dst, v))
+        return v
+
+    async def _rpop(self, key):
+        lst = self.lists.get(_b(key))
+        return lst.pop() if lst else None
+
+    # hashes
+    async def hget(self, key, field):
+        return self.hashes.get(_b(key), {}).get(_b(field))
+
+    async def hset(self, key, field=None, value=None, mapping=None):
+        h = self.hashes.setdefault(_b(key), {})
+        if field is not None:
+            h[_b(field)] = _b(value)
+        for f, v in (mapping or {}).items():
+            h[_b(f)] = _b(v)
+        return 1
+
+    # sorted sets
+    async def zadd(self, key, mapping):
+        z = self.zsets.setdefault(_b(key), {})
+        for m, score in mapping.items():
+            z[_b(m)] = float(score)
+        return len(mapping)
+
+    async def zrem(self, key, *members):
+        z = self.zsets.get(_b(key), {})
+        return sum(1 for m in map(_b, members) if z.pop(m, None) is not None)
+
+    async def zrange(self, key, start, end):
+        z = self.zsets.get(_b(key), {})
+        return [m for m, _ in sorted(z.items(), key=lambda kv: kv[1])]
+
+    async def zremrangebyscore(self, key, lo, hi):
+        z = self.zsets.get(_b(key), {})
+        gone = [m for m, s in z.items() if lo <= s <= hi]
+        for m in gone:
+            del z[m]
+        return len(gone)
+
+    async def zcard(self, key):
+        return len(self.zsets.get(_b(key), {}))
+
+    async def eval(self, script, numkeys, *args):
+        keys, argv = [_b(a) for a in args[:numkeys]], list(args[numkeys:])
+        if script == gen_scheduler._SUBMIT_LUA:
+            queue, members, ring = keys
+            await self.rpush(queue, argv[0])
+            chat = _b(argv[1])
+            if chat not in self.sets.setdefault(members, set()):
+                self.sets[members].add(chat)
+                await self.rpush(ring, chat)
+            return 1
+        if script == gen_scheduler._RETIRE_LUA:
+            queue, members, ring, deficit = keys
+            if await self.llen(queue) > 0:
+                return 0
+            chat = _b(argv[0])
+            self.sets.get(members, set()).discard(chat)
+            if ring in self.lists:
+                self.lists[ring] = [c for c in self.lists[ring] if c != chat]
+            self.hashes.get(deficit, {}).pop(chat, None)
+            return 1
+        raise AssertionError("unexpected script")
+
+
+class FakeArq:
+    def __init__(self) -> None:
+        self.jobs: List[tuple] = []
+
+    async def enqueue_job(self, name, *args, **kwargs):
+        self.jobs.append((name, args, kwargs))
+        return object()
+
+    def generations(self) -> List[tuple]:
+        return [j for j in self.jobs if j[0] == "process_generation"]
+
+
+@pytest.fixture
+def sched(monkeypatch):
+    r, arq = FakeRedis(), FakeArq()
+
+    async def _profile(_r, chat_id):
+        return gen_scheduler.CLASS_INTERACTIVE, False
+
+    monkeypatch.setattr(gen_scheduler, "get_redis", lambda *_: r)
+    monkeypatch.setattr(gen_scheduler, "get_arq_client", lambda: arq)
+    monkeypatch.setattr(gen_scheduler, "_profile", _profile)
+    return r, arq
+
+
+async def _submit_and_dispatch(users: List[int], arq: FakeArq) -> None:
+    for chat_id in users:
+        await gen_scheduler.submit_generation(chat_id, "prompt", [], None)
+    await gen_scheduler.dispatch_generations({"redis": arq})
+
+
+def test_default_slots_follow_worker_max_jobs():
+    assert settings.GEN_SCHED_MAX_INFLIGHT == 0
+    assert WorkerSettings.max_jobs == settings.ARQ_WORKER_MAX_JOBS
+    assert settings.GEN_SCHED_SLOTS == settings.ARQ_WORKER_MAX_JOBS * settings.ARQ_WORKERS
+
+
+@pytest.mark.parametrize("n", [1, WorkerSettings.max_jobs // 2, WorkerSettings.max_jobs])
+def test_n_users_up_to_max_jobs_run_concurrently(sched, n):
+    r, arq = sched
+    users = [1000 + i for i in range(n)]
+
+    asyncio.run(_submit_and_dispatch(users, arq))
+
+    started = sorted(job[1][0] for job in arq.generations())
+    assert started == users
+    assert asyncio.run(r.zcard(gen_scheduler._RUNNING)) == n
+
+
+def test_users_beyond_slots_wait_for_a_free_slot(sched):
+    r, arq = sched
+    slots = settings.GEN_SCHED_SLOTS
+    users = [2000 + i for i in range(slots + 2)]
+
+    asyncio.run(_submit_and_dispatch(users, arq))
+    assert len(arq.generations()) == slots
+
+    slot = arq.generations()[0][2]["sched_slot"]
+    asyncio.run(gen_scheduler.finish_generation({"redis": arq}, slot))
+    asyncio.run(gen_scheduler.dispatch_generations({"redis": arq}))
+    assert len(arq.generations()) == slots + 1
+    assert asyncio.run(r.zcard(gen_scheduler._RUNNING)) == slots
+
+
+def test_stale_slots_expire(sched):
+    r, arq = sched
+    asyncio.run(r.zadd(gen_scheduler._RUNNING, {"1:interactive:old": time.time() - settings.GEN_SCHED_SLOT_TTL_S - 1}))
+
+    asyncio.run(_submit_and_dispatch([3000], arq))
+
+    assert [job[1][0] for job in arq.generations()] == [3000]
@@ -3,11 +3,13 @@ import asyncio
 import json
 import logging
 import time
-from vendors.kie_rate_limiter import kie_rate_limiter
+from vendors.kie_rate_limiter import bucket_for_model, kie_rate_limiter
+from vendors.kie_aimd import SIGNAL_BODY, SIGNAL_CLOUDFLARE, SIGNAL_HTTP_429, kie_aimd
 from typing import Any, Dict, List, Optional
 
 import httpx
 
+from core import metrics
 from core.config import settings
 
 log = logging.getLogger("kie")
@@ -21,6 +23,14 @@ def _j(event: str, **fields) -> str:
     return json.dumps({"event": event, **fields}, ensure_ascii=False)
 
 
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
 class KieClient:
     """
     ✅ ПРОСТОЕ РЕШЕНИЕ: Pro работает как Standard, только параметры другие
@@ -40,9 +50,31 @@ class KieClient:
             "Authorization": f"Bearer {settings.KIE_API_KEY}",
             "Content-Type": "application/json",
         }
+        # ✅ Один клиент на весь воркер (см. services.queue.startup): keep-alive + HTTP/2,
+        # TLS-handshake платим один раз, а не на каждую генерацию
+        http2 = settings.KIE_HTTP2 and _http2_available()
         self._client = httpx.AsyncClient(
-            timeout=httpx.Timeout(90.0, read=90.0, connect=15.0)
+            timeout=httpx.Timeout(90.0, read=90.0, connect=15.0),
+            limits=httpx.Limits(
+                max_connections=settings.KIE_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.KIE_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=settings.KIE_HTTP_KEEPALIVE_EXPIRY_S,
+            ),
+            http2=http2,
+            event_hooks={"request": [self._on_request]},
         )
+        log.info(_j("kie.client.created", http2=http2))
+
+    async def _on_request(self, request: httpx.Request) -> None:
+        metrics.inc("kie_http.requests")
+        request.extensions["trace"] = self._trace
+
+    @staticmethod
+    async def _trace(event_name: str, info: Dict[str, Any]) -> None:
+        # httpcore шлёт connect_tcp только при открытии нового соединения —
+        # kie_http.requests - kie_http.new_connections = переиспользованные
+        if event_name == "connection.connect_tcp.complete":
+            metrics.inc("kie_http.new_connections")
 
     async def aclose(self):
         try:
@@ -152,13 +184,17 @@ class KieClient:
             original_prompt_len=original_len
         ))
         
-        await kie_rate_limiter.acquire()
+        bucket = bucket_for_model(user_model)
         delay = 2.0
         max_attempts = 5
         
+        # ✅ Сигналы перегрузки идут в общий AIMD-контроллер: он сам замедляет
+        # token bucket на весь кластер, поэтому повтор просто снова ждёт limiter
         for attempt in range(1, max_attempts + 1):
+            await kie_rate_limiter.acquire(bucket)
             try:
-                r = await self._client.post(self.create_url, headers=self.headers, json=payload)
+                async with kie_aimd.slot(bucket):
+                    r = await self._client.post(self.create_url, headers=self.headers, json=payload)
             except httpx.TimeoutException:
                 if attempt < max_attempts:
                     log.warning(_j("kie.create.timeout", cid=cid, attempt=attempt))
@@ -176,7 +212,7 @@ class KieClient:
 
             if r.status_code == 429:
                 ra = r.headers.get("Retry-After")
-                wait_s = float(ra) if (ra and str(ra).replace('.', '').isdigit()) else delay
+                wait_s = float(ra) if (ra and str(ra).replace('.', '').isdigit()) else 0.0
                 
                 log.warning(_j(
                     "kie.create.http_429",
@@ -184,10 +220,12 @@ class KieClient:
                     attempt=attempt,
                     retry_after=wait_s
                 ))
+                await kie_aimd.on_congestion(bucket, SIGNAL_HTTP_429)
                 
                 if attempt < max_attempts:
-                    await asyncio.sleep(wait_s)
-                    delay = min(delay * 2.0, 30.0)
+                    # Retry-After соблюдаем явно, остальное — через замедленный limiter
+                    if wait_s > 0:
+                        await asyncio.sleep(wait_s)
                     continue
                 else:
                     raise KieError("rate_limit_exceeded_http_429")
@@ -211,18 +249,15 @@ class KieClient:
                 is_rate_limited = any(indicator in msg for indicator in rate_limit_indicators)
                 
                 if is_rate_limited:
-                    wait_s = delay
                     log.warning(_j(
                         "kie.create.rate_limit_in_body",
                         cid=cid,
                         attempt=attempt,
-                        retry_after=wait_s,
                         msg=msg[:200]
                     ))
+                    await kie_aimd.on_congestion(bucket, SIGNAL_BODY)
                     
                     if attempt < max_attempts:
-                        await asyncio.sleep(wait_s)
-                        delay = min(delay * 2.0, 30.0)
                         continue
                     else:
                         raise KieError(f"rate_limit_exceeded:{msg[:200]}")
@@ -239,16 +274,21 @@ class KieClient:
                     attempt=attempt
                 ))
                 
+                if is_cloudflare_error:
+                    await kie_aimd.on_congestion(bucket, SIGNAL_CLOUDFLARE)
+                
                 if attempt < max_attempts:
-                    wait_time = delay * 2 if is_cloudflare_error else delay
+                    # Cloudflare 5xx — перегрузка, её уже отработал AIMD; прочие 5xx — обычный backoff
+                    wait_time = 0.0 if is_cloudflare_error else delay
                     log.warning(_j(
                         "kie.create.5xx_retry",
                         cid=cid,
                         attempt=attempt,
                         wait_time=wait_time
                     ))
-                    await asyncio.sleep(wait_time)
-                    delay = min(delay * 2.0, 30.0)
+                    if wait_time > 0:
+                        await asyncio.sleep(wait_time)
+                        delay = min(delay * 2.0, 30.0)
                     continue
                 else:
                     if is_cloudflare_error:
@@ -272,6 +312,8 @@ class KieClient:
             if not task_id:
                 raise KieError("no_task_id")
 
+            await kie_aimd.on_success(bucket)
+
             log.info(_j(
                 "kie.create.ok",
                 cid=cid,
@@ -287,13 +329,16 @@ class KieClient:
         self,
         task_id: str,
         *,
-        cid: Optional[str] = None
+        cid: Optional[str] = None,
+        bucket: Optional[str] = None,
     ) -> Dict[str, Any]:
-        """Получение статуса - БЕЗ ИЗМЕНЕНИЙ"""
+        """Получение статуса; bucket — ждать токен глобального rate limiter'а перед запросом"""
         max_attempts = 3
         delay = 2.0
         
         for attempt in range(1, max_attempts + 1):
+            if bucket:
+                await kie_rate_limiter.acquire(bucket)
             try:
                 r = await self._client.get(
                     self.status_url,
@@ -0,0 +1,181 @@
+"""
+AIMD-контроллер нагрузки на KIE createTask, общий для всего кластера.
+
+Состояние в Redis (kie:aimd:{bucket}):
+  • limit — сколько createTask одновременно может быть «в полёте»;
+  • rate  — текущий rps, который читает token bucket (vendors.kie_rate_limiter).
+
+Успешный ответ — аддитивный рост (limit += 1/limit, rate += step), сигнал
+перегрузки (429, «call frequency» в теле 200, Cloudflare 5xx) — limit и rate
+пополам и обнуление токенов bucket'а. Снижение срабатывает не чаще раза в
+cooldown, поэтому пачка 429 от одной волны запросов режет нагрузку один раз,
+а не на каждом воркере отдельно.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict
+from uuid import uuid4
+
+from core import metrics
+from core.config import settings
+from core.redis_pools import POOL_CACHE, get_redis
+from vendors.kie_rate_limiter import aimd_key, kie_rate_limiter, state_key
+
+log = logging.getLogger("kie_aimd")
+
+SIGNAL_HTTP_429 = "http_429"
+SIGNAL_BODY = "rate_limit_in_body"
+SIGNAL_CLOUDFLARE = "cloudflare_5xx"
+
+_LEASE_MS = 120_000
+_TTL_MS = 24 * 3600 * 1000
+
+# KEYS: aimd, leases; ARGV: token, lease_ms, init_limit, min_limit, ttl_ms
+_SLOT_LUA = """
+local t = redis.call('time')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+redis.call('zremrangebyscore', KEYS[2], '-inf', now)
+local limit = tonumber(redis.call('hget', KEYS[1], 'limit') or ARGV[3])
+local cap = math.max(tonumber(ARGV[4]), math.floor(limit))
+if redis.call('zcard', KEYS[2]) < cap then
+    redis.call('zadd', KEYS[2], now + tonumber(ARGV[2]), ARGV[1])
+    redis.call('pexpire', KEYS[2], ARGV[5])
+    return 1
+end
+return 0
+"""
+
+# KEYS: aimd, bucket_state
+# ARGV: kind, min_limit, max_limit, init_limit, min_rate, max_rate, rate_step, cooldown_ms, ttl_ms
+_FEEDBACK_LUA = """
+local t = redis.call('time')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local min_limit, max_limit = tonumber(ARGV[2]), tonumber(ARGV[3])
+local min_rate, max_rate = tonumber(ARGV[5]), tonumber(ARGV[6])
+local st = redis.call('hmget', KEYS[1], 'limit', 'rate', 'dec_at')
+local limit = tonumber(st[1]) or tonumber(ARGV[4])
+local rate = tonumber(st[2]) or max_rate
+local dec_at = tonumber(st[3]) or 0
+local changed = 0
+if ARGV[1] == 'inc' then
+    limit = math.min(max_limit, limit + 1 / limit)
+    rate = math.min(max_rate, rate + tonumber(ARGV[7]))
+    changed = 1
+elseif now - dec_at >= tonumber(ARGV[8]) then
+    limit = math.max(min_limit, limit * 0.5)
+    rate = math.max(min_rate, rate * 0.5)
+    dec_at = now
+    changed = 1
+    -- весь кластер притормаживает сразу: накопленный burst сгорает
+    redis.call('hset', KEYS[2], 'tokens', '0', 'ts', now)
+end
+redis.call('hset', KEYS[1], 'limit', tostring(limit), 'rate', tostring(rate), 'dec_at', dec_at)
+redis.call('pexpire', KEYS[1], ARGV[9])
+return {changed, tostring(limit), tostring(rate)}
+"""
+
+
+def _j(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+class KieAimdController:
+    def __init__(self, max_rates: Dict[str, float]):
+        self.max_rates = max_rates
+
+    def _max_rate(self, bucket: str) -> float:
+        return self.max_rates.get(bucket) or min(self.max_rates.values())
+
+    @asynccontextmanager
+    async def slot(self, bucket: str) -> AsyncIterator[None]:
+        """async with kie_aimd.slot(bucket): — не больше limit createTask в полёте на кластер"""
+        if not settings.KIE_AIMD_ENABLED:
+            yield
+            return
+
+        leases = f"{aimd_key(bucket)}:inflight"
+        token = uuid4().hex
+        r = get_redis(POOL_CACHE)
+        started = time.monotonic()
+        held = False
+        delay = 0.05
+        try:
+            while True:
+                if await r.eval(
+                    _SLOT_LUA, 2, aimd_key(bucket), leases,
+                    token, _LEASE_MS, settings.KIE_AIMD_INIT_INFLIGHT,
+                    settings.KIE_AIMD_MIN_INFLIGHT, _TTL_MS,
+                ):
+                    held = True
+                    break
+                await asyncio.sleep(delay)
+                delay = min(delay * 1.5, 0.5)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning(_j("kie_aimd.redis_error", bucket=bucket, op="slot", error=str(e)[:200]))
+        metrics.observe(f"kie_aimd.slot_wait_s.{bucket}", time.monotonic() - started)
+
+        try:
+            yield
+        finally:
+            if held:
+                try:
+                    await r.zrem(leases, token)
+                except Exception:
+                    pass
+
+    async def _feedback(self, bucket: str, kind: str):
+        return await get_redis(POOL_CACHE).eval(
+            _FEEDBACK_LUA, 2, aimd_key(bucket), state_key(bucket),
+            kind,
+            settings.KIE_AIMD_MIN_INFLIGHT,
+            settings.KIE_AIMD_MAX_INFLIGHT,
+            settings.KIE_AIMD_INIT_INFLIGHT,
+            settings.KIE_AIMD_MIN_RPS,
+            self._max_rate(bucket),
+            settings.KIE_AIMD_RPS_STEP,
+            settings.KIE_AIMD_COOLDOWN_MS,
+            _TTL_MS,
+        )
+
+    async def on_success(self, bucket: str) -> None:
+        if not settings.KIE_AIMD_ENABLED:
+            return
+        try:
+            _, limit, rate = await self._feedback(bucket, "inc")
+        except Exception as e:
+            log.warning(_j("kie_aimd.redis_error", bucket=bucket, op="inc", error=str(e)[:200]))
+            return
+        metrics.set_gauge(f"kie_aimd.limit.{bucket}", float(limit))
+        metrics.set_gauge(f"kie_aimd.rate.{bucket}", float(rate))
+
+    async def on_congestion(self, bucket: str, signal: str) -> None:
+        metrics.inc(f"kie_aimd.congestion.{bucket}.{signal}")
+        if not settings.KIE_AIMD_ENABLED:
+            return
+        try:
+            changed, limit, rate = await self._feedback(bucket, "dec")
+        except Exception as e:
+            log.warning(_j("kie_aimd.redis_error", bucket=bucket, op="dec", error=str(e)[:200]))
+            return
+        metrics.set_gauge(f"kie_aimd.limit.{bucket}", float(limit))
+        metrics.set_gauge(f"kie_aimd.rate.{bucket}", float(rate))
+        if int(changed):
+            metrics.inc(f"kie_aimd.decrease.{bucket}")
+            log.warning(_j(
+                "kie_aimd.decrease",
+                bucket=bucket,
+                signal=signal,
+                limit=round(float(limit), 2),
+                rate=round(float(rate), 3),
+            ))
+
+
+# Глобальный экземпляр: потолок rate — лимиты token bucket'ов
+kie_aimd = KieAimdController({name: rps for name, (rps, _) in kie_rate_limiter.limits.items()})
@@ -1,34 +1,194 @@
 """
-Глобальный rate limiter для KIE AI
+Глобальный rate limiter для KIE AI — общий для всех arq-воркеров и реплик.
+
+Token bucket живёт в Redis и обновляется одним Lua-скриптом, поэтому весь
+кластер вместе держит ровно лимит провайдера, а не rps × число процессов.
+У каждой модели свой bucket (standard / pro). Ожидающие стоят в FIFO-очереди
+тикетов: токен получает только голова очереди, «зависшие» тикеты (процесс
+умер) вычищаются по таймауту. Если Redis недоступен — локальный limiter
+процесса, как раньше. Текущий rate bucket'а может понижать AIMD-контроллер
+(vendors.kie_aimd) — поле rate в kie:aimd:{bucket}.
 """
+from __future__ import annotations
+
 import asyncio
-import time
-from typing import Optional
+import json
 import logging
+import time
+from typing import Dict, Optional
+
+from core import metrics
+from core.config import settings
+from core.redis_pools import POOL_CACHE, get_redis
 
 log = logging.getLogger("kie_rate_limiter")
 
+BUCKET_STANDARD = "standard"
+BUCKET_PRO = "pro"
 
-class KieRateLimiter:
-    """Контролирует частоту запросов к KIE AI"""
-    def __init__(self, requests_per_second: float = 1.5):
-        self.requests_per_second = requests_per_second
+_KEY_PREFIX = "kie:rl:"
+AIMD_KEY_PREFIX = "kie:aimd:"
+
+# KEYS: state, queue, seen, seq, aimd
+# ARGV: ticket (0 = встать в очередь), rate_per_s, burst, stale_ms, ttl_ms
+# Возвращает {granted, wait_ms, ticket}
+_ACQUIRE_LUA = """
+local rate = tonumber(ARGV[2])
+local aimd_rate = tonumber(redis.call('hget', KEYS[5], 'rate') or '')
+if aimd_rate and aimd_rate > 0 and aimd_rate < rate then
+    rate = aimd_rate
+end
+local burst = tonumber(ARGV[3])
+local stale_ms = tonumber(ARGV[4])
+local ttl_ms = tonumber(ARGV[5])
+local t = redis.call('time')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+
+local ticket = tonumber(ARGV[1])
+if ticket == 0 then
+    ticket = redis.call('incr', KEYS[4])
+    redis.call('zadd', KEYS[2], ticket, ticket)
+end
+redis.call('hset', KEYS[3], ticket, now)
+
+-- выкидываем из головы тикеты, которые давно не опрашивали bucket
+for _ = 1, 16 do
+    local head = redis.call('zrange', KEYS[2], 0, 0)[1]
+    if not head or tonumber(head) == ticket then break end
+    local seen = tonumber(redis.call('hget', KEYS[3], head) or '0')
+    if now - seen <= stale_ms then break end
+    redis.call('zrem', KEYS[2], head)
+    redis.call('hdel', KEYS[3], head)
+end
+
+local st = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(st[1]) or burst
+local ts = tonumber(st[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+
+local pos = redis.call('zrank', KEYS[2], ticket)
+if not pos then
+    -- наш тикет сочли зависшим — возвращаем его на прежнее место
+    redis.call('zadd', KEYS[2], ticket, ticket)
+    pos = redis.call('zrank', KEYS[2], ticket)
+end
+local granted = 0
+local wait_ms = 0
+if pos == 0 and tokens >= 1 then
+    tokens = tokens - 1
+    granted = 1
+    redis.call('zrem', KEYS[2], ticket)
+    redis.call('hdel', KEYS[3], ticket)
+else
+    wait_ms = math.ceil((pos + 1 - tokens) * 1000 / rate)
+end
+
+redis.call('hset', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+for i = 1, 4 do
+    redis.call('pexpire', KEYS[i], ttl_ms)
+end
+return {granted, wait_ms, ticket}
+"""
+
+
+def state_key(bucket: str) -> str:
+    return f"{_KEY_PREFIX}{bucket}:state"
+
+
+def aimd_key(bucket: str) -> str:
+    return f"{AIMD_KEY_PREFIX}{bucket}"
+
+
+def _j(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+class _LocalLimiter:
+    """Прежний limiter процесса: интервал между запросами под asyncio.Lock"""
+
+    def __init__(self, requests_per_second: float):
         self.min_interval = 1.0 / requests_per_second
         self.last_request_time: Optional[float] = None
         self.lock = asyncio.Lock()
-    
-    async def acquire(self):
-        """Ждёт, пока не разрешится следующий запрос"""
+
+    async def acquire(self) -> None:
         async with self.lock:
             if self.last_request_time is not None:
                 elapsed = time.time() - self.last_request_time
-                
                 if elapsed < self.min_interval:
-                    wait_time = self.min_interval - elapsed
-                    await asyncio.sleep(wait_time)
-            
+                    await asyncio.sleep(self.min_interval - elapsed)
             self.last_request_time = time.time()
 
 
+class KieRateLimiter:
+    """Контролирует частоту запросов к KIE AI (распределённый token bucket)"""
+
+    def __init__(self, limits: Dict[str, tuple], *, stale_ms: int = 5000):
+        # limits: bucket -> (requests_per_second, burst)
+        self.limits = limits
+        self.stale_ms = stale_ms
+        self._local: Dict[str, _LocalLimiter] = {
+            name: _LocalLimiter(rps) for name, (rps, _) in limits.items()
+        }
+
+    def _keys(self, bucket: str):
+        base = f"{_KEY_PREFIX}{bucket}"
+        return state_key(bucket), f"{base}:q", f"{base}:seen", f"{base}:seq", aimd_key(bucket)
+
+    async def acquire(self, bucket: str = BUCKET_STANDARD) -> float:
+        """Ждёт свою очередь и токен; возвращает время ожидания в секундах"""
+        if bucket not in self.limits:
+            bucket = BUCKET_STANDARD
+        rps, burst = self.limits[bucket]
+        started = time.monotonic()
+        ticket = 0
+        r = get_redis(POOL_CACHE)
+        keys = self._keys(bucket)
+        ttl_ms = max(60_000, self.stale_ms * 4)
+
+        try:
+            while True:
+                granted, wait_ms, ticket = await r.eval(
+                    _ACQUIRE_LUA, 5, *keys,
+                    int(ticket), rps, burst, self.stale_ms, ttl_ms,
+                )
+                ticket = int(ticket)
+                if int(granted):
+                    break
+                # Опрашиваем не реже раза в секунду, чтобы тикет не счёлся зависшим
+                await asyncio.sleep(min(max(int(wait_ms), 20), 1000) / 1000.0)
+        except asyncio.CancelledError:
+            if ticket:
+                asyncio.ensure_future(self._abandon(keys, ticket))
+            raise
+        except Exception as e:
+            metrics.inc(f"kie_rl.fallback.{bucket}")
+            log.warning(_j("kie_rl.redis_error", bucket=bucket, error=str(e)[:200]))
+            await self._local[bucket].acquire()
+
+        waited = time.monotonic() - started
+        metrics.inc(f"kie_rl.granted.{bucket}")
+        metrics.observe(f"kie_rl.wait_s.{bucket}", waited)
+        if waited >= 5.0:
+            log.info(_j("kie_rl.long_wait", bucket=bucket, wait_s=round(waited, 2)))
+        return waited
+
+    async def _abandon(self, keys: tuple, ticket: int) -> None:
+        """Убрать тикет отменённого ожидания, чтобы не держать очередь до stale_ms"""
+        try:
+            r = get_redis(POOL_CACHE)
+            await r.zrem(keys[1], ticket)
+            await r.hdel(keys[2], ticket)
+        except Exception:
+            pass
+
+
+def bucket_for_model(user_model: str) -> str:
+    return BUCKET_PRO if user_model == "pro" else BUCKET_STANDARD
+
+
 # Глобальный экземпляр
-kie_rate_limiter = KieRateLimiter(requests_per_second=1.5)
\ No newline at end of file
+kie_rate_limiter = KieRateLimiter({
+    BUCKET_STANDARD: (settings.KIE_RPS_STANDARD, settings.KIE_BURST_STANDARD),
+    BUCKET_PRO: (settings.KIE_RPS_PRO, settings.KIE_BURST_PRO),
+})
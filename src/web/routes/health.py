@@ -60,12 +60,13 @@
 
 from fastapi import APIRouter
 from fastapi.responses import JSONResponse
-import redis.asyncio as redis
 from sqlalchemy import text
 from pathlib import Path
 import httpx
 
 from core.config import settings
+from core import metrics
+from core.redis_pools import POOL_CACHE, POOL_FSM, get_redis, redis_pool_stats
 from db.engine import SessionLocal
 
 router = APIRouter()
@@ -91,9 +92,7 @@ async def health_deep():
     
     # Проверка Redis FSM
     try:
-        r = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_FSM)
-        await r.ping()
-        await r.aclose()
+        await get_redis(POOL_FSM).ping()
         status["services"]["redis_fsm"] = "ok"
     except Exception as e:
         status["services"]["redis_fsm"] = f"error: {str(e)[:100]}"
@@ -101,14 +100,14 @@ async def health_deep():
     
     # Проверка Redis Cache
     try:
-        r = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_CACHE)
-        await r.ping()
-        await r.aclose()
+        await get_redis(POOL_CACHE).ping()
         status["services"]["redis_cache"] = "ok"
     except Exception as e:
         status["services"]["redis_cache"] = f"error: {str(e)[:100]}"
         status["overall"] = "degraded"
     
+    status["redis_pools"] = redis_pool_stats()
+    
     # ✅ НОВОЕ: Проверка прокси изображений
     try:
         temp_dir = Path("/app/temp_inputs")
@@ -125,6 +124,24 @@ async def health_deep():
     return JSONResponse(status, status_code=200 if status["overall"] == "ok" else 503)
 
 
+@router.get("/health/metrics")
+async def health_metrics():
+    """
+    Метрики текущего процесса (gunicorn worker) + снимки arq-воркеров из Redis
+    (kie_http.*, kie_rl.*, deliver.*, image.*, reconcile.*, gen_sched.*, queue.wait_s.*)
+    """
+    data = metrics.snapshot()
+    data["redis_pools"] = redis_pool_stats()
+    try:
+        workers = await metrics.load_published(get_redis(POOL_CACHE))
+    except Exception as e:
+        workers = {}
+        data["workers_error"] = str(e)[:100]
+    data["workers"] = workers
+    data["workers_total"] = metrics.merge(list(workers.values()))
+    return data
+
+
 @router.get("/health/proxy-test")
 async def health_proxy_test():
     """✅ НОВОЕ: Тест доступности прокси извне"""
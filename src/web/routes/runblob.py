@@ -12,13 +12,10 @@ from fastapi import APIRouter, Request
 from fastapi.responses import JSONResponse
 from sqlalchemy import select, update
 
-from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.base import StorageKey
-from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
-
 from bot.routers.generation import send_generation_result
 from bot.states import CreateStates, GenStates
-from core.config import settings
+from core.fsm import external_fsm
+from core.redis_pools import POOL_CACHE, get_redis
 from db.engine import SessionLocal
 from db.models import Task, User
 from services.telegram_safe import safe_send_text
@@ -48,7 +45,7 @@ def _normalize_status(s: str) -> str:
 # -------------------- redis lock per task_uuid --------------------
 
 async def _acquire_webhook_lock(task_uuid: str, ttl: int = 180) -> Optional[Tuple[aioredis.Redis, str]]:
-    r = aioredis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_CACHE)
+    r = get_redis(POOL_CACHE)
     key = f"wb:lock:{task_uuid}"
     try:
         ok = await r.set(key, "1", nx=True, ex=ttl)
@@ -56,10 +53,6 @@ async def _acquire_webhook_lock(task_uuid: str, ttl: int = 180) -> Optional[Tupl
             return r, key
         return None
     except Exception:
-        try:
-            await r.close()
-        except Exception:
-            pass
         return None
 
 async def _release_webhook_lock(lock: Optional[Tuple[aioredis.Redis, str]]) -> None:
@@ -70,16 +63,11 @@ async def _release_webhook_lock(lock: Optional[Tuple[aioredis.Redis, str]]) -> N
         await r.delete(key)
     except Exception:
         pass
-    finally:
-        try:
-            await r.close()
-        except Exception:
-            pass
-        
+
+
 async def _clear_pending_marker(task_uuid: str) -> None:
     try:
-        r = aioredis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_CACHE)
-        await r.delete(f"task:pending:{task_uuid}")
+        await get_redis(POOL_CACHE).delete(f"task:pending:{task_uuid}")
     except Exception:
         pass
 
@@ -91,33 +79,27 @@ async def _clear_wait_and_reset(bot, chat_id: int, *, back_to: str = "auto") ->
       • если режим был create -> ждём новый текстовый промт
       • иначе -> ждём промт для правок
     """
-    r = aioredis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_FSM)
-    try:
-        storage = RedisStorage(redis=r, key_builder=DefaultKeyBuilder(with_bot_id=True))
-        me = await bot.get_me()
-        fsm = FSMContext(storage=storage, key=StorageKey(me.id, chat_id, chat_id))
-
-        data = await fsm.get_data()
-        wait_id = data.get("wait_msg_id")
-        if wait_id:
-            try:
-                await bot.delete_message(chat_id, wait_id)
-            except Exception:
-                pass
-            await fsm.update_data(wait_msg_id=None)
-
-        mode = (data.get("mode") or "").lower()
-        target = back_to
-        if target == "auto":
-            target = "create" if mode == "create" else "edit"
-
-        if target == "create":
-            await fsm.update_data(mode="create", edits=[], photos=[])
-            await fsm.set_state(CreateStates.waiting_prompt)
-        else:
-            await fsm.set_state(GenStates.waiting_prompt)
-    finally:
-        await r.aclose()
+    fsm = external_fsm(chat_id)
+
+    data = await fsm.get_data()
+    wait_id = data.get("wait_msg_id")
+    if wait_id:
+        try:
+            await bot.delete_message(chat_id, wait_id)
+        except Exception:
+            pass
+        await fsm.update_data(wait_msg_id=None)
+
+    mode = (data.get("mode") or "").lower()
+    target = back_to
+    if target == "auto":
+        target = "create" if mode == "create" else "edit"
+
+    if target == "create":
+        await fsm.update_data(mode="create", edits=[], photos=[])
+        await fsm.set_state(CreateStates.waiting_prompt)
+    else:
+        await fsm.set_state(GenStates.waiting_prompt)
 
 # -------------------- webhook --------------------
 
@@ -196,8 +178,7 @@ async def runblob_callback(req: Request):
 
                 # маркер «списано» (для возможного возврата в очереди)
                 try:
-                    r = aioredis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_CACHE)
-                    await r.setex(f"credits:debited:{task_uuid}", 86400, "1")
+                    await get_redis(POOL_CACHE).setex(f"credits:debited:{task_uuid}", 86400, "1")
                 except Exception:
                     pass
 
@@ -240,7 +221,7 @@ async def runblob_callback(req: Request):
             if status == "moderation_blocked":
                 # показываем ОДИН раз на задачу
                 try:
-                    rr = aioredis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_CACHE)
+                    rr = get_redis(POOL_CACHE)
                     shown = await rr.setnx(f"msg:mod:{task_uuid}", "1")
                     if shown:
                         await rr.expire(f"msg:mod:{task_uuid}", 86400)
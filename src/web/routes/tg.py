@@ -2,6 +2,9 @@ from fastapi import APIRouter, Request, Header, HTTPException
 from fastapi.responses import JSONResponse
 from aiogram.types import Update
 
+from services.chat_lanes import LaneBusy, chat_lane
+from web.update_queue import update_chat_id
+
 router = APIRouter()
 
 @router.post("/tg/webhook")
@@ -9,5 +12,18 @@ async def tg_webhook(request: Request, x_telegram_bot_api_secret_token: str = He
     if x_telegram_bot_api_secret_token != request.app.state.webhook_secret:
         raise HTTPException(403, "forbidden")
     update = Update.model_validate(await request.json(), context={"bot": request.app.state.bot})
-    await request.app.state.dp.feed_update(request.app.state.bot, update)
+
+    update_queue = getattr(request.app.state, "update_queue", None)
+    if update_queue is not None:
+        # ✅ Fast-ack: обработка в фоне, при переполнении — 503 (Telegram повторит)
+        if not update_queue.submit(update):
+            return JSONResponse({"ok": False, "error": "busy"}, status_code=503)
+        return JSONResponse({"ok": True})
+
+    try:
+        async with chat_lane(update_chat_id(update)):
+            await request.app.state.dp.feed_update(request.app.state.bot, update)
+    except LaneBusy:
+        # ✅ Lane-лок не взят — не обрабатываем без лока, Telegram повторит доставку
+        return JSONResponse({"ok": False, "error": "busy"}, status_code=503)
     return JSONResponse({"ok": True})
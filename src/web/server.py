@@ -1,16 +1,20 @@
 import asyncio
-import redis.asyncio as redis
+from functools import partial
 
 from fastapi import FastAPI
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
 from aiogram.exceptions import TelegramRetryAfter
 import logging
 from core.config import settings
+from core.fsm import fsm_storage
+from core.tg_outbound import install_outbound_scheduler
 from core.logging import configure_json_logging
-from redis.asyncio.connection import ConnectionPool
+from core.redis_pools import POOL_CACHE, POOL_FSM, close_redis_pools, get_redis, init_redis_pools
+from services.arq_pool import close_arq_client, get_arq_client, init_arq_client
+from web.update_queue import UpdateQueue
+from services.album_aggregator import AlbumAggregator
 
 from bot.middlewares import ErrorLoggingMiddleware, RateLimitMiddleware
 from bot.routers import commands as r_cmd
@@ -32,11 +36,7 @@ async def migrate_fsm_states():
     """
     Очищает FSM состояния, которые несовместимы с новой версией.
     """
-    r = redis.Redis(
-        host=settings.REDIS_HOST, 
-        port=settings.REDIS_PORT, 
-        db=settings.REDIS_DB_FSM
-    )
+    r = get_redis(POOL_FSM)
     
     try:
         log = logging.getLogger("migration")
@@ -89,8 +89,6 @@ async def migrate_fsm_states():
     
     except Exception as e:
         log.error(f"❌ FSM migration failed: {e}")
-    finally:
-        await r.aclose()
 
 
 configure_json_logging()
@@ -98,21 +96,14 @@ app = FastAPI(title="NanoBanana", version="1.0.0")
 
 bot = Bot(token=settings.TELEGRAM_BOT_TOKEN,
           default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+install_outbound_scheduler(bot)
 
 
-redis_pool = ConnectionPool(
-    host=settings.REDIS_HOST,
-    port=settings.REDIS_PORT,
-    db=settings.REDIS_DB_FSM,
-    max_connections=200,        # увеличено с 50
-    decode_responses=False,
-)
-
-redis_fsm = redis.Redis(connection_pool=redis_pool)
-storage = RedisStorage(redis=redis_fsm, key_builder=DefaultKeyBuilder(with_bot_id=True))
+storage = fsm_storage()
 # redis_fsm = redis.from_url(f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB_FSM}")
 # storage = RedisStorage(redis=redis_fsm, key_builder=DefaultKeyBuilder(with_bot_id=True))
 dp = Dispatcher(storage=storage)
+dp["arq_client"] = get_arq_client()  # ✅ доступен в хендлерах как аргумент arq_client
 
 # include routers
 dp.include_router(r_voice.router)
@@ -127,7 +118,7 @@ dp.include_router(r_generation.router)
 dp.message.middleware(ErrorLoggingMiddleware())
 dp.message.middleware(
     RateLimitMiddleware(
-        redis.from_url(f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB_CACHE}"),
+        get_redis(POOL_CACHE),
         settings.RATE_LIMIT_PER_MIN,
     )
 )
@@ -135,7 +126,7 @@ dp.message.middleware(
 dp.callback_query.middleware(ErrorLoggingMiddleware())
 dp.callback_query.middleware(
     RateLimitMiddleware(
-        redis.from_url(f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB_CACHE}"),
+        get_redis(POOL_CACHE),
         settings.RATE_LIMIT_PER_MIN,
     )
 )
@@ -143,6 +134,12 @@ dp.callback_query.middleware(
  
 app.state.bot = bot
 app.state.dp = dp
+app.state.arq = dp["arq_client"]
+app.state.update_queue = None
+app.state.album_aggregator = AlbumAggregator(
+    partial(r_generation.on_album_ready, bot, dp.storage),
+    poll_ms=settings.ALBUM_POLL_MS,
+)
 app.state.webhook_secret = settings.WEBHOOK_SECRET_TOKEN
 
 # FastAPI routes
@@ -157,7 +154,18 @@ app.include_router(rt_proxy.router)
 
 @app.on_event("startup")
 async def on_startup():
+    await init_redis_pools()
+    await init_arq_client()
     
+    if settings.TG_WEBHOOK_FAST_ACK:
+        app.state.update_queue = UpdateQueue(
+            bot, dp,
+            workers=settings.TG_DISPATCH_WORKERS,
+            maxsize=settings.TG_DISPATCH_QUEUE_SIZE,
+        )
+        app.state.update_queue.start()
+
+    app.state.album_aggregator.start()
     
     if settings.ADMIN_ID:
         from core.telegram_logger import TelegramLogHandler
@@ -190,4 +198,10 @@ async def on_startup():
 
 @app.on_event("shutdown")
 async def on_shutdown():
+    if app.state.update_queue is not None:
+        await app.state.update_queue.stop()
+        app.state.update_queue = None
+    await app.state.album_aggregator.stop()
     await bot.session.close()
+    await close_arq_client()
+    await close_redis_pools()
@@ -0,0 +1,155 @@
+"""
+Быстрый ACK Telegram-вебхука: апдейт кладётся в ограниченную очередь,
+а обрабатывают его фоновые таски.
+
+Апдейты раскладываются по lane'ам (одна lane = один chat_id): внутри lane
+строго по порядку и под межпроцессным локом chat_lane(), разные чаты —
+параллельно, не более `workers` обработчиков одновременно. Если в очереди
+уже maxsize апдейтов — submit() возвращает False и роут отвечает 503
+(Telegram повторит доставку позже). Если lane-лок не взят, lane с
+накопленными апдейтами повторяется TG_LANE_LOCK_RETRIES раз, затем
+апдейты сбрасываются (без лока они не обрабатываются).
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from core import metrics
+from core.config import settings
+from services.chat_lanes import LaneBusy, chat_lane
+
+log = logging.getLogger("update_queue")
+
+
+def _j(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+def update_chat_id(update: Update) -> Optional[int]:
+    """chat_id апдейта (ключ lane); None — если чат определить нельзя"""
+    try:
+        event = update.event
+    except Exception:
+        return None
+    chat = getattr(event, "chat", None)
+    if chat is None:
+        chat = getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None) or getattr(event, "user", None)
+    return getattr(user, "id", None)
+
+
+class UpdateQueue:
+    def __init__(self, bot: Bot, dp: Dispatcher, *, workers: int, maxsize: int):
+        self.bot = bot
+        self.dp = dp
+        self.workers = max(1, workers)
+        self.maxsize = max(1, maxsize)
+        self._sem = asyncio.Semaphore(self.workers)
+        self._lanes: Dict[int, Deque[Tuple[Update, float]]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def start(self) -> None:
+        log.info(_j("update_queue.started", workers=self.workers, maxsize=self.maxsize))
+
+    async def stop(self, timeout: float = 25.0) -> None:
+        """Дождаться разбора уже принятых апдейтов, затем остановить lane-таски"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            log.warning(_j("update_queue.stop_timeout", depth=self.depth()))
+        for t in list(self._tasks):
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def submit(self, update: Update) -> bool:
+        if self._pending >= self.maxsize:
+            metrics.inc("tg_queue.rejected")
+            return False
+
+        chat_id = update_chat_id(update)
+        # Без чата — отдельная lane на апдейт (ключ вне диапазона реальных chat_id)
+        lane_key = chat_id if chat_id is not None else -(10**15) - update.update_id
+        lane = self._lanes.get(lane_key)
+        item = (update, time.monotonic())
+        if lane is None:
+            self._lanes[lane_key] = deque([item])
+            task = asyncio.create_task(self._run_lane(lane_key, chat_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            lane.append(item)
+
+        self._pending += 1
+        self._idle.clear()
+        metrics.inc("tg_queue.accepted")
+        self._update_gauges()
+        return True
+
+    def depth(self) -> int:
+        return self._pending
+
+    def _update_gauges(self) -> None:
+        metrics.set_gauge("tg_queue.depth", self._pending)
+        metrics.set_gauge("tg_queue.lanes", len(self._lanes))
+
+    async def _run_lane(self, lane_key: int, chat_id: Optional[int]) -> None:
+        lane = self._lanes[lane_key]
+        try:
+            attempt = 0
+            while True:
+                try:
+                    async with chat_lane(chat_id):
+                        await self._drain(lane_key, lane, chat_id)
+                    break
+                except LaneBusy:
+                    attempt += 1
+                    if attempt > settings.TG_LANE_LOCK_RETRIES:
+                        # ✅ Fail: без лока не обрабатываем, хвост lane сбрасывается в finally
+                        metrics.inc("tg_queue.lane_dropped", len(lane))
+                        log.error(_j("update_queue.lane_dropped", chat_id=chat_id, updates=len(lane)))
+                        break
+                    # ✅ Requeue: апдейты остаются в lane (новые дописываются в хвост), повторяем позже
+                    metrics.inc("tg_queue.lane_retry")
+                    await asyncio.sleep(settings.TG_LANE_RETRY_DELAY_S * attempt)
+        finally:
+            if self._lanes.get(lane_key) is lane:
+                self._lanes.pop(lane_key, None)
+            # Отменённая/сброшенная lane не дорабатывает хвост — считаем его сброшенным
+            self._pending -= len(lane)
+            self._update_gauges()
+            if self._pending <= 0:
+                self._pending = 0
+                self._idle.set()
+
+    async def _drain(self, lane_key: int, lane: Deque[Tuple[Update, float]], chat_id: Optional[int]) -> None:
+        """Разобрать lane под уже взятым локом (его TTL продлевает chat_lane)"""
+        while True:
+            if not lane:
+                # Снимаем lane синхронно с проверкой: новый апдейт этого чата откроет новую
+                self._lanes.pop(lane_key, None)
+                return
+            update, enqueued_at = lane.popleft()
+            async with self._sem:
+                started = time.monotonic()
+                metrics.observe("tg_queue.wait_s", started - enqueued_at)
+                try:
+                    await self.dp.feed_update(self.bot, update)
+                except Exception:
+                    log.exception(_j("update_queue.handler_failed", chat_id=chat_id, update_id=update.update_id))
+                finally:
+                    metrics.observe("tg_queue.handle_s", time.monotonic() - started)
+                    self._pending -= 1